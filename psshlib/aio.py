@@ -0,0 +1,300 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""An asyncio engine for running Tasks (--engine=asyncio).
+
+The AsyncManager runs the same Tasks as the Manager, with the same options,
+reports, and output handling, but inside an asyncio event loop: processes
+are started with asyncio.create_subprocess_exec, their output is read with
+stream readers, and child exits are collected by asyncio instead of by a
+SIGCHLD handler.  This lets pssh share a loop with other asyncio code:
+
+    from psshlib import aio
+
+    async def main():
+        async for result in aio.run_hosts(hosts, 'uptime', capture=4096):
+            print(result.host, result.returncode, result.stdout)
+
+The parts of pssh that were written for an IOMap (the Printer for -P, the
+InputStream for -I, and the PasswordServer for -A) are registered with the
+loop through a LoopIOMap.
+"""
+
+import asyncio
+from asyncio.subprocess import DEVNULL, PIPE
+import sys
+import time
+
+from psshlib.api import Options, make_tasks
+from psshlib import controlpool
+from psshlib.manager import Manager
+from psshlib.task import BUFFER_SIZE
+
+
+class LoopIOMap(object):
+    """An IOMap that registers file descriptors with the running loop."""
+    def __init__(self):
+        self.loop = None
+        self.readers = set()
+        self.writers = set()
+
+    def _get_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        return self.loop
+
+    def register_read(self, fd, handler):
+        """Registers an IO handler for a file descriptor for reading."""
+        self._get_loop().add_reader(fd, handler, fd, self)
+        self.readers.add(fd)
+
+    def register_write(self, fd, handler):
+        """Registers an IO handler for a file descriptor for writing."""
+        self._get_loop().add_writer(fd, handler, fd, self)
+        self.writers.add(fd)
+
+    def unregister(self, fd):
+        """Unregisters the given file descriptor."""
+        if fd in self.readers:
+            self.loop.remove_reader(fd)
+            self.readers.remove(fd)
+        if fd in self.writers:
+            self.loop.remove_writer(fd)
+            self.writers.remove(fd)
+
+    def close(self):
+        """Unregisters every file descriptor."""
+        for fd in list(self.readers | self.writers):
+            self.unregister(fd)
+
+
+class AsyncManager(Manager):
+    """Executes tasks concurrently in an asyncio event loop.
+
+    Use run() from synchronous code (as the pssh programs do), or iterate
+    over results() from a coroutine.  The settings, callback, and cancel()
+    are the same as for the Manager.  Output is never spliced.
+    """
+    def __init__(self, opts):
+        Manager.__init__(self, opts, iomap=LoopIOMap())
+        self.splice = False
+        # Processes get no pty, so the password goes through pssh-askpass.
+        self.askpass_mode = 'program'
+        self.flush_scheduled = False
+        # The running Tasks, keyed by the futures that run them.
+        self.running = {}
+
+    def run(self):
+        """Processes the tasks in a new event loop."""
+        try:
+            asyncio.run(self._run())
+        except KeyboardInterrupt:
+            pass
+
+    async def _run(self):
+        async for result in self.results():
+            pass
+
+    async def results(self):
+        """Runs the tasks and yields a Result for each as it finishes."""
+        try:
+            self.prepare()
+            try:
+                while True:
+                    self._start_tasks()
+                    if not self.running:
+                        break
+                    done, _ = await asyncio.wait(list(self.running),
+                            return_when=asyncio.FIRST_COMPLETED)
+                    for future in done:
+                        self._finished_future(future)
+                        yield self.done[-1]
+            except asyncio.CancelledError:
+                # Report each interrupted host, as after a KeyboardInterrupt.
+                self.interrupted()
+                raise
+            except GeneratorExit:
+                # The caller stopped iterating, so stop the run too.
+                self.cancel()
+                while self.running:
+                    done, _ = await asyncio.wait(list(self.running))
+                    for future in done:
+                        self._finished_future(future)
+                raise
+        finally:
+            for future in self.running:
+                future.cancel()
+            self.running = {}
+            self.finish()
+
+    def _finished_future(self, future):
+        """Finishes the Task run by a future, recording any error it raised."""
+        task = self.running.pop(future)
+        if not future.cancelled():
+            try:
+                future.result()
+            except Exception:
+                _, e, _ = sys.exc_info()
+                task.log_exception(e)
+        self.finished(task)
+
+    def _start_tasks(self):
+        """Starts as many tasks as allowed."""
+        while len(self.running) < self.limit:
+            task = self._next_task()
+            if task is None:
+                break
+            task.splice = False
+            environ = task.setup(self.taskcount, self.iomap, self.writer,
+                    self.askpass_socket, self.environ, self.printer,
+                    self.reducer)
+            if task.inputstream:
+                # Readers must exist before the stream is sealed.
+                task.inputreader = task.inputstream.reader(self.iomap)
+            future = asyncio.ensure_future(self._run_task(task, environ))
+            self.running[future] = task
+            self.taskcount += 1
+        if not self.sealed and not self.pending():
+            self.sealed = True
+            for task in self.running.values():
+                task.seal_input()
+
+    async def _run_task(self, task, environ):
+        """Runs the process of a Task until it exits and its output ends."""
+        if task.inputstream:
+            stdin = PIPE
+        else:
+            stdin = DEVNULL
+        try:
+            proc = await asyncio.create_subprocess_exec(*task.cmd,
+                    stdin=stdin, stdout=PIPE, stderr=PIPE, env=environ,
+                    start_new_session=True)
+        except (OSError, IOError):
+            _, e, _ = sys.exc_info()
+            task.timestamp = time.time()
+            task.log_exception(e)
+            task.close_stdin(self.iomap)
+            task.close_stdout(self.iomap)
+            task.close_stderr(self.iomap)
+            return
+        task.proc = proc
+        task.pid = proc.pid
+        task.timestamp = time.time()
+
+        if task.inputstream:
+            feeder = asyncio.ensure_future(self._feed_input(task, proc.stdin))
+        else:
+            feeder = None
+        jobs = [asyncio.ensure_future(job) for job in (
+                self._read(task, proc.stdout, task.receive_stdout,
+                    task.close_stdout),
+                self._read(task, proc.stderr, task.receive_stderr,
+                    task.close_stderr),
+                proc.wait())]
+        try:
+            if self.timeout > 0:
+                timeout = self.timeout
+            else:
+                timeout = None
+            done, pending = await asyncio.wait(jobs, timeout=timeout)
+            if pending:
+                task.timedout()
+                await asyncio.wait(pending)
+        except asyncio.CancelledError:
+            for job in jobs:
+                job.cancel()
+            task.interrupted()
+            raise
+        except Exception:
+            # Don't leave the process running with nobody to wait for it.
+            task._kill()
+            await asyncio.wait(jobs)
+            raise
+        finally:
+            if feeder and not feeder.done():
+                # Nobody is left to read the rest of the input.
+                feeder.cancel()
+        task.returned(proc.returncode)
+
+    async def _read(self, task, stream, receive, close):
+        """Passes the output of one stream to the Task until it ends."""
+        try:
+            while True:
+                buf = await stream.read(BUFFER_SIZE)
+                if not buf:
+                    break
+                receive(buf)
+                printer = task.printer
+                if printer:
+                    self._schedule_flush()
+                    if printer.full():
+                        # Stop reading until the printer catches up.
+                        await self._wait(printer.wait)
+        except (OSError, IOError):
+            _, e, _ = sys.exc_info()
+            task.log_exception(e)
+        # If the task is cancelled instead, it may already be released.
+        close(self.iomap)
+
+    async def _feed_input(self, task, stdin):
+        """Writes the Task's input stream to the process."""
+        reader = task.inputreader
+        try:
+            while True:
+                chunk = reader.peek()
+                if chunk is not None:
+                    stdin.write(chunk)
+                    reader.advance(len(chunk))
+                    task.byteswritten += len(chunk)
+                    await stdin.drain()
+                elif reader.at_eof():
+                    break
+                else:
+                    await self._wait(reader.wait)
+        except (OSError, IOError):
+            _, e, _ = sys.exc_info()
+            task.log_exception(e)
+        finally:
+            stdin.close()
+            reader.close()
+            task.inputreader = None
+
+    async def _wait(self, register):
+        """Waits until the callback given to register is called."""
+        waiter = asyncio.get_running_loop().create_future()
+        def wake():
+            if not waiter.done():
+                waiter.set_result(None)
+        register(wake)
+        await waiter
+
+    def _schedule_flush(self):
+        """Flushes the printer once the current callbacks are done."""
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self):
+        self.flush_scheduled = False
+        if self.printer:
+            self.printer.flush()
+
+
+async def run_hosts(hosts, cmdline, stdin=None, callback=None, opts=None,
+        **kwargs):
+    """Runs cmdline over ssh on each host, yielding Results as they finish.
+
+    Takes the same arguments as psshlib.api.Run.
+    """
+    if opts is None:
+        opts = Options(**kwargs)
+    elif kwargs:
+        raise TypeError('options must be given in opts or as keyword '
+                'arguments, not both')
+    manager = AsyncManager(opts)
+    manager.callback = callback
+    pool = controlpool.from_opts(opts)
+    manager.add_tasks(make_tasks(hosts, cmdline, opts, stdin, pool))
+    async for result in manager.results():
+        yield result
+    if pool:
+        pool.finish()
@@ -0,0 +1,217 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""A library interface for running commands on many hosts.
+
+This drives the same Manager and Tasks as the pssh program, but takes its
+settings as keyword arguments instead of parsed command-line options, prints
+nothing, and hands back a Result (see psshlib.task.Result) for each host as
+it finishes:
+
+    from psshlib.api import Run
+
+    run = Run(['web1', 'web2', 'root@db:2222'], 'uptime', par=50, timeout=30,
+            capture=4096)
+    for result in run:
+        print(result.host, result.returncode, result.stdout)
+
+Results can also go to a callback, which may call run.cancel() to stop the
+run early.  Several Runs can share one thread by calling poll() with a
+timeout on each in turn.  A Run only reaps its own children, so the process
+may start and wait for others, and when it finishes, it puts back the
+SIGCHLD handler and signal wakeup fd that were in place.  A Run may also be
+driven from a thread other than the main one.
+"""
+
+from psshlib import controlpool
+from psshlib.manager import Manager
+from psshlib import psshutil
+from psshlib.task import Task
+
+_DEFAULT_PARALLELISM = 32
+_DEFAULT_TIMEOUT = -1
+
+
+class Options(object):
+    """Settings for a Run, in place of the options of the pssh program.
+
+    Any option of the pssh program can be given by its dest name (such as
+    par, timeout, user, outdir, errdir, options, extra, capture, include,
+    json, or control_dir).  Options that are not given are None, except par
+    (32), timeout (-1, for none), and quiet (true, so no status lines are
+    printed).
+    """
+    def __init__(self, **kwargs):
+        self.par = _DEFAULT_PARALLELISM
+        self.timeout = _DEFAULT_TIMEOUT
+        self.quiet = True
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, name):
+        # Only called for options that were not given.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return None
+
+
+def ssh_command(host, port, user, cmdline, opts, pool=None):
+    """Returns the ssh command line (as a list) for running cmdline on host.
+
+    If a ControlPool is given, the connection goes through its master.
+    """
+    cmd = ['ssh', host, '-o', 'NumberOfPasswordPrompts=1',
+            '-o', 'SendEnv=PSSH_NODENUM']
+    if not opts.verbose:
+        cmd.append('-q')
+    if opts.options:
+        cmd += ['-o', opts.options]
+    if pool:
+        cmd += pool.options(host, port, user)
+    if user:
+        cmd += ['-l', user]
+    if port:
+        cmd += ['-p', port]
+    if opts.extra:
+        cmd.extend(opts.extra)
+    if cmdline:
+        cmd.append(cmdline)
+    return cmd
+
+
+def make_tasks(hosts, cmdline, opts, stdin=None, pool=None):
+    """Generates a Task for each host, as a Manager has room for it.
+
+    The hosts are "[user@]host[:port]" strings or (host, port, user) tuples.
+    """
+    for entry in hosts:
+        if isinstance(entry, tuple):
+            host, port, user = entry
+        else:
+            host, port, user = psshutil.parse_host(entry,
+                    default_user=opts.user)
+        cmd = ssh_command(host, port, user, cmdline, opts, pool)
+        yield Task(host, port, user, cmd, opts, stdin)
+
+
+class Run(object):
+    """Runs a command over ssh on each of the given hosts.
+
+    Arguments:
+        hosts: Iterable of "[user@]host[:port]" strings or (host, port, user)
+            tuples.  It is consumed lazily as hosts start.
+        cmdline: The command to run on each host.
+        stdin: Bytes (or an InputStream) to send to every host.
+        callback: Called with each Result as its host finishes.
+        opts: An Options object; any other keyword arguments are options.
+
+    The Run starts with the first call to poll(), wait(), or iteration.
+    """
+    def __init__(self, hosts, cmdline, stdin=None, callback=None, opts=None,
+            **kwargs):
+        if opts is None:
+            opts = Options(**kwargs)
+        elif kwargs:
+            raise TypeError('options must be given in opts or as keyword '
+                    'arguments, not both')
+        self.opts = opts
+        self.cmdline = cmdline
+        self.stdin = stdin
+        self.callback = callback
+        # With the control_dir option, connections go through a ControlPool.
+        self.pool = controlpool.from_opts(opts)
+        self.manager = Manager(opts)
+        self.manager.add_tasks(make_tasks(hosts, cmdline, opts, stdin,
+            self.pool))
+        self.manager.callback = self._finished
+        self.started = False
+        self.done = False
+        # Results that have not been returned by poll() or iteration.
+        self.results = []
+
+    def _finished(self, result):
+        self.results.append(result)
+        if self.callback:
+            self.callback(result)
+
+    def poll(self, timeout=None):
+        """Handles events once and returns the Results of new finishers.
+
+        Waits at most timeout seconds (forever if None) for something to
+        happen.  After the last host finishes, the Run cleans up and done
+        becomes true.
+        """
+        if self.done:
+            results, self.results = self.results, []
+            return results
+        try:
+            if not self.started:
+                self.started = True
+                self.manager.start()
+            running = self.manager.step(timeout)
+        except:
+            # For example, the callback raised: stop the run, so that its
+            # processes, file descriptors, and signal handlers are released.
+            self._abort()
+            raise
+        if not running:
+            self._cleanup()
+        results, self.results = self.results, []
+        return results
+
+    def _abort(self):
+        """Cancels the run after an error and waits for it to end."""
+        # Don't call a callback that may fail again.
+        self.callback = None
+        try:
+            self.manager.cancel()
+            while self.manager.step():
+                pass
+        finally:
+            self._cleanup()
+
+    def _cleanup(self):
+        self.done = True
+        self.manager.finish()
+        if self.pool:
+            self.pool.finish()
+
+    def __iter__(self):
+        """Yields a Result for each host as it finishes.
+
+        If the loop stops early, the rest of the run is cancelled.
+        """
+        try:
+            while True:
+                for result in self.poll():
+                    yield result
+                if self.done:
+                    break
+        finally:
+            if not self.done:
+                self.cancel()
+                self.wait()
+
+    def wait(self):
+        """Runs until every host finishes and returns the remaining Results."""
+        results = []
+        while not self.done:
+            results.extend(self.poll())
+        results.extend(self.results)
+        self.results = []
+        return results
+
+    def cancel(self):
+        """Stops the run: unstarted hosts are cancelled, running ones killed.
+
+        Killed hosts still produce Results (failed with "Cancelled") once
+        their processes exit.  Call this from the thread that polls the Run,
+        for example from the callback.
+        """
+        self.manager.cancel()
+
+
+def run(hosts, cmdline, **kwargs):
+    """Runs cmdline on every host and returns a list of Results.
+
+    Takes the same arguments as Run.
+    """
+    return Run(hosts, cmdline, **kwargs).wait()
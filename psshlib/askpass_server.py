@@ -17,6 +17,14 @@ import textwrap
 from psshlib import psshutil
 
 
+def prompt_password():
+    """Warns the user and reads the password from the terminal."""
+    message = ('Warning: do not enter your password if anyone else has'
+            ' superuser privileges or access to your account.')
+    print(textwrap.fill(message))
+    return getpass.getpass()
+
+
 class PasswordServer(object):
     """Listens on a UNIX domain socket for password requests."""
     def __init__(self):
@@ -32,11 +40,9 @@ class PasswordServer(object):
         The specified backlog should be the max number of clients connecting
         at once.
         """
-        message = ('Warning: do not enter your password if anyone else has'
-                ' superuser privileges or access to your account.')
-        print(textwrap.fill(message))
-
-        self.password = getpass.getpass()
+        self.password = prompt_password()
+        if not isinstance(self.password, bytes):
+            self.password = self.password.encode('utf-8')
 
         # Note that according to the docs for mkdtemp, "The directory is
         # readable, writable, and searchable only by the creating user."
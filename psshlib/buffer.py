@@ -0,0 +1,144 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""Buffers for output that is held until a task is reported."""
+
+from collections import deque
+import io
+import tempfile
+
+COPY_SIZE = 1 << 16
+
+
+class Capture(object):
+    """Keeps up to limit bytes from the start of a stream."""
+    __slots__ = ('limit', 'data', 'truncated')
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = bytearray()
+        self.truncated = False
+
+    def add(self, buf):
+        room = self.limit - len(self.data)
+        if len(buf) > room:
+            self.truncated = True
+            buf = buf[:room]
+        if buf:
+            self.data += buf
+
+
+class OutputBuffer(object):
+    """Accumulates the output of a stream, optionally with a size cap.
+
+    Data is kept as a list of chunks, so each append costs time proportional
+    to the size of the chunk rather than the size of the buffer.
+
+    Arguments:
+        limit: Maximum number of bytes to keep in memory (None for no limit).
+        spill: If true, output beyond the limit is moved to a temporary file
+            instead of being dropped.  Otherwise, only the first and last
+            limit/2 bytes are kept, and the bytes in between are counted in
+            the omitted attribute.
+    """
+    def __init__(self, limit=None, spill=False):
+        self.limit = limit
+        self.spill = spill
+        self.total = 0
+        self.omitted = 0
+        self.spillfile = None
+
+        self.head = []
+        self.headsize = 0
+        self.tail = deque()
+        self.tailsize = 0
+        if limit is None:
+            self.headlimit = None
+        elif spill:
+            self.headlimit = limit
+        else:
+            self.headlimit = limit // 2
+            self.taillimit = limit - self.headlimit
+
+    def __len__(self):
+        """Returns the total number of bytes appended (including omitted)."""
+        return self.total
+
+    def append(self, data):
+        """Adds a chunk of data to the end of the buffer."""
+        self.total += len(data)
+        if self.spillfile:
+            self.spillfile.write(data)
+            return
+        headroom = None
+        if self.headlimit is not None:
+            headroom = self.headlimit - self.headsize
+        if headroom is None or len(data) <= headroom:
+            self.head.append(data)
+            self.headsize += len(data)
+        elif self.spill:
+            self._spill(data)
+        else:
+            if headroom > 0:
+                self.head.append(data[:headroom])
+                self.headsize += headroom
+                data = data[headroom:]
+            self._append_tail(data)
+
+    def _append_tail(self, data):
+        """Adds data to the tail, dropping the oldest tail bytes if needed."""
+        self.tail.append(data)
+        self.tailsize += len(data)
+        excess = self.tailsize - self.taillimit
+        while excess > 0:
+            first = self.tail[0]
+            if len(first) <= excess:
+                self.tail.popleft()
+                cut = len(first)
+            else:
+                self.tail[0] = first[excess:]
+                cut = excess
+            self.tailsize -= cut
+            self.omitted += cut
+            excess -= cut
+
+    def _spill(self, data):
+        """Moves the buffer to a temporary file and appends data to it."""
+        self.spillfile = tempfile.TemporaryFile(prefix='pssh.')
+        for chunk in self.head:
+            self.spillfile.write(chunk)
+        self.spillfile.write(data)
+        self.head = []
+        self.headsize = 0
+
+    def write_to(self, stream):
+        """Writes the buffered output to the given binary stream."""
+        if self.spillfile:
+            self.spillfile.flush()
+            self.spillfile.seek(0)
+            while True:
+                chunk = self.spillfile.read(COPY_SIZE)
+                if not chunk:
+                    break
+                stream.write(chunk)
+            return
+        for chunk in self.head:
+            stream.write(chunk)
+        if self.omitted:
+            stream.write(('\n[... %s bytes omitted ...]\n'
+                % self.omitted).encode('ascii'))
+        for chunk in self.tail:
+            stream.write(chunk)
+
+    def getvalue(self):
+        """Returns the buffered output as a single bytes object."""
+        out = io.BytesIO()
+        self.write_to(out)
+        return out.getvalue()
+
+    def close(self):
+        """Discards the buffered output and any temporary file."""
+        if self.spillfile:
+            self.spillfile.close()
+            self.spillfile = None
+        self.head = []
+        self.tail = deque()
@@ -7,9 +7,17 @@ import shlex
 import sys
 import textwrap
 
+from psshlib import compress
+from psshlib.reduce import parse_spec
+
 _DEFAULT_PARALLELISM = 32
 _DEFAULT_TIMEOUT     = -1 # "infinity" by default
 
+ENGINES = ('poll', 'asyncio')
+ASKPASS_MODES = ('program', 'pty')
+
+_DEFAULT_DAEMON_SOCKET = os.path.join('~', '.pssh', 'daemon.sock')
+
 def common_parser():
     """
     Create a basic OptionParser with arguments common to all pssh programs.
@@ -35,6 +43,38 @@ def common_parser():
             help='output directory for stdout files (OPTIONAL)')
     parser.add_option('-e', '--errdir', dest='errdir',
             help='output directory for stderr files (OPTIONAL)')
+    parser.add_option('--writer-threads', dest='writer_threads', type='int',
+            metavar='N', help='number of threads writing to the output '
+            'and error directories (default 1) (OPTIONAL)')
+    parser.add_option('--max-open-files', dest='max_open_files', type='int',
+            metavar='N', help='most output and error files to keep open at '
+            'once (default 256) (OPTIONAL)')
+    parser.add_option('--compress-output', dest='compress_output',
+            action='callback', type='string', callback=codec_option,
+            metavar='CODEC', help='compress the files in the output and error '
+            'directories with CODEC[:LEVEL] (%s) (OPTIONAL)'
+            % ', '.join(sorted(compress.CODECS)))
+    parser.add_option('--json', dest='json', metavar='FILE',
+            help='write a JSON record for each host to FILE ("-" for '
+            'stdout, instead of the status lines) as it finishes (OPTIONAL)')
+    parser.add_option('--json-output', dest='capture', type='int',
+            metavar='BYTES', help='with --json, include up to BYTES of the '
+            'stdout and stderr of each host, base64-encoded (OPTIONAL)')
+    parser.add_option('--engine', dest='engine', type='choice',
+            choices=ENGINES, metavar='ENGINE', help='how to run the '
+            'commands: %s (default poll) (OPTIONAL)' % ', '.join(ENGINES))
+    parser.add_option('--workers', dest='workers', type='int',
+            metavar='N', help='split the hosts among N worker processes, '
+            'each running its share of the -p limit (OPTIONAL)')
+    parser.add_option('--control-dir', dest='control_dir', metavar='DIR',
+            help='share ssh master connections through control sockets in '
+            'DIR, across hosts and runs (OPTIONAL)')
+    parser.add_option('--control-persist', dest='control_persist',
+            type='int', metavar='SECS', help='with --control-dir, close '
+            'masters idle for SECS seconds (default 600) (OPTIONAL)')
+    parser.add_option('--control-max', dest='control_max', type='int',
+            metavar='N', help='with --control-dir, keep at most N masters, '
+            'closing the least recently used (OPTIONAL)')
     parser.add_option('-t', '--timeout', dest='timeout', type='int',
             help='timeout (secs) (-1 = no timeout) per host (OPTIONAL)')
     parser.add_option('-O', '--options', dest='options',
@@ -43,6 +83,11 @@ def common_parser():
             help='turn on warning and diagnostic messages (OPTIONAL)')
     parser.add_option('-A', '--askpass', dest='askpass', action='store_true',
             help='Ask for a password (OPTIONAL)')
+    parser.add_option('--askpass-mode', dest='askpass_mode', type='choice',
+            choices=ASKPASS_MODES, metavar='MODE', help='with -A, how ssh '
+            'gets the password: program (an askpass process per host) or '
+            'pty (typed at the prompt on a terminal, with no extra process) '
+            '(default program) (OPTIONAL)')
     parser.add_option('-x', '--extra-args', action='callback', type='string',
             metavar='ARGS', callback=shlex_append, dest='extra',
             help='Extra command-line arguments, with processing for '
@@ -64,11 +109,13 @@ def common_defaults(**kwargs):
             ('verbose', 'PSSH_VERBOSE'),
             ('print_out', 'PSSH_PRINT'),
             ('askpass', 'PSSH_ASKPASS'),
+            ('askpass_mode', 'PSSH_ASKPASS_MODE'),
             ('inline', 'PSSH_INLINE'),
             ('recursive', 'PSSH_RECURSIVE'),
             ('archive', 'PSSH_ARCHIVE'),
             ('compress', 'PSSH_COMPRESS'),
             ('localdir', 'PSSH_LOCALDIR'),
+            ('control_dir', 'PSSH_CONTROL_DIR'),
             ]
     for option, var, in envvars:
         value = os.getenv(var)
@@ -89,6 +136,15 @@ def common_defaults(**kwargs):
 
     return defaults
 
+def daemon_socket(path=None):
+    """Returns the socket path of pssh-daemon.
+
+    The default comes from PSSH_DAEMON_SOCKET, or is ~/.pssh/daemon.sock.
+    """
+    if not path:
+        path = os.getenv('PSSH_DAEMON_SOCKET') or _DEFAULT_DAEMON_SOCKET
+    return os.path.expanduser(path)
+
 def shlex_append(option, opt_str, value, parser):
     """An optparse callback similar to the append action.
 
@@ -100,3 +156,21 @@ def shlex_append(option, opt_str, value, parser):
         lst = []
         setattr(parser.values, option.dest, lst)
     lst.extend(shlex.split(value))
+
+def reducer_option(option, opt_str, value, parser):
+    """An optparse callback that checks a reducer spec."""
+    try:
+        parse_spec(value)
+    except ValueError:
+        _, e, _ = sys.exc_info()
+        raise optparse.OptionValueError('option %s: %s' % (opt_str, e))
+    setattr(parser.values, option.dest, value)
+
+def codec_option(option, opt_str, value, parser):
+    """An optparse callback that checks a compression codec spec."""
+    try:
+        compress.get_codec(value)
+    except ValueError:
+        _, e, _ = sys.exc_info()
+        raise optparse.OptionValueError('option %s: %s' % (opt_str, e))
+    setattr(parser.values, option.dest, value)
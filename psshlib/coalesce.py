@@ -0,0 +1,141 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""Grouping of hosts with identical output (pssh --coalesce).
+
+Each Task hashes its stdout and stderr as they stream in.  When the Task
+finishes, the Coalescer looks up the pair of digests: the first host with a
+given output donates its buffers to a new group, and later hosts with the
+same output just add their names, so memory grows with the number of
+distinct outputs rather than with the number of hosts.  At the end, each
+group is printed once under a compressed list of its hosts, in the style of
+"dshbak -c".
+"""
+
+import re
+
+SEPARATOR = '-' * 16
+
+# A host name split into a prefix, a number, and a suffix (which may be a
+# ":port").
+_NUMBERED = re.compile(r'^(.*?)(\d+)(\D*(?::\d+)?)$')
+
+
+class Group(object):
+    """Hosts that produced the same stdout and stderr."""
+    __slots__ = ('hosts', 'outputbuffer', 'errorbuffer')
+
+    def __init__(self, outputbuffer, errorbuffer):
+        self.hosts = []
+        self.outputbuffer = outputbuffer
+        self.errorbuffer = errorbuffer
+
+
+class Coalescer(object):
+    """Collects finished Tasks into groups with identical output."""
+    def __init__(self):
+        self.groups = {}
+        # Groups in the order their first host finished.
+        self.order = []
+
+    def add(self, task):
+        """Adds a finished Task, taking its buffers if its output is new."""
+        key = (task.outhash.digest(), task.errhash.digest())
+        group = self.groups.get(key)
+        if group is None:
+            group = Group(task.outputbuffer, task.errorbuffer)
+            # The group owns the buffers now, so Task.release keeps them.
+            task.outputbuffer = None
+            task.errorbuffer = None
+            self.groups[key] = group
+            self.order.append(group)
+        if task.port:
+            group.hosts.append('%s:%s' % (task.host, task.port))
+        else:
+            group.hosts.append(task.host)
+
+    def report(self, out):
+        """Writes every group to the given binary stream."""
+        for group in self.order:
+            hosts = compress_hosts(group.hosts)
+            if len(group.hosts) > 1:
+                hosts = '%s (%s hosts)' % (hosts, len(group.hosts))
+            out.write(('%s\n%s\n%s\n' % (SEPARATOR, hosts, SEPARATOR))
+                    .encode('utf-8'))
+            if group.outputbuffer:
+                group.outputbuffer.write_to(out)
+            if group.errorbuffer:
+                out.write('Stderr: '.encode('ascii'))
+                group.errorbuffer.write_to(out)
+        out.flush()
+
+    def close(self):
+        """Discards the buffers of all groups."""
+        for group in self.order:
+            group.outputbuffer.close()
+            group.errorbuffer.close()
+        self.groups = {}
+        self.order = []
+
+
+def compress_hosts(names):
+    """Returns a compact description of a list of host names.
+
+    Names that differ only in a number are combined into ranges, so that
+    ["web1", "web2", "web3", "web5", "db"] becomes "db,web[1-3,5]".  Numbers
+    with leading zeros are only combined with numbers of the same width.
+    """
+    plain = []
+    matches = []
+    # Widths of zero-padded numbers, by (prefix, suffix).
+    padded = {}
+    for name in names:
+        match = _NUMBERED.match(name)
+        if not match:
+            plain.append(name)
+            continue
+        prefix, digits, suffix = match.groups()
+        matches.append((prefix, digits, suffix))
+        if len(digits) > 1 and digits.startswith('0'):
+            padded.setdefault((prefix, suffix), set()).add(len(digits))
+
+    numbered = {}
+    for prefix, digits, suffix in matches:
+        # Numbers like 10 go with 01-09 if they have the same width.
+        if len(digits) in padded.get((prefix, suffix), ()):
+            width = len(digits)
+        else:
+            width = 0
+        key = (prefix, suffix, width)
+        numbers = numbered.get(key)
+        if numbers is None:
+            numbers = numbered[key] = set()
+        numbers.add(int(digits))
+
+    parts = [(name, name) for name in set(plain)]
+    for (prefix, suffix, width), numbers in numbered.items():
+        numbers = sorted(numbers)
+        if len(numbers) == 1:
+            name = '%s%0*d%s' % (prefix, width, numbers[0], suffix)
+        else:
+            ranges = []
+            start = end = numbers[0]
+            for number in numbers[1:] + [None]:
+                if number is not None and number == end + 1:
+                    end = number
+                    continue
+                if start == end:
+                    ranges.append('%0*d' % (width, start))
+                else:
+                    ranges.append('%0*d-%0*d' % (width, start, width, end))
+                start = end = number
+            name = '%s[%s]%s' % (prefix, ','.join(ranges), suffix)
+        parts.append(((prefix, suffix, numbers[0]), name))
+    parts.sort(key=_sort_key)
+    return ','.join([name for key, name in parts])
+
+
+def _sort_key(part):
+    key = part[0]
+    if isinstance(key, tuple):
+        return (key[0], key[2], key[1])
+    return (key, -1, '')
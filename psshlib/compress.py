@@ -0,0 +1,101 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""Streaming compression codecs for output files.
+
+A codec is named by a spec of the form "NAME" or "NAME:LEVEL", for example
+"gzip" or "xz:1".  Each compressed stream can be finished and a new one
+started at any time: gzip, bzip2, and xz all treat concatenated streams as
+one file, so a file that is closed and reopened in append mode stays
+readable with the usual tools.
+"""
+
+import zlib
+
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+class Codec(object):
+    """A compression method and level.
+
+    Arguments:
+        name: The name used in specs.
+        suffix: Appended to the names of compressed files.
+        factory: Called with the level to create a compressor, an object
+            with compress(data) and flush() methods like zlib's.
+        level: Compression level, or None for the default_level.
+    """
+    def __init__(self, name, suffix, factory, default_level, level=None):
+        self.name = name
+        self.suffix = suffix
+        self.factory = factory
+        self.default_level = default_level
+        if level is None:
+            level = default_level
+        self.level = level
+
+    def compressor(self):
+        """Creates a compressor for a new stream."""
+        return self.factory(self.level)
+
+    def __str__(self):
+        return '%s:%s' % (self.name, self.level)
+
+
+def _gzip(level):
+    # A wbits of 31 produces a gzip header and trailer.
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+def _bzip2(level):
+    return bz2.BZ2Compressor(level)
+
+def _xz(level):
+    return lzma.LZMACompressor(preset=level)
+
+
+# Codecs by name: (suffix, factory, default level).
+CODECS = {'gzip': ('.gz', _gzip, 6)}
+if bz2:
+    CODECS['bzip2'] = ('.bz2', _bzip2, 9)
+if lzma:
+    CODECS['xz'] = ('.xz', _xz, 1)
+
+
+def register_codec(name, suffix, factory, default_level):
+    """Adds a codec that can be selected by name."""
+    CODECS[name] = (suffix, factory, default_level)
+
+
+def get_codec(spec):
+    """Returns the Codec for a spec like "gzip" or "gzip:1".
+
+    Raises ValueError if the codec is unknown or the level is not a number.
+    """
+    name, _, level = spec.partition(':')
+    try:
+        suffix, factory, default_level = CODECS[name]
+    except KeyError:
+        raise ValueError('unknown codec %r (available: %s)'
+                % (name, ', '.join(sorted(CODECS))))
+    if level:
+        try:
+            level = int(level)
+        except ValueError:
+            raise ValueError('invalid compression level %r' % level)
+    else:
+        level = None
+    codec = Codec(name, suffix, factory, default_level, level)
+    try:
+        # Check the level now rather than in a Writer thread.
+        codec.compressor()
+    except Exception:
+        raise ValueError('invalid compression level %s for %s'
+                % (level, name))
+    return codec
@@ -0,0 +1,201 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""A pool of ssh master connections shared by pssh runs (--control-dir).
+
+With a control directory, every ssh (and the ssh under scp and rsync) is
+started with ControlMaster=auto and a ControlPath in that directory, one per
+destination, and with ControlPersist.  The first connection to a host does
+the TCP handshake and key exchange and stays in the background as a master;
+later connections to the same host, from this run or from any later run of
+pssh, pnuke, pscp, pslurp, or prsync that uses the same directory, are
+multiplexed over it and start right away.  Running a trivial command (such
+as "pssh -h hosts --control-dir DIR true") warms the masters for all of the
+hosts in parallel.
+
+Masters exit by themselves after being idle for the persist time.  The pool
+also closes masters that have not been used for that long, and, if there are
+more than max_sockets, the least recently used ones, at the end of each run.
+The modification time of each socket records its last use.  Closing a master
+only stops it from accepting new sessions (ssh -O stop): sessions that other
+runs, or daemon jobs, have open on it carry on, and the master exits once
+they end.
+
+The pool counts hits (hosts that already had a live master) and misses.
+"""
+
+from errno import ECONNREFUSED, ENOENT
+import hashlib
+import os
+import socket
+import stat
+import subprocess
+import sys
+import time
+
+DEFAULT_PERSIST = 600
+
+
+class ControlPool(object):
+    """Manages the control sockets of ssh masters in a directory.
+
+    Arguments:
+        directory: Directory for the sockets (created if necessary).
+        persist: Seconds that an idle master stays up.
+        max_sockets: Most masters to keep after a run, or None for no limit.
+    """
+    def __init__(self, directory, persist=DEFAULT_PERSIST, max_sockets=None):
+        self.directory = os.path.expanduser(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 448) # 0700
+        self.persist = persist
+        self.max_sockets = max_sockets
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, host, port=None, user=None):
+        """Returns the control socket path for a destination.
+
+        The name is a hash, so that it stays within the length limit of
+        socket paths.
+        """
+        key = '%s@%s:%s' % (user or '', host, port or '')
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+        return os.path.join(self.directory, name)
+
+    def options(self, host, port=None, user=None):
+        """Returns ssh arguments that use the pool for a destination.
+
+        The destination counts as a hit if its master is alive.
+        """
+        path = self.path(host, port, user)
+        if is_alive(path):
+            self.hits += 1
+            try:
+                # Record the use for the least recently used policy.
+                os.utime(path, None)
+            except OSError:
+                pass
+        else:
+            self.misses += 1
+        return ['-o', 'ControlMaster=auto', '-o', 'ControlPath=%s' % path,
+                '-o', 'ControlPersist=%s' % self.persist]
+
+    def sockets(self):
+        """Returns a list of (last use, path) for the sockets, oldest first."""
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISSOCK(st.st_mode):
+                entries.append((st.st_mtime, path))
+        entries.sort()
+        return entries
+
+    def expire(self, now=None):
+        """Closes expired and excess masters and removes stale sockets.
+
+        Returns the number of masters closed.
+        """
+        if now is None:
+            now = time.time()
+        live = [(mtime, path) for mtime, path in self.sockets()
+                if is_alive(path)]
+        doomed = [path for mtime, path in live if now - mtime > self.persist]
+        live = [(mtime, path) for mtime, path in live if path not in doomed]
+        if self.max_sockets is not None and len(live) > self.max_sockets:
+            excess = len(live) - self.max_sockets
+            doomed.extend([path for mtime, path in live[:excess]])
+        close_masters(doomed)
+        return len(doomed)
+
+    def hit_rate(self):
+        """Returns the fraction of destinations that had a live master."""
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return float(self.hits) / total
+
+    def finish(self, verbose=False):
+        """Applies the expiry policy after a run, and reports the hit rate."""
+        closed = self.expire()
+        if verbose:
+            sys.stderr.write('Control pool: %s hits, %s misses (%.0f%% hit '
+                    'rate); %s masters closed\n' % (self.hits, self.misses,
+                        100 * self.hit_rate(), closed))
+
+
+def from_opts(opts):
+    """Returns a ControlPool for the control options, or None."""
+    directory = getattr(opts, 'control_dir', None)
+    if not directory:
+        return None
+    persist = getattr(opts, 'control_persist', None)
+    if persist is None:
+        persist = DEFAULT_PERSIST
+    return ControlPool(directory, persist,
+            getattr(opts, 'control_max', None))
+
+
+def is_alive(path):
+    """Finds whether a master is listening on the control socket."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        _, e, _ = sys.exc_info()
+        if e.errno == ECONNREFUSED and is_socket(path):
+            # The master died without removing its socket.
+            remove(path)
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def is_socket(path):
+    """Finds whether path is a socket, without following symlinks."""
+    try:
+        return stat.S_ISSOCK(os.lstat(path).st_mode)
+    except OSError:
+        return False
+
+
+def remove(path):
+    """Removes a socket, ignoring one that is already gone."""
+    try:
+        os.unlink(path)
+    except OSError:
+        _, e, _ = sys.exc_info()
+        if e.errno != ENOENT:
+            raise
+
+
+def close_masters(paths):
+    """Asks the masters on the given sockets to stop, all in parallel.
+
+    Each master removes its socket right away, but it keeps serving the
+    sessions it already has, and exits when the last one ends.
+    """
+    procs = []
+    devnull = open(os.devnull, 'r+')
+    try:
+        for path in paths:
+            # ssh needs a destination, but only the socket is used.
+            cmd = ['ssh', '-o', 'ControlPath=%s' % path, '-O', 'stop',
+                    'pssh-control']
+            try:
+                procs.append(subprocess.Popen(cmd, stdin=devnull,
+                    stdout=devnull, stderr=devnull, close_fds=True))
+            except OSError:
+                pass
+        for proc in procs:
+            proc.wait()
+    finally:
+        devnull.close()
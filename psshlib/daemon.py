@@ -0,0 +1,306 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""A long-running pssh that takes jobs over a UNIX domain socket.
+
+Each run of pssh pays for starting Python, parsing the host files, and
+connecting to every host.  The Daemon (started with pssh-daemon) pays for
+these once: it keeps the parsed host files (rereading one only when it
+changes) and a ControlPool of ssh masters, and runs the jobs sent by
+pssh-client in one asyncio event loop, several at a time.
+
+The protocol is JSON Lines over the socket.  The client sends one request:
+
+    {"command": "uptime", "host_files": ["/etc/pssh/web"], "hosts": ["db1"],
+     "par": 32, "timeout": 60, "capture": 4096}
+
+Besides command, host_files (absolute paths), and hosts ("[user@]host[:port]"
+entries), a request may give any of the options in JOB_OPTIONS.  The daemon
+answers with the JSON record of each host as it finishes (see
+psshlib.jsonsink), and then with {"done": true, "hosts": N, "failures": F},
+or with {"error": MESSAGE} if the request is invalid.  If the client hangs
+up, its job is interrupted.
+
+Input for the hosts is streamed the same way: a request with "stdin": true
+is followed by frames of the form {"stdin": BASE64}, as the client reads its
+input, and then by {"done": true}.  The frames are fed to an InputStream, so
+the daemon holds no more of the input than pssh -I would, and a slow host
+slows down the client rather than filling the daemon's memory.  (A base64
+string in place of true is taken as the whole input.)
+
+The socket is created in a directory that only its owner can use, as for
+the PasswordServer.
+"""
+
+import asyncio
+import base64
+from errno import EAGAIN, ENOENT
+import json
+import os
+import re
+import signal
+import sys
+import traceback
+
+from psshlib.aio import AsyncManager
+from psshlib.api import Options, make_tasks
+from psshlib import controlpool
+from psshlib.instream import InputStream
+from psshlib.jsonsink import dumps, make_record
+from psshlib import linefilter
+from psshlib import psshutil
+
+DEFAULT_CONTROL_DIR = os.path.join('~', '.pssh', 'control')
+
+# The options that a request may set, with their types (list means a list
+# of strings).
+JOB_OPTIONS = {'user': str, 'par': int, 'timeout': int, 'options': str,
+        'extra': list, 'verbose': bool, 'outdir': str, 'errdir': str,
+        'capture': int, 'include': list, 'exclude': list}
+
+_TYPE_NAMES = {str: 'a string', int: 'an integer', bool: 'true or false',
+        list: 'a list of strings'}
+
+# Seconds between applications of the ControlPool's expiry policy.
+EXPIRE_INTERVAL = 60
+
+# The most bytes of input in a frame.  Once base64-encoded, a frame must fit
+# in a line of an asyncio stream (64 KiB by default).
+INPUT_FRAME_SIZE = 1 << 15
+
+
+class Inventory(object):
+    """Caches the hosts of each host file until the file changes."""
+    def __init__(self):
+        # (stamp, hosts) by (pathname, default_user).
+        self.files = {}
+
+    def hosts(self, pathname, default_user=None):
+        """Returns a list of (host, port, user) for a host file."""
+        st = os.stat(pathname)
+        stamp = (st.st_mtime, st.st_size, st.st_ino)
+        key = (pathname, default_user)
+        entry = self.files.get(key)
+        if entry is None or entry[0] != stamp:
+            hosts = psshutil.read_hosts([pathname], default_user)
+            entry = self.files[key] = (stamp, hosts)
+        return entry[1]
+
+
+class Daemon(object):
+    """Accepts jobs on a UNIX domain socket and runs them.
+
+    Arguments:
+        address: Path of the socket.
+        pool: A ControlPool for all of the jobs' connections, or None.
+    """
+    def __init__(self, address, pool=None):
+        self.address = address
+        self.pool = pool
+        self.inventory = Inventory()
+        self.jobs = 0
+
+    def run(self):
+        """Serves jobs until interrupted or terminated."""
+        try:
+            asyncio.run(self.serve())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+
+    async def serve(self):
+        # Stop cleanly, removing the socket, on SIGTERM too.
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM,
+                asyncio.current_task().cancel)
+        directory = os.path.dirname(self.address)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 448) # 0700
+        if os.path.exists(self.address):
+            if controlpool.is_alive(self.address):
+                raise RuntimeError('A daemon is already listening on %s'
+                        % self.address)
+            controlpool.remove(self.address)
+        umask = os.umask(63) # 077
+        try:
+            server = await asyncio.start_unix_server(self.handle,
+                    path=self.address)
+        finally:
+            os.umask(umask)
+        try:
+            async with server:
+                while True:
+                    await asyncio.sleep(EXPIRE_INTERVAL)
+                    if self.pool:
+                        await asyncio.get_running_loop().run_in_executor(
+                                None, self.pool.expire)
+        finally:
+            try:
+                os.unlink(self.address)
+            except OSError:
+                _, e, _ = sys.exc_info()
+                if e.errno != ENOENT:
+                    raise
+
+    def job(self, request):
+        """Returns (opts, hosts, command, stdin) for a request.
+
+        The stdin is True if the input follows in frames.  Raises ValueError
+        if the request is invalid.
+        """
+        if not isinstance(request, dict):
+            raise ValueError('The request must be a JSON object.')
+        command = request.get('command')
+        if not command:
+            raise ValueError('Command not specified.')
+        check_type('command', command, str)
+        opts = Options()
+        for name, kind in JOB_OPTIONS.items():
+            value = request.get(name)
+            if value is not None:
+                check_type(name, value, kind)
+                setattr(opts, name, value)
+        if opts.par <= 0:
+            raise ValueError('The parallelism must be a positive number.')
+        try:
+            linefilter.from_opts(opts)
+        except re.error:
+            _, e, _ = sys.exc_info()
+            raise ValueError('Invalid regular expression: %s' % e)
+        for name in ('host_files', 'hosts'):
+            if request.get(name) is not None:
+                check_type(name, request[name], list)
+        hosts = []
+        try:
+            for pathname in request.get('host_files') or ():
+                hosts.extend(self.inventory.hosts(pathname, opts.user))
+        except (OSError, IOError):
+            _, e, _ = sys.exc_info()
+            raise ValueError('Could not read host file %s: %s'
+                    % (e.filename, e.strerror))
+        for entry in request.get('hosts') or ():
+            hosts.append(psshutil.parse_host(entry, default_user=opts.user))
+        if not hosts:
+            raise ValueError('Hosts not specified.')
+        stdin = request.get('stdin')
+        if stdin and stdin is not True:
+            stdin = base64.b64decode(stdin)
+        for directory in (opts.outdir, opts.errdir):
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+        return opts, hosts, command, stdin
+
+    async def handle(self, reader, writer):
+        """Runs the job of one client, sending it the results."""
+        watcher = None
+        inputfd = None
+        try:
+            line = await reader.readline()
+            try:
+                opts, hosts, command, stdin = self.job(json.loads(line))
+            except (ValueError, TypeError, OSError):
+                _, e, _ = sys.exc_info()
+                writer.write(dumps({'error': str(e)}))
+                await writer.drain()
+                return
+            self.jobs += 1
+
+            if stdin is True:
+                inputfd, pipefd = os.pipe()
+                os.set_blocking(pipefd, False)
+                stdin = InputStream(inputfd)
+            else:
+                pipefd = None
+            # The watcher ends when the client hangs up (or sends a broken
+            # frame), and interrupts the job.
+            job = asyncio.current_task()
+            watcher = asyncio.ensure_future(self.watch(reader, pipefd))
+            watcher.add_done_callback(
+                    lambda future: future.cancelled() or job.cancel())
+
+            manager = AsyncManager(opts)
+            manager.add_tasks(make_tasks(hosts, command, opts, stdin,
+                self.pool))
+            count = failures = 0
+            results = manager.results()
+            try:
+                async for result in results:
+                    count += 1
+                    if result.failures:
+                        failures += 1
+                    writer.write(dumps(make_record(result)))
+                    await writer.drain()
+            finally:
+                await results.aclose()
+            watcher.cancel()
+            writer.write(dumps({'done': True, 'hosts': count,
+                'failures': failures}))
+            await writer.drain()
+        except (asyncio.CancelledError, ConnectionError):
+            # The client hung up.
+            pass
+        except Exception:
+            # Tell the client, rather than leaving it without a done record.
+            _, e, _ = sys.exc_info()
+            traceback.print_exc()
+            try:
+                writer.write(dumps({'error': 'Internal error: %s' % e}))
+                await writer.drain()
+            except ConnectionError:
+                pass
+        finally:
+            if watcher:
+                watcher.cancel()
+            if inputfd is not None:
+                os.close(inputfd)
+            writer.close()
+
+    async def watch(self, reader, pipefd=None):
+        """Copies any input frames to pipefd, then waits for a hang-up.
+
+        The pipefd is closed once the input ends.
+        """
+        if pipefd is not None:
+            try:
+                while True:
+                    frame = json.loads(await reader.readline())
+                    if frame.get('done'):
+                        break
+                    await write_all(pipefd, base64.b64decode(frame['stdin']))
+            except (ValueError, TypeError, KeyError, AttributeError, OSError):
+                # The client hung up, or sent something that isn't a frame.
+                return
+            finally:
+                os.close(pipefd)
+        # Nothing more is read, so a read ends when the client hangs up.
+        await reader.read()
+
+
+def check_type(name, value, kind):
+    """Raises ValueError unless the value of a request field has the type."""
+    if kind is int:
+        valid = isinstance(value, int) and not isinstance(value, bool)
+    elif kind is list:
+        valid = (isinstance(value, list)
+                and all([isinstance(item, str) for item in value]))
+    else:
+        valid = isinstance(value, kind)
+    if not valid:
+        raise ValueError('The %s option must be %s.'
+                % (name, _TYPE_NAMES[kind]))
+
+
+async def write_all(fd, data):
+    """Writes all of data to a non-blocking file descriptor."""
+    loop = asyncio.get_running_loop()
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(fd, view):]
+        except (OSError, IOError):
+            _, e, _ = sys.exc_info()
+            if e.errno != EAGAIN:
+                raise
+            writable = loop.create_future()
+            loop.add_writer(fd, writable.set_result, None)
+            try:
+                await writable
+            finally:
+                loop.remove_writer(fd)
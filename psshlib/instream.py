@@ -0,0 +1,315 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""Fan-out of a single input stream to the standard input of many tasks.
+
+An InputStream reads from one file descriptor into fixed-size chunks.  Each
+task gets an InputReader with its own offset, and writes straight from the
+shared chunks through memoryviews, so no per-host copies are made.
+
+Chunks that every reader has passed are recycled, and reading from the
+source pauses while capacity bytes are buffered ahead of the slowest reader,
+so the slowest host applies backpressure and memory stays constant no matter
+how large the input is.  While more readers may still be added (for example,
+when there are more hosts than the -p limit), everything read is also
+appended to a temporary spill file, from which late readers catch up.  Once
+the stream is sealed and no reader is left behind the chunks in memory, the
+spill file is closed.
+"""
+
+from errno import EAGAIN, EINTR
+import os
+import stat
+import sys
+import tempfile
+
+CHUNK_SIZE = 1 << 16
+DEFAULT_CAPACITY = 1 << 24
+
+
+class InputStream(object):
+    """Shares the data read from a file descriptor among many readers.
+
+    Arguments:
+        fd: File descriptor to read from (None for a stream created by
+            from_bytes).
+        capacity: Bytes to buffer ahead of the slowest reader.
+    """
+    def __init__(self, fd, capacity=DEFAULT_CAPACITY):
+        self.fd = fd
+        self.capacity = max(capacity, CHUNK_SIZE)
+        # Chunk i holds the data at offsets starting from
+        # (self.base + i) * CHUNK_SIZE.
+        self.chunks = []
+        self.base = 0
+        self.size = 0
+        self.eof = False
+        self.sealed = False
+        # Number of readers whose offset is in each chunk, by chunk number.
+        self.positions = {}
+        self.readers = 0
+        # The spill file (see the module docstring), the number of bytes in
+        # it, and the number of readers behind the chunks in memory.
+        self.spill = None
+        self.spilled = 0
+        self.spill_failed = False
+        self.lagging = 0
+        self.waiting = []
+        self.spare = []
+        self.iomap = None
+        self.registered = False
+
+        if fd is None:
+            self.pollable = False
+        else:
+            mode = os.fstat(fd).st_mode
+            # Regular files and devices like /dev/null are always readable,
+            # and epoll rejects them, so they are read on demand instead.
+            self.pollable = (stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)
+                    or os.isatty(fd))
+
+    def from_bytes(cls, data):
+        """Creates a complete stream that serves the given data."""
+        stream = cls(None)
+        view = memoryview(data)
+        stream.chunks = [view[i:i + CHUNK_SIZE]
+                for i in range(0, len(data), CHUNK_SIZE)]
+        stream.size = len(data)
+        stream.eof = True
+        return stream
+    from_bytes = classmethod(from_bytes)
+
+    def reader(self, iomap):
+        """Creates a reader that starts at the beginning of the stream."""
+        if self.base and self.spill is None:
+            raise ValueError('InputStream is sealed and has discarded data')
+        if self.iomap is None:
+            self.iomap = iomap
+        if self.base:
+            # It starts out in the spill file.
+            self.lagging += 1
+        reader = InputReader(self)
+        self._schedule_read()
+        return reader
+
+    def seal(self):
+        """Declares that no more readers will be created.
+
+        From now on, data that all readers have passed is discarded.
+        """
+        if not self.sealed:
+            self.sealed = True
+            self._release()
+            self._close_spill()
+            self._schedule_read()
+
+    def _buffered(self):
+        return self.size - self.base * CHUNK_SIZE
+
+    def _want_read(self):
+        """Finds whether more data should be read from the source."""
+        if self.eof:
+            return False
+        if self.spill_failed and self._spilling():
+            # Everything has to stay in memory.
+            return True
+        return self.readers > 0 and self._buffered() < self.capacity
+
+    def _spilling(self):
+        """Finds whether data must be in the spill file to be recycled."""
+        return not self.sealed or self.lagging > 0
+
+    def _spill(self, data):
+        """Appends data, just read from the source, to the spill file."""
+        if self.spill_failed:
+            return
+        try:
+            if self.spill is None:
+                self.spill = tempfile.TemporaryFile(prefix='pssh.')
+            fd = self.spill.fileno()
+            while data:
+                data = data[os.write(fd, data):]
+        except (OSError, IOError):
+            # Without the spill file, chunks are kept until the stream is
+            # sealed, as before.
+            self.spill_failed = True
+            return
+        self.spilled = self.size
+
+    def _read_spill(self, offset, count):
+        """Returns up to count bytes at offset from the spill file."""
+        fd = self.spill.fileno()
+        if hasattr(os, 'pread'):
+            return os.pread(fd, count, offset)
+        position = os.lseek(fd, 0, os.SEEK_CUR)
+        os.lseek(fd, offset, os.SEEK_SET)
+        try:
+            return os.read(fd, count)
+        finally:
+            os.lseek(fd, position, os.SEEK_SET)
+
+    def _close_spill(self):
+        """Closes the spill file once no reader can need it again."""
+        if self.spill is not None and not self._spilling():
+            self.spill.close()
+            self.spill = None
+
+    def _schedule_read(self):
+        """Registers or unregisters the source with the IOMap as needed."""
+        if not self.pollable or self.iomap is None:
+            return
+        want = self._want_read()
+        if want and not self.registered:
+            self.iomap.register_read(self.fd, self.handle_read)
+            self.registered = True
+        elif not want and self.registered:
+            self.iomap.unregister(self.fd)
+            self.registered = False
+
+    def handle_read(self, fd, iomap):
+        """Called when the source is ready for reading."""
+        self._read()
+        self._schedule_read()
+
+    def _read(self):
+        """Reads up to one chunk from the source and wakes waiting readers."""
+        offset = self.size % CHUNK_SIZE
+        if offset == 0:
+            if self.spare:
+                chunk = self.spare.pop()
+            else:
+                chunk = bytearray(CHUNK_SIZE)
+            self.chunks.append(chunk)
+        chunk = self.chunks[-1]
+        try:
+            if hasattr(os, 'readv'):
+                count = os.readv(self.fd, [memoryview(chunk)[offset:]])
+            else:
+                data = os.read(self.fd, CHUNK_SIZE - offset)
+                chunk[offset:offset + len(data)] = data
+                count = len(data)
+        except (OSError, IOError):
+            _, e, _ = sys.exc_info()
+            if offset == 0:
+                self.spare.append(self.chunks.pop())
+            if e.errno in (EINTR, EAGAIN):
+                return
+            # Treat a read error like the end of input.
+            count = 0
+        if count:
+            self.size += count
+            if self._spilling():
+                self._spill(memoryview(chunk)[offset:offset + count])
+        else:
+            self.eof = True
+            if offset == 0:
+                self.spare.append(self.chunks.pop())
+        self._wake()
+
+    def _wake(self):
+        """Calls the callbacks of all waiting readers."""
+        waiting = self.waiting
+        self.waiting = []
+        for reader, callback in waiting:
+            callback()
+
+    def _view(self, offset):
+        """Returns a memoryview of the data at offset, or None if none yet."""
+        if offset < self.base * CHUNK_SIZE:
+            # A late reader catching up through the spill file.
+            end = min((offset // CHUNK_SIZE + 1) * CHUNK_SIZE, self.spilled)
+            return memoryview(self._read_spill(offset, end - offset))
+        if offset >= self.size and not self.pollable and self._want_read():
+            self._read()
+        if offset >= self.size:
+            return None
+        index = offset // CHUNK_SIZE
+        start = offset - index * CHUNK_SIZE
+        end = min(CHUNK_SIZE, self.size - index * CHUNK_SIZE)
+        return memoryview(self.chunks[index - self.base])[start:end]
+
+    def _move(self, old, new):
+        """Updates the position counts when a reader moves."""
+        old_index = old // CHUNK_SIZE
+        new_index = new // CHUNK_SIZE
+        if old_index == new_index:
+            return
+        self.positions[new_index] = self.positions.get(new_index, 0) + 1
+        if old_index < self.base <= new_index:
+            # A late reader has caught up with the chunks in memory.
+            self.lagging -= 1
+            self._close_spill()
+        self._leave(old_index)
+
+    def _leave(self, index):
+        count = self.positions[index] - 1
+        if count:
+            self.positions[index] = count
+        else:
+            del self.positions[index]
+            if index == self.base:
+                self._release()
+
+    def _release(self):
+        """Recycles leading chunks that no reader in memory still needs."""
+        released = False
+        while self.chunks and (self.base + 1) * CHUNK_SIZE <= self.size:
+            if self.positions.get(self.base):
+                break
+            if (self._spilling()
+                    and (self.base + 1) * CHUNK_SIZE > self.spilled):
+                # A late reader may still need it.
+                break
+            chunk = self.chunks.pop(0)
+            if isinstance(chunk, bytearray):
+                self.spare.append(chunk)
+            self.base += 1
+            released = True
+        if released:
+            self._schedule_read()
+            if not self.pollable:
+                # On-demand sources are read when a reader asks for data,
+                # so let the waiting readers ask again.
+                self._wake()
+
+
+class InputReader(object):
+    """One task's position in an InputStream."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.offset = 0
+        stream.readers += 1
+        stream.positions[0] = stream.positions.get(0, 0) + 1
+
+    def peek(self):
+        """Returns a memoryview of the next available data, or None."""
+        return self.stream._view(self.offset)
+
+    def advance(self, count):
+        """Marks count bytes as consumed."""
+        old = self.offset
+        self.offset += count
+        self.stream._move(old, self.offset)
+
+    def at_eof(self):
+        """Finds whether every byte of the stream has been consumed."""
+        return self.stream.eof and self.offset >= self.stream.size
+
+    def wait(self, callback):
+        """Calls callback once more data (or the end of input) arrives."""
+        self.stream.waiting.append((self, callback))
+
+    def close(self):
+        """Stops reading, so that this reader no longer holds back data."""
+        stream = self.stream
+        if stream is None:
+            return
+        self.stream = None
+        stream.waiting = [entry for entry in stream.waiting
+                if entry[0] is not self]
+        stream.readers -= 1
+        index = self.offset // CHUNK_SIZE
+        if index < stream.base:
+            stream.lagging -= 1
+            stream._close_spill()
+        stream._leave(index)
+        stream._schedule_read()
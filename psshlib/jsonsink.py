@@ -0,0 +1,94 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""Machine-readable results, one JSON record per host (--json).
+
+Each record is written and flushed as soon as its host finishes, as one
+line of JSON (the "JSON Lines" format), so other programs can follow the run
+without parsing the status lines of Task.report.  A record looks like:
+
+    {"host": "web1", "port": null, "user": null, "exit": 0, "failures": [],
+     "start": 1262304000.25, "end": 1262304001.5, "stdout_bytes": 12,
+     "stderr_bytes": 0}
+
+With an output limit (--json-output, which sets the capture option of the
+Tasks), the first bytes of stdout and stderr are included too,
+base64-encoded, as "stdout" and "stderr", with "stdout_truncated" and
+"stderr_truncated" telling whether anything was cut.
+Records may also have "matches" (with --include or --exclude), and "outfile"
+and "errfile" (with -o or -e).
+"""
+
+import base64
+import json
+import sys
+
+
+class JsonSink(object):
+    """Writes a JSON record for each finished host to a binary stream.
+
+    If path is "-", the records go to standard output.
+    """
+    def __init__(self, path):
+        self.path = path
+        if path == '-':
+            self.to_stdout = True
+            try:
+                self.stream = sys.stdout.buffer
+            except AttributeError:
+                self.stream = sys.stdout
+        else:
+            self.to_stdout = False
+            self.stream = open(path, 'wb')
+        self.records = 0
+
+    def add(self, result):
+        """Writes the record for a Result."""
+        self.stream.write(dumps(make_record(result)))
+        self.stream.flush()
+        self.records += 1
+
+    def close(self):
+        if self.to_stdout:
+            self.stream.flush()
+        else:
+            self.stream.close()
+
+
+def make_record(result):
+    """Returns the record (a dict) for a Result."""
+    record = {
+        'host': result.host,
+        'port': result.port,
+        'user': result.user,
+        'exit': result.returncode,
+        'failures': list(result.failures),
+        'start': result.starttime,
+        'end': result.endtime,
+        'stdout_bytes': result.outbytes,
+        'stderr_bytes': result.errbytes,
+    }
+    if result.matches is not None:
+        record['matches'] = result.matches
+    # With a store, the files are (name, stream) handles, not paths.
+    if isinstance(result.outfile, str):
+        record['outfile'] = result.outfile
+    if isinstance(result.errfile, str):
+        record['errfile'] = result.errfile
+    if result.stdout is not None:
+        record['stdout'] = encode(result.stdout)
+        record['stdout_truncated'] = result.stdout_truncated
+    if result.stderr is not None:
+        record['stderr'] = encode(result.stderr)
+        record['stderr_truncated'] = result.stderr_truncated
+    return record
+
+
+def dumps(record):
+    """Returns a record as a line of JSON, in UTF-8 bytes."""
+    line = json.dumps(record, separators=(', ', ': ')) + '\n'
+    return line.encode('utf-8')
+
+
+def encode(data):
+    """Returns bytes as a base64 string."""
+    return base64.b64encode(data).decode('ascii')
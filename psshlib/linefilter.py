@@ -0,0 +1,79 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""Filtering of output lines by regular expression (--include/--exclude).
+
+Tasks filter each stream as it is read, before the output is buffered,
+written, or printed, so the memory and disk used grow with the number of
+matching lines rather than with the total output.
+"""
+
+import re
+
+from psshlib.psshutil import LineSplitter
+
+
+class LineFilter(object):
+    """Decides which lines to keep.
+
+    A line is kept if it matches any of the include patterns (or if there
+    are none) and none of the exclude patterns.  Patterns are strings, which
+    are matched against the UTF-8 bytes of each line.
+    """
+    def __init__(self, include=None, exclude=None):
+        self.include = [compile_pattern(p) for p in include or ()]
+        self.exclude = [compile_pattern(p) for p in exclude or ()]
+
+    def keep(self, line):
+        """Finds whether a line (as bytes) should be kept."""
+        if self.include:
+            for pattern in self.include:
+                if pattern.search(line):
+                    break
+            else:
+                return False
+        for pattern in self.exclude:
+            if pattern.search(line):
+                return False
+        return True
+
+
+def compile_pattern(pattern):
+    """Compiles a pattern string for matching bytes.
+
+    Raises re.error if the pattern is invalid.
+    """
+    if not isinstance(pattern, bytes):
+        pattern = pattern.encode('utf-8')
+    return re.compile(pattern)
+
+
+def from_opts(opts):
+    """Returns a LineFilter for the include and exclude options, or None."""
+    include = getattr(opts, 'include', None)
+    exclude = getattr(opts, 'exclude', None)
+    if not include and not exclude:
+        return None
+    return LineFilter(include, exclude)
+
+
+class StreamFilter(object):
+    """Filters one stream, which may split lines across chunks."""
+    def __init__(self, linefilter):
+        self.linefilter = linefilter
+        self.splitter = LineSplitter()
+        self.matches = 0
+
+    def feed(self, data):
+        """Returns the kept lines completed by data, joined together."""
+        keep = self.linefilter.keep
+        kept = [line for line in self.splitter.split(data) if keep(line)]
+        self.matches += len(kept)
+        return bytes().join(kept)
+
+    def finish(self):
+        """Returns the final partial line if it is kept, or empty bytes."""
+        rest = self.splitter.rest()
+        if rest and self.linefilter.keep(rest):
+            self.matches += 1
+            return rest
+        return bytes()
@@ -1,73 +1,158 @@
 # Copyright (c) 2009, Andrew McNabb
 
-from errno import EINTR
+from collections import deque, OrderedDict
+from errno import EAGAIN, ECHILD, EINTR
+import heapq
+import io
 import os
-import select
 import signal
 import sys
 import threading
+import time
 
 try:
     import queue
 except ImportError:
     import Queue as queue
 
-from psshlib.askpass_server import PasswordServer
+from psshlib import askpass_server
+from psshlib.coalesce import Coalescer
+from psshlib.jsonsink import JsonSink
+from psshlib import compress
+from psshlib.outstore import StoreWriter, STDOUT, STDERR
+from psshlib.printer import Printer
+from psshlib.reduce import get_reducer
+from psshlib.reorder import ReorderBuffer
 from psshlib import psshutil
+from psshlib.task import base_environ, splice_enabled, DEFAULT_MAX_OPEN_FILES
+from psshlib.poller import default_poller, POLL_READ, POLL_WRITE
 
 READ_SIZE = 1 << 16
 
+# Each running task needs up to three pipes and a pidfd (and two output files
+# when it splices, or the two ends of a pty with --askpass-mode=pty), the
+# Writer keeps up to max_open_files output files open, and the PasswordServer
+# and standard streams need a few more.
+FDS_PER_TASK = 4
+FDS_PER_SPLICE = 2
+FDS_PER_TTY = 2
+FDS_RESERVED = 64
+
+# Where available (Python 3.9 and Linux 5.3), each child gets a pidfd, which
+# becomes readable when the child exits.
+HAVE_PIDFD = hasattr(os, 'pidfd_open')
+
+# The longest a poll waits when neither a pidfd nor SIGCHLD would end it as a
+# child exits (outside the main thread without pidfds).
+REAP_INTERVAL = 0.05
+
+# The Managers whose SIGCHLD handler is installed and the IOMaps that set the
+# signal wakeup fd, most recent last, with the handler and the wakeup fd that
+# were in place before the first of each.
+_sigchld_managers = []
+_sigchld_previous = None
+_wakeup_owners = []
+_wakeup_previous = -1
+
 
 class Manager(object):
     """Executes tasks concurrently.
 
-    Tasks are added with add_task() and executed in parallel with run().
+    Tasks are added with add_task() or add_tasks() and executed in parallel
+    with run().  If callback is set, it is called with the Result of each
+    task as it finishes.  With the quiet option, no status lines are printed.
 
     Arguments:
         limit: Maximum number of commands running at once.
         timeout: Maximum allowed execution time in seconds.
     """
-    def __init__(self, opts):
+    def __init__(self, opts, iomap=None):
         self.limit = opts.par
         self.timeout = opts.timeout
         self.askpass = opts.askpass
+        # How the password gets to ssh: through the pssh-askpass program
+        # ("program") or typed at the prompt on a pty for each ssh ("pty").
+        self.askpass_mode = getattr(opts, 'askpass_mode', None) or 'program'
         self.outdir = opts.outdir
         self.errdir = opts.errdir
-        self.iomap = IOMap()
+        self.store = getattr(opts, 'store', None)
+        self.codec = getattr(opts, 'compress_output', None)
+        if self.codec:
+            self.codec = compress.get_codec(self.codec)
+        self.verbose = opts.verbose
+        self.writer_threads = getattr(opts, 'writer_threads', None) or 1
+        self.max_open_files = (getattr(opts, 'max_open_files', None)
+                or DEFAULT_MAX_OPEN_FILES)
+        self.splice = splice_enabled(opts)
+        if iomap is None:
+            iomap = IOMap()
+        self.iomap = iomap
+        if getattr(opts, 'print_out', False):
+            self.printer = Printer(sys.stdout.fileno(), self.iomap)
+        else:
+            self.printer = None
+        if getattr(opts, 'ordered', False):
+            try:
+                stdout = sys.stdout.buffer
+            except AttributeError:
+                stdout = sys.stdout
+            self.reorder = ReorderBuffer(stdout)
+        else:
+            self.reorder = None
+        self.reducer_spec = getattr(opts, 'reduce', None)
+        if self.reducer_spec:
+            self.reducer = get_reducer(self.reducer_spec)
+        else:
+            self.reducer = None
+        if getattr(opts, 'coalesce', False):
+            self.coalescer = Coalescer()
+        else:
+            self.coalescer = None
+        json_path = getattr(opts, 'json', None)
+        if json_path:
+            self.jsonsink = JsonSink(json_path)
+        else:
+            self.jsonsink = None
+        # JSON records on stdout take the place of the status lines.
+        self.quiet = bool(getattr(opts, 'quiet', False)
+                or (self.jsonsink and self.jsonsink.to_stdout))
+        self.callback = None
 
         self.taskcount = 0
-        self.tasks = []
-        self.running = []
+        self.tasks = deque()
+        # Iterators of Tasks that are consumed as slots become free.
+        self.sources = deque()
+        # Started tasks that haven't finished, keyed by pid.
+        self.running = {}
+        # Tasks whose process was reaped but whose pipes are still open.
+        self.exited = []
+        # Running tasks by the pidfd of their process, and the pids of those
+        # without a pidfd, which are checked with waitpid after each poll.
+        self.pidfds = {}
+        self.unwatched = set()
+        # Whether this Manager's SIGCHLD handler is installed.
+        self.sigchld = False
+        # Result records of finished tasks.
         self.done = []
+        # Min-heap of (deadline, taskcount, task) for running tasks.  Entries
+        # for finished tasks are discarded lazily.
+        self.deadlines = []
+        # Whether all tasks have started, so that inputs can be sealed.
+        self.sealed = False
 
         self.askpass_socket = None
+        self.pass_server = None
+        self.password = None
+        self.environ = None
+        self.writer = None
 
     def run(self):
         """Processes tasks previously added with add_task."""
         try:
-            if self.outdir or self.errdir:
-                writer = Writer(self.outdir, self.errdir)
-                writer.start()
-            else:
-                writer = None
-
-            if self.askpass:
-                pass_server = PasswordServer()
-                pass_server.start(self.iomap, self.limit)
-                self.askpass_socket = pass_server.address
-
-            self.set_sigchld_handler()
-
+            self.start()
             try:
-                self.update_tasks(writer)
-                wait = None
-                while self.running or self.tasks:
-                    # Opt for efficiency over subsecond timeout accuracy.
-                    if wait is None or wait < 1:
-                        wait = 1
-                    self.iomap.poll(wait)
-                    self.update_tasks(writer)
-                    wait = self.check_timeout()
+                while self.step():
+                    pass
             except KeyboardInterrupt:
                 # This exception handler tries to clean things up and prints
                 # out a nice status message for each interrupted host.
@@ -78,140 +163,535 @@ class Manager(object):
             # information--it just stops.
             pass
 
+        self.finish()
+
+    def start(self):
+        """Prepares to process tasks and starts the first ones.
+
+        Together with step() and finish(), this lets a caller drive the
+        Manager one iteration at a time instead of calling run().
+        """
+        self.prepare()
+        if not HAVE_PIDFD:
+            self.set_sigchld_handler()
+        self.update_tasks(self.writer)
+
+    def prepare(self):
+        """Raises the fd limit and sets up the Writer and PasswordServer."""
+        per_task = FDS_PER_TASK
+        if self.splice:
+            per_task += FDS_PER_SPLICE
+        if self.askpass and self.askpass_mode == 'pty':
+            per_task += FDS_PER_TTY
+        psshutil.raise_fd_limit(per_task * self.limit
+                + self.max_open_files + FDS_RESERVED)
+        if self.store:
+            self.writer = Writer(None, None, store=StoreWriter(self.store))
+            self.writer.start()
+        elif self.outdir or self.errdir:
+            self.writer = Writer(self.outdir, self.errdir,
+                    self.writer_threads, self.max_open_files,
+                    codec=self.codec)
+            self.writer.start()
+
+        if self.askpass and self.askpass_mode == 'pty':
+            # No askpass process is started for each host: each Task types
+            # the password at ssh's prompt.
+            password = askpass_server.prompt_password()
+            if not isinstance(password, bytes):
+                password = password.encode('utf-8')
+            self.password = password
+        elif self.askpass:
+            self.pass_server = askpass_server.PasswordServer()
+            self.pass_server.start(self.iomap, self.limit)
+            self.askpass_socket = self.pass_server.address
+
+        self.environ = base_environ(self.askpass_socket)
+
+    def step(self, timeout=None):
+        """Waits for and handles events once, starting and finishing tasks.
+
+        The wait ends at the next task deadline, or after timeout seconds if
+        that comes first.  Returns whether any tasks are still running or
+        waiting to start.
+        """
+        if not (self.running or self.pending()):
+            return False
+        wait = self.check_timeout()
+        if timeout is not None and (wait is None or wait > timeout):
+            wait = timeout
+        if self.unwatched and not (self.sigchld and self.iomap.owns_wakeup()):
+            # Nothing ends the poll when a child exits.
+            if wait is None or wait > REAP_INTERVAL:
+                wait = REAP_INTERVAL
+        self.iomap.poll(wait)
+        self.update_tasks(self.writer)
+        if self.printer:
+            self.printer.flush()
+        return bool(self.running or self.pending())
+
+    def cancel(self):
+        """Stops the run early.
+
+        Tasks that have not started are cancelled and finished right away.
+        Running tasks are killed and finish, as usual, once step() finds that
+        their processes have exited.  This must be called from the thread
+        that drives the Manager, such as from a callback.
+        """
+        self.cancel_pending()
+        for task in self.running.values():
+            task.cancel()
+
+    def finish(self):
+        """Prints any final reports and releases the Manager's resources."""
+        if self.printer:
+            self.printer.drain()
+        if self.reorder:
+            self.reorder.finish()
+        if self.coalescer:
+            sys.stdout.flush()
+            try:
+                self.coalescer.report(sys.stdout.buffer)
+            except AttributeError:
+                self.coalescer.report(sys.stdout)
+            self.coalescer.close()
+        if self.reducer:
+            sys.stdout.write('Reduce %s: %s\n' % (self.reducer_spec,
+                self.reducer.result()))
+            sys.stdout.flush()
+        if self.jsonsink:
+            self.jsonsink.close()
+        writer = self.writer
         if writer:
             writer.signal_quit()
             writer.join()
+            if self.verbose:
+                stats = writer.stats()
+                sys.stderr.write('Writer: %(bytes)s bytes (%(written)s '
+                        'written) in %(writes)s writes and %(batches)s '
+                        'batches from %(requests)s requests; max queue depth '
+                        '%(max_queue_depth)s; %(reopens)s reopens; '
+                        '%(threads)s threads\n' % stats)
+            self.writer = None
+        self.pass_server = None
+        self.password = None
+        self.release_children()
+        self.restore_sigchld_handler()
+        self.iomap.close()
 
-    def clear_sigchld_handler(self):
-        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    def release_children(self):
+        """Closes the pidfds and reaps the processes killed by cancel()."""
+        for fd, task in self.pidfds.items():
+            self.iomap.unregister(fd)
+            os.close(fd)
+            if task.killed:
+                wait_child(task.pid, 0)
+        for pid in self.unwatched:
+            if self.running[pid].killed:
+                wait_child(pid, 0)
+        self.pidfds = {}
+        self.unwatched = set()
 
     def set_sigchld_handler(self):
-        # TODO: find out whether set_wakeup_fd still works if the default
-        # signal handler is used (I'm pretty sure it doesn't work if the
-        # signal is ignored).
-        signal.signal(signal.SIGCHLD, self.handle_sigchld)
+        """Installs a SIGCHLD handler so that exits end the poll.
+
+        This is only needed for tasks without a pidfd.  The previous handler
+        is put back by restore_sigchld_handler().
+        """
+        global _sigchld_previous
+        try:
+            previous = signal.signal(signal.SIGCHLD, self.handle_sigchld)
+        except ValueError:
+            # Only the main thread can handle signals.  Other threads poll
+            # with a timeout of at most REAP_INTERVAL instead.
+            return
+        if not _sigchld_managers:
+            _sigchld_previous = previous
+        _sigchld_managers.append(self)
+        self.sigchld = True
+
+    def restore_sigchld_handler(self):
+        """Puts back the SIGCHLD handler that was replaced, if any."""
+        if not self.sigchld:
+            return
+        self.sigchld = False
+        latest = _sigchld_managers[-1] is self
+        _sigchld_managers.remove(self)
+        if not latest:
+            # A later Manager's handler is in place.
+            return
+        if _sigchld_managers:
+            handler = _sigchld_managers[-1].handle_sigchld
+        elif _sigchld_previous is None:
+            # The previous handler was not installed from Python.
+            handler = signal.SIG_DFL
+        else:
+            handler = _sigchld_previous
+        try:
+            signal.signal(signal.SIGCHLD, handler)
+        except ValueError:
+            pass
 
     def handle_sigchld(self, number, frame):
-        """Apparently we need a sigchld handler to make set_wakeup_fd work."""
+        """Apparently we need a sigchld handler to make set_wakeup_fd work.
+
+        Children are collected by reap_tasks, which runs after every poll.
+        """
         # Write to the signal pipe (only for Python <2.5, where the
         # set_wakeup_fd method doesn't exist).
         if self.iomap.wakeup_writefd:
             os.write(self.iomap.wakeup_writefd, '\0')
-        for task in self.running:
-            if task.proc:
-                task.proc.poll()
-        # Apparently some UNIX systems automatically resent the SIGCHLD
-        # handler to SIG_DFL.  Reset it just in case.
-        self.set_sigchld_handler()
 
     def add_task(self, task):
         """Adds a Task to be processed with run()."""
         self.tasks.append(task)
 
+    def add_tasks(self, tasks):
+        """Adds an iterable of Tasks to be processed with run().
+
+        The iterable is consumed lazily, one Task at a time as slots become
+        free, so a generator that creates each Task on demand keeps memory
+        proportional to the parallelism rather than to the number of hosts.
+        Tasks given to add_task are started before those given here.
+        """
+        self.sources.append(iter(tasks))
+
+    def pending(self):
+        """Finds whether any tasks remain to be started."""
+        if not self.tasks:
+            task = self._next_source_task()
+            if task is None:
+                return False
+            self.tasks.append(task)
+        return True
+
+    def _next_task(self):
+        """Returns the next task to start, or None if there are none."""
+        if self.tasks:
+            return self.tasks.popleft()
+        return self._next_source_task()
+
+    def _next_source_task(self):
+        """Takes the next task from the iterators given to add_tasks."""
+        while self.sources:
+            try:
+                return next(self.sources[0])
+            except StopIteration:
+                self.sources.popleft()
+        return None
+
     def update_tasks(self, writer):
         """Reaps tasks and starts as many new ones as allowed."""
-        # Mask signals to work around a Python bug:
-        #   http://bugs.python.org/issue1068268
-        # Since sigprocmask isn't in the stdlib, clear the SIGCHLD handler.
-        # Since signals are masked, reap_tasks needs to be called once for
-        # each loop.
         keep_running = True
         while keep_running:
-            self.clear_sigchld_handler()
             self._start_tasks_once(writer)
-            self.set_sigchld_handler()
             keep_running = self.reap_tasks()
 
     def _start_tasks_once(self, writer):
-        """Starts tasks once.
+        """Starts tasks once."""
+        while len(self.running) < self.limit:
+            task = self._next_task()
+            if task is None:
+                break
+            # Tasks from a coordinator (see psshlib.shard) are numbered.
+            nodenum = task.nodenum
+            if nodenum is None:
+                nodenum = self.taskcount
+            task.start(nodenum, self.iomap, writer, self.askpass_socket,
+                    self.environ, self.printer, self.reducer, self.password)
+            self.running[task.pid] = task
+            self.watch(task)
+            if self.timeout > 0:
+                deadline = task.timestamp + self.timeout
+                heapq.heappush(self.deadlines,
+                        (deadline, self.taskcount, task))
+            self.taskcount += 1
+        if not self.sealed and not self.pending():
+            # No more tasks will start, so shared input streams can discard
+            # data once every running task has written it.
+            self.sealed = True
+            for task in self.running.values():
+                task.seal_input()
 
-        Due to http://bugs.python.org/issue1068268, signals must be masked
-        when this method is called.
+    def watch(self, task):
+        """Arranges to find out when the process of a started task exits.
+
+        Only the Manager's own children are ever reaped, so it can share the
+        process with other code that starts and waits for children.
         """
-        while 0 < len(self.tasks) and len(self.running) < self.limit:
-            task = self.tasks.pop(0)
-            self.running.append(task)
-            task.start(self.taskcount, self.iomap, writer, self.askpass_socket)
-            self.taskcount += 1
+        if HAVE_PIDFD:
+            try:
+                fd = os.pidfd_open(task.pid)
+            except OSError:
+                # For example, ENOSYS from a kernel older than 5.3.
+                if not self.sigchld:
+                    self.set_sigchld_handler()
+            else:
+                self.pidfds[fd] = task
+                self.iomap.register_read(fd, self.handle_pidfd)
+                return
+        self.unwatched.add(task.pid)
+
+    def handle_pidfd(self, fd, iomap):
+        """Called when the process of a task has exited."""
+        task = self.pidfds[fd]
+        status = wait_child(task.pid)
+        if status is not None:
+            del self.pidfds[fd]
+            iomap.unregister(fd)
+            os.close(fd)
+            task.exited(status)
+            self.exited.append(task)
 
     def reap_tasks(self):
-        """Checks to see if any tasks have terminated.
+        """Collects exited children and finishes tasks that are done.
+
+        With pidfds, the exited children have already been collected by
+        handle_pidfd, so the cost is proportional to the number of exits
+        rather than the number of running tasks.  Otherwise, each running
+        task's pid is checked with waitpid.
 
         After cleaning up, returns the number of tasks that finished.
         """
-        still_running = []
+        for pid in list(self.unwatched):
+            status = wait_child(pid)
+            if status is not None:
+                self.unwatched.remove(pid)
+                task = self.running[pid]
+                task.exited(status)
+                self.exited.append(task)
+
         finished_count = 0
-        for task in self.running:
+        exited = self.exited
+        self.exited = []
+        for i, task in enumerate(exited):
             if task.running():
-                still_running.append(task)
-            else:
+                self.exited.append(task)
+                continue
+            del self.running[task.pid]
+            finished_count += 1
+            try:
                 self.finished(task)
-                finished_count += 1
-        self.running = still_running
+            except:
+                # If the callback raised, leave the rest for the next call.
+                self.exited.extend(exited[i + 1:])
+                raise
         return finished_count
 
     def check_timeout(self):
-        """Kills timed-out processes and returns the lowest time left."""
-        if self.timeout <= 0:
-            return None
+        """Kills timed-out processes and returns the time until the next one.
 
-        min_timeleft = None
-        for task in self.running:
-            timeleft = self.timeout - task.elapsed()
-            if timeleft <= 0:
-                task.timedout()
-                continue
-            if min_timeleft is None or timeleft < min_timeleft:
-                min_timeleft = timeleft
+        Returns None if no deadlines are pending.  Only expired deadlines are
+        examined, so each timeout costs O(log n).
+        """
+        deadlines = self.deadlines
+        if len(deadlines) > 2 * len(self.running) + 64:
+            # Drop the entries of finished tasks so they don't pile up.
+            deadlines = [entry for entry in deadlines if entry[2].proc]
+            heapq.heapify(deadlines)
+            self.deadlines = deadlines
 
-        if min_timeleft is None:
-            return 0
-        else:
-            return max(0, min_timeleft)
+        now = time.time()
+        while deadlines:
+            deadline, _, task = deadlines[0]
+            if not task.proc:
+                # The task already finished.
+                heapq.heappop(deadlines)
+            elif deadline <= now:
+                heapq.heappop(deadlines)
+                task.timedout()
+            else:
+                return deadline - now
+        return None
 
     def interrupted(self):
         """Cleans up after a keyboard interrupt."""
-        for task in self.running:
+        for task in list(self.running.values()):
             task.interrupted()
             self.finished(task)
+        self.cancel_pending()
 
-        for task in self.tasks:
+    def cancel_pending(self):
+        """Cancels and finishes the tasks that have not started."""
+        task = self._next_task()
+        while task is not None:
             task.cancel()
+            if task.nodenum is None:
+                task.nodenum = self.taskcount
+            self.taskcount += 1
             self.finished(task)
+            task = self._next_task()
 
     def finished(self, task):
-        """Marks a task as complete and reports its status to stdout."""
-        self.done.append(task)
-        n = len(self.done)
-        task.report(n)
+        """Marks a task as complete and reports its status to stdout.
+
+        Only a compact Result is kept in self.done; the Task's process and
+        buffers are released right after the report.  In ordered mode, reports
+        are numbered by host and held until every earlier host's report has
+        been written.  With --json, a record is also written for each task.
+        """
+        if self.printer:
+            self.printer.drain()
+        if self.quiet:
+            pass
+        elif self.reorder:
+            sys.stdout.flush()
+            number = task.nodenum
+            if self.reorder.is_next(number):
+                task.report(number + 1, self.reorder.stream)
+                self.reorder.written()
+            else:
+                out = io.BytesIO()
+                task.report(number + 1, out)
+                self.reorder.add(number, out.getvalue())
+        else:
+            task.report(len(self.done) + 1)
+        if self.coalescer:
+            self.coalescer.add(task)
+        result = task.result()
+        if self.jsonsink:
+            self.jsonsink.add(result)
+        self.done.append(result)
+        if self.callback:
+            self.callback(result)
+        task.release()
+
+
+def wait_child(pid, options=os.WNOHANG):
+    """Reaps a child with waitpid and returns its exit status.
+
+    Returns None if the child is still running.
+    """
+    while True:
+        try:
+            reaped, status = os.waitpid(pid, options)
+        except OSError:
+            _, e, _ = sys.exc_info()
+            if e.errno == EINTR:
+                continue
+            elif e.errno == ECHILD:
+                # Some other code reaped it, so its exit status is lost;
+                # report it like an ssh failure.
+                return 255 << 8
+            else:
+                raise
+        if reaped:
+            return status
+        return None
+
+
+def forget_signal_handlers():
+    """In a forked child, drops the parent's SIGCHLD handler and wakeup fd.
+
+    The child's own Managers then start from the defaults, and won't put
+    back handlers or file descriptors that belong to the parent.
+    """
+    global _sigchld_previous, _wakeup_previous
+    del _sigchld_managers[:]
+    del _wakeup_owners[:]
+    _sigchld_previous = None
+    _wakeup_previous = -1
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.set_wakeup_fd(-1)
+    except ValueError:
+        # Not in the main thread, so neither was set.
+        pass
+
+
+def create_manager(opts):
+    """Returns a Manager for the engine chosen with --engine.
+
+    With more than one worker (--workers), it is a ShardedManager, whose
+    worker processes each run a Manager of their own.
+    """
+    if (getattr(opts, 'workers', None) or 1) > 1:
+        from psshlib.shard import ShardedManager
+        return ShardedManager(opts)
+    if getattr(opts, 'engine', None) == 'asyncio':
+        from psshlib.aio import AsyncManager
+        return AsyncManager(opts)
+    return Manager(opts)
 
 
 class IOMap(object):
     """A manager for file descriptors and their associated handlers.
 
-    The poll method dispatches events to the appropriate handlers.
+    The poll method dispatches events to the appropriate handlers.  File
+    descriptors stay registered with the poller until they are unregistered,
+    so the cost of a poll grows with the number of ready descriptors rather
+    than the number of registered ones.
     """
-    def __init__(self):
+    def __init__(self, poller=None):
+        global _wakeup_previous
         self.readmap = {}
         self.writemap = {}
+        if poller is None:
+            poller = default_poller()
+        self.poller = poller
 
         # Setup the wakeup file descriptor to avoid hanging on lost signals.
         wakeup_readfd, wakeup_writefd = os.pipe()
+        psshutil.set_nonblocking(wakeup_readfd)
+        psshutil.set_nonblocking(wakeup_writefd)
         self.register_read(wakeup_readfd, self.wakeup_handler)
+        self.wakeup_fds = (wakeup_readfd, wakeup_writefd)
+        self.wakeup_writefd = None
         # TODO: remove test when we stop supporting Python <2.5
         if hasattr(signal, 'set_wakeup_fd'):
-            signal.set_wakeup_fd(wakeup_writefd)
-            self.wakeup_writefd = None
+            try:
+                previous = signal.set_wakeup_fd(wakeup_writefd)
+            except ValueError:
+                # Not in the main thread.
+                pass
+            else:
+                if not _wakeup_owners:
+                    _wakeup_previous = previous
+                _wakeup_owners.append(self)
         else:
             self.wakeup_writefd = wakeup_writefd
 
+    def owns_wakeup(self):
+        """Finds whether signals write to this IOMap's wakeup pipe."""
+        if self.wakeup_writefd:
+            return True
+        return bool(_wakeup_owners) and _wakeup_owners[-1] is self
+
+    def close(self):
+        """Closes the wakeup pipe and the poller.
+
+        The signal wakeup fd that this IOMap replaced is put back.
+        """
+        readfd, writefd = self.wakeup_fds
+        if self in _wakeup_owners:
+            latest = _wakeup_owners[-1] is self
+            _wakeup_owners.remove(self)
+            if _wakeup_owners:
+                restore = _wakeup_owners[-1].wakeup_fds[1]
+            else:
+                restore = _wakeup_previous
+            try:
+                if latest:
+                    current = signal.set_wakeup_fd(restore)
+                    if current != writefd:
+                        # Some other code set its own fd after this IOMap.
+                        signal.set_wakeup_fd(current)
+            except ValueError:
+                pass
+        self.unregister(readfd)
+        os.close(readfd)
+        os.close(writefd)
+        self.poller.close()
+
     def register_read(self, fd, handler):
         """Registers an IO handler for a file descriptor for reading."""
         self.readmap[fd] = handler
+        self._update(fd)
 
     def register_write(self, fd, handler):
         """Registers an IO handler for a file descriptor for writing."""
         self.writemap[fd] = handler
+        self._update(fd)
 
     def unregister(self, fd):
         """Unregisters the given file descriptor."""
@@ -219,28 +699,32 @@ class IOMap(object):
             del self.readmap[fd]
         if fd in self.writemap:
             del self.writemap[fd]
+        self._update(fd)
+
+    def _update(self, fd):
+        """Tells the poller which events are of interest for fd."""
+        events = 0
+        if fd in self.readmap:
+            events |= POLL_READ
+        if fd in self.writemap:
+            events |= POLL_WRITE
+        self.poller.update(fd, events)
 
     def poll(self, timeout=None):
         """Performs a poll and dispatches the resulting events."""
         if not self.readmap and not self.writemap:
             return
-        rlist = list(self.readmap)
-        wlist = list(self.writemap)
-        try:
-            rlist, wlist, _ = select.select(rlist, wlist, [], timeout)
-        except select.error:
-            _, e, _ = sys.exc_info()
-            errno = e.args[0]
-            if errno == EINTR:
-                return
-            else:
-                raise
-        for fd in rlist:
-            handler = self.readmap[fd]
-            handler(fd, self)
-        for fd in wlist:
-            handler = self.writemap[fd]
-            handler(fd, self)
+        for fd, events in self.poller.poll(timeout):
+            # A handler may unregister other file descriptors, so look each
+            # one up again rather than trusting the poll results.
+            if events & POLL_READ:
+                handler = self.readmap.get(fd)
+                if handler:
+                    handler(fd, self)
+            if events & POLL_WRITE:
+                handler = self.writemap.get(fd)
+                if handler:
+                    handler(fd, self)
 
     def wakeup_handler(self, fd, iomap):
         """Handles read events on the signal wakeup pipe.
@@ -252,82 +736,321 @@ class IOMap(object):
         except (OSError, IOError):
             _, e, _ = sys.exc_info()
             errno, message = e.args
-            if errno != EINTR:
+            if errno not in (EINTR, EAGAIN):
                 sys.stderr.write('Fatal error reading from wakeup pipe: %s\n'
                         % message)
                 sys.exit(-1)
 
 
-class Writer(threading.Thread):
-    """Thread that writes to files by processing requests from a Queue.
+class Writer(object):
+    """Writes to files by handing requests to a pool of WriterThreads.
 
     Until AIO becomes widely available, it is impossible to make a nonblocking
-    write to an ordinary file.  The Writer thread processes all writing to
-    ordinary files so that the main thread can work without blocking.
-    """
-    OPEN = object()
-    EOF = object()
-    ABORT = object()
+    write to an ordinary file.  The Writer threads process all writing to
+    ordinary files so that the main thread can work without blocking.  Each
+    file is always handled by the same thread, so its writes stay in order.
 
-    def __init__(self, outdir, errdir):
-        threading.Thread.__init__(self)
-        # A daemon thread automatically dies if the program is terminated.
-        self.setDaemon(True)
-        self.queue = queue.Queue()
+    If a store (a StoreWriter) is given, the output and error streams of
+    every host go to it, through a single thread, instead of to outdir and
+    errdir.  If a codec (from psshlib.compress) is given, the files are
+    compressed by the Writer threads, and their names get the codec's suffix.
+    """
+    def __init__(self, outdir, errdir, threads=1,
+            max_open_files=DEFAULT_MAX_OPEN_FILES, store=None, codec=None):
         self.outdir = outdir
         self.errdir = errdir
-
+        self.store = store
+        self.codec = codec
         self.host_counts = {}
-        self.files = {}
+        if store:
+            self.threads = [WriterThread(store)]
+            return
+        threads = max(1, threads)
+        # Each thread gets an equal share of the open file budget.
+        max_open = max(1, max_open_files // threads)
+        self.threads = [WriterThread(FileSink(max_open, codec))
+                for i in range(threads)]
 
-    def run(self):
-        while True:
-            filename, data = self.queue.get()
-            if filename == self.ABORT:
-                return
+    def start(self):
+        for thread in self.threads:
+            thread.start()
 
-            if data == self.OPEN:
-                self.files[filename] = open(filename, 'wb', buffering=1)
-                psshutil.set_cloexec(self.files[filename])
-            else:
-                dest = self.files[filename]
-                if data == self.EOF:
-                    dest.close()
-                else:
-                    dest.write(data)
+    def join(self):
+        for thread in self.threads:
+            thread.join()
 
-    def open_files(self, host):
-        """Called from another thread to create files for stdout and stderr.
+    def _queue(self, filename):
+        """Finds the queue of the thread responsible for the given file."""
+        threads = self.threads
+        if len(threads) == 1:
+            return threads[0].queue
+        return threads[hash(filename) % len(threads)].queue
 
-        Returns a pair of filenames (outfile, errfile).  These filenames are
-        used as handles for future operations.  Either or both may be None if
-        outdir or errdir or not set.
+    def filenames(self, host):
+        """Returns a pair of new filenames (outfile, errfile) for the host.
+
+        Either or both may be None if outdir or errdir is not set.  Unlike
+        open_files, the files are not created.
         """
         outfile = errfile = None
-        if self.outdir or self.errdir:
+        if self.outdir or self.errdir or self.store:
             count = self.host_counts.get(host, 0)
             self.host_counts[host] = count + 1
             if count:
                 filename = "%s.%s" % (host, count)
             else:
                 filename = host
+            if self.codec:
+                filename += self.codec.suffix
+            if self.store:
+                outfile = (filename, STDOUT)
+                errfile = (filename, STDERR)
             if self.outdir:
                 outfile = os.path.join(self.outdir, filename)
-                self.queue.put((outfile, self.OPEN))
             if self.errdir:
                 errfile = os.path.join(self.errdir, filename)
-                self.queue.put((errfile, self.OPEN))
+        return outfile, errfile
+
+    def open_files(self, host):
+        """Called from another thread to create files for stdout and stderr.
+
+        Returns a pair of filenames (outfile, errfile).  These filenames are
+        used as handles for future operations.  Either or both may be None if
+        outdir or errdir or not set.  With a store, the handles are (name,
+        stream) pairs instead.
+        """
+        outfile, errfile = self.filenames(host)
+        if outfile:
+            self._queue(outfile).put((outfile, WriterThread.OPEN))
+        if errfile:
+            self._queue(errfile).put((errfile, WriterThread.OPEN))
         return outfile, errfile
 
     def write(self, filename, data):
         """Called from another thread to enqueue a write."""
-        self.queue.put((filename, data))
+        self._queue(filename).put((filename, data))
 
     def close(self, filename):
         """Called from another thread to close the given file."""
-        self.queue.put((filename, self.EOF))
+        self._queue(filename).put((filename, WriterThread.EOF))
 
     def signal_quit(self):
         """Called from another thread to request the Writer to quit."""
-        self.queue.put((self.ABORT, None))
+        for thread in self.threads:
+            thread.queue.put((WriterThread.ABORT, None))
+
+    def stats(self):
+        """Returns a dict of counters summed over all threads.
+
+        The keys are threads, queue_depth (requests waiting right now),
+        max_queue_depth (the most requests any one thread found waiting),
+        requests, bytes (received), written (bytes written, which differs
+        when compressing), writes (system calls), batches, and reopens (files
+        reopened after being closed to stay within max_open_files).
+        """
+        stats = dict(threads=len(self.threads), queue_depth=0,
+                max_queue_depth=0, requests=0, bytes=0, written=0, writes=0,
+                batches=0, reopens=0)
+        for thread in self.threads:
+            stats['queue_depth'] += thread.queue.qsize()
+            stats['max_queue_depth'] = max(stats['max_queue_depth'],
+                    thread.max_queue_depth)
+            stats['requests'] += thread.requests
+            stats['batches'] += thread.batches
+            stats['bytes'] += thread.sink.bytes
+            stats['written'] += thread.sink.written
+            stats['writes'] += thread.sink.writes
+            stats['reopens'] += thread.sink.reopens
+        return stats
+
+
+class WriterThread(threading.Thread):
+    """Thread that writes to a sink by processing requests from a Queue.
+
+    Requests that are waiting in the queue are taken in batches, and the
+    chunks for each file are held until FLUSH_SIZE bytes are pending, the file
+    is closed, or the queue runs dry, so they can be combined into as few
+    writev calls as possible.  Nothing is held while the thread is idle.
+
+    The sink (a FileSink by default) does the actual writing.  It provides
+    open(handle), write(handle, chunks), close(handle), and finish() methods
+    and bytes, writes, and reopens counters.
+    """
+    OPEN = object()
+    EOF = object()
+    ABORT = object()
+
+    # The most requests to handle in one batch.
+    BATCH_SIZE = 4096
+    # Bytes to collect for a file before writing them.
+    FLUSH_SIZE = 1 << 16
+
+    def __init__(self, sink=None):
+        threading.Thread.__init__(self)
+        # A daemon thread automatically dies if the program is terminated.
+        self.setDaemon(True)
+        self.queue = queue.Queue()
+        if sink is None:
+            sink = FileSink()
+        self.sink = sink
+        # Chunks waiting to be written and their total size, by filename.
+        self.pending = {}
+
+        self.max_queue_depth = 0
+        self.requests = 0
+        self.batches = 0
+
+    def run(self):
+        sink = self.sink
+        while True:
+            batch = [self.queue.get()]
+            depth = self.queue.qsize() + 1
+            if depth > self.max_queue_depth:
+                self.max_queue_depth = depth
+            drained = False
+            try:
+                while len(batch) < self.BATCH_SIZE:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                drained = True
+            self.batches += 1
+            self.requests += len(batch)
+
+            for filename, data in batch:
+                if filename is self.ABORT:
+                    self.flush()
+                    sink.finish()
+                    return
+                if data is self.OPEN:
+                    sink.open(filename)
+                elif data is self.EOF:
+                    entry = self.pending.pop(filename, None)
+                    if entry:
+                        sink.write(filename, entry[0])
+                    sink.close(filename)
+                else:
+                    entry = self.pending.get(filename)
+                    if entry is None:
+                        entry = self.pending[filename] = [[], 0]
+                    entry[0].append(data)
+                    entry[1] += len(data)
+                    if entry[1] >= self.FLUSH_SIZE:
+                        del self.pending[filename]
+                        sink.write(filename, entry[0])
+            if drained:
+                self.flush()
+
+    def flush(self):
+        """Writes all pending chunks."""
+        pending = self.pending
+        self.pending = {}
+        for filename, entry in pending.items():
+            self.sink.write(filename, entry[0])
+
+
+class FileSink(object):
+    """Writes each stream to its own file, optionally compressed.
+
+    At most max_open files are kept open.  When another is needed, the least
+    recently used one is closed, and it is reopened in append mode the next
+    time it is written to.  When compressing, closing a file finishes its
+    compressed stream and reopening it starts another, which decompressors
+    read as a continuation of the same data.
+    """
+    def __init__(self, max_open=DEFAULT_MAX_OPEN_FILES, codec=None):
+        self.max_open = max_open
+        self.codec = codec
+        # Open file descriptors by filename, from least to most recently
+        # used.  Each use moves a file to the end by removing and reinserting
+        # it (OrderedDict has no move_to_end before Python 3.2).
+        self.files = OrderedDict()
+        # Compressors of the open files, by filename.
+        self.compressors = {}
+        # Files that have been created but are not open right now.
+        self.closed = set()
+
+        self.bytes = 0
+        self.written = 0
+        self.writes = 0
+        self.reopens = 0
+
+    def open(self, filename, append=False):
+        """Opens (or, with append, reopens) a file and returns its fd.
+
+        Returns None if the file could not be opened.
+        """
+        while len(self.files) >= self.max_open:
+            oldest = next(iter(self.files))
+            self._close(oldest)
+            self.closed.add(oldest)
+        flags = os.O_WRONLY | os.O_CREAT
+        if append:
+            flags |= os.O_APPEND
+        else:
+            flags |= os.O_TRUNC
+        flags |= getattr(os, 'O_CLOEXEC', 0)
+        try:
+            fd = os.open(filename, flags, 438) # 0666
+        except OSError:
+            _, e, _ = sys.exc_info()
+            sys.stderr.write('Could not open %s: %s\n' % (filename,
+                e.strerror))
+            return None
+        self.files[filename] = fd
+        if self.codec:
+            self.compressors[filename] = self.codec.compressor()
+        return fd
+
+    def write(self, filename, chunks):
+        """Writes a list of chunks to the given file."""
+        fd = self.files.pop(filename, None)
+        if fd is not None:
+            # Move the file to the most recently used end.
+            self.files[filename] = fd
+        elif filename in self.closed:
+            self.closed.remove(filename)
+            self.reopens += 1
+            fd = self.open(filename, append=True)
+        if fd is None:
+            return
+        for chunk in chunks:
+            self.bytes += len(chunk)
+        compressor = self.compressors.get(filename)
+        if compressor:
+            chunks = [compressor.compress(chunk) for chunk in chunks]
+            chunks = [chunk for chunk in chunks if chunk]
+        self._write(filename, fd, chunks)
+
+    def _write(self, filename, fd, chunks):
+        if not chunks:
+            return
+        try:
+            written, calls = psshutil.write_chunks(fd, chunks)
+            self.written += written
+            self.writes += calls
+        except OSError:
+            _, e, _ = sys.exc_info()
+            sys.stderr.write('Could not write to %s: %s\n' % (filename,
+                e.strerror))
+            self.compressors.pop(filename, None)
+            os.close(self.files.pop(filename))
+
+    def _close(self, filename):
+        """Finishes any compressed stream and closes an open file."""
+        compressor = self.compressors.pop(filename, None)
+        if compressor:
+            self._write(filename, self.files[filename], [compressor.flush()])
+        fd = self.files.pop(filename, None)
+        if fd is not None:
+            os.close(fd)
+
+    def close(self, filename):
+        if filename in self.files:
+            self._close(filename)
+        self.closed.discard(filename)
 
+    def finish(self):
+        """Closes any files that are still open."""
+        for filename in list(self.files):
+            self._close(filename)
+        self.closed = set()
@@ -0,0 +1,326 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""A consolidated store for the output of many hosts.
+
+Instead of one file per host and stream, a store is a pair of files: a
+segment file, which receives all output appended in the order it is written,
+and an index file, which records which host and stream each extent of the
+segment belongs to.  Each run of pssh appends to both files, so one store
+can hold the output of many runs.
+
+The index is a sequence of records, each starting with a one-byte type:
+
+    'R' run:    start time (double)
+    'H' host:   host number (uint32), name length (uint16), name (UTF-8)
+    'D' extent: host number (uint32), stream (uint8), segment offset
+                (uint64), length (uint32)
+
+Host numbers count from zero within each run.  An extent record is only
+written after its data, so the index never points at missing data, and a
+partial record left by a crash is ignored (and removed by the next run).
+"""
+
+import errno
+import fcntl
+import os
+import re
+import struct
+import sys
+import time
+
+from psshlib import psshutil
+
+MAGIC = 'PSSHSTORE1\n'.encode('ascii')
+INDEX_SUFFIX = '.idx'
+
+STDOUT = 1
+STDERR = 2
+STREAM_NAMES = {STDOUT: 'stdout', STDERR: 'stderr'}
+
+RUN = struct.Struct('!cd')
+HOST = struct.Struct('!cIH')
+EXTENT = struct.Struct('!cIBQI')
+RUN_TYPE = 'R'.encode('ascii')
+HOST_TYPE = 'H'.encode('ascii')
+EXTENT_TYPE = 'D'.encode('ascii')
+
+# Extent lengths are stored in 32 bits.
+MAX_EXTENT = (1 << 32) - 1
+READ_SIZE = 1 << 16
+
+
+class StoreError(Exception):
+    pass
+
+
+def index_path(path):
+    """Returns the path of the index file of the store at path."""
+    return path + INDEX_SUFFIX
+
+
+class StoreRun(object):
+    """The hosts and extents recorded by one run."""
+    __slots__ = ('number', 'time', 'hosts', 'numbers', 'extents', 'bytes')
+
+    def __init__(self, number, start):
+        self.number = number
+        self.time = start
+        # Host names by host number, and host numbers by name.
+        self.hosts = []
+        self.numbers = {}
+        # Lists of (offset, length) pairs by (host number, stream).
+        self.extents = {}
+        self.bytes = 0
+
+
+def parse_index(data):
+    """Parses the contents of an index file.
+
+    Returns a pair (runs, length), where runs is a list of StoreRuns and
+    length is the size of the complete records at the start of the data.
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise StoreError('Not a pssh output store index')
+    runs = []
+    run = None
+    pos = len(MAGIC)
+    end = len(data)
+    while pos < end:
+        kind = data[pos:pos + 1]
+        if run is None and kind != RUN_TYPE:
+            # Every extent and host record belongs to the run before it.
+            raise StoreError('Corrupt pssh output store index')
+        if kind == EXTENT_TYPE:
+            if pos + EXTENT.size > end:
+                break
+            _, host, stream, offset, length = EXTENT.unpack_from(data, pos)
+            pos += EXTENT.size
+            key = (host, stream)
+            extents = run.extents.get(key)
+            if extents is None:
+                extents = run.extents[key] = []
+            extents.append((offset, length))
+            run.bytes += length
+        elif kind == HOST_TYPE:
+            if pos + HOST.size > end:
+                break
+            _, host, size = HOST.unpack_from(data, pos)
+            if pos + HOST.size + size > end:
+                break
+            name = data[pos + HOST.size:pos + HOST.size + size]
+            pos += HOST.size + size
+            name = name.decode('utf-8')
+            run.numbers[name] = host
+            run.hosts.append(name)
+        elif kind == RUN_TYPE:
+            if pos + RUN.size > end:
+                break
+            _, start = RUN.unpack_from(data, pos)
+            pos += RUN.size
+            run = StoreRun(len(runs) + 1, start)
+            runs.append(run)
+        else:
+            raise StoreError('Corrupt pssh output store index')
+    return runs, pos
+
+
+class StoreWriter(object):
+    """A Writer sink that appends output to a store.
+
+    The handles are (name, stream) pairs.  The store is locked while it is
+    open, so concurrent runs can't interleave their records.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.bytes = 0
+        self.written = 0
+        self.writes = 0
+        self.reopens = 0
+        self.hosts = {}
+
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_CLOEXEC', 0)
+        try:
+            self.indexfd = os.open(index_path(path), flags, 438) # 0666
+        except OSError:
+            _, e, _ = sys.exc_info()
+            raise StoreError('Could not open store %s: %s'
+                    % (path, e.strerror))
+        try:
+            try:
+                fcntl.flock(self.indexfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                _, e, _ = sys.exc_info()
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    raise StoreError('Store %s is in use by another run'
+                            % path)
+                raise
+            self.segmentfd = os.open(path, os.O_WRONLY | os.O_CREAT
+                    | os.O_APPEND | getattr(os, 'O_CLOEXEC', 0), 438)
+            self._recover()
+        except:
+            os.close(self.indexfd)
+            raise
+        self.offset = os.fstat(self.segmentfd).st_size
+        self._record(RUN.pack(RUN_TYPE, time.time()))
+
+    def _recover(self):
+        """Checks the index and drops any partial record at its end."""
+        size = os.fstat(self.indexfd).st_size
+        if not size:
+            psshutil.write_chunks(self.indexfd, [MAGIC])
+            return
+        f = os.fdopen(os.dup(self.indexfd), 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        runs, length = parse_index(data)
+        if length < size:
+            os.ftruncate(self.indexfd, length)
+        os.lseek(self.indexfd, 0, os.SEEK_END)
+
+    def _record(self, record):
+        """Appends a record to the index and returns the write calls made."""
+        return psshutil.write_chunks(self.indexfd, [record])[1]
+
+    def open(self, handle):
+        """Assigns a host number to the stream's host, if it has none yet."""
+        name = handle[0]
+        if name not in self.hosts:
+            number = len(self.hosts)
+            self.hosts[name] = number
+            encoded = name.encode('utf-8')
+            self._record(HOST.pack(HOST_TYPE, number, len(encoded))
+                    + encoded)
+
+    def write(self, handle, chunks):
+        """Appends a list of chunks and records them as one extent."""
+        name, stream = handle
+        number = self.hosts[name]
+        size = sum([len(chunk) for chunk in chunks])
+        if size > MAX_EXTENT:
+            middle = len(chunks) // 2
+            self.write(handle, chunks[:middle])
+            self.write(handle, chunks[middle:])
+            return
+        try:
+            _, calls = psshutil.write_chunks(self.segmentfd, chunks)
+        except OSError:
+            _, e, _ = sys.exc_info()
+            sys.stderr.write('Could not write to %s: %s\n' % (self.path,
+                e.strerror))
+            # Skip the hole that a partial write may have left.
+            self.offset = os.fstat(self.segmentfd).st_size
+            return
+        calls += self._record(EXTENT.pack(EXTENT_TYPE, number, stream,
+            self.offset, size))
+        self.offset += size
+        self.bytes += size
+        self.written += size
+        self.writes += calls
+
+    def close(self, handle):
+        pass
+
+    def finish(self):
+        """Closes the store, releasing the lock."""
+        os.close(self.segmentfd)
+        os.close(self.indexfd)
+
+
+class OutputStore(object):
+    """Reads the output saved in a store.
+
+    Runs are numbered from 1 in the order they were written; a run argument
+    of None means the latest run.  Only the extents of the requested hosts
+    and stream are read from the segment file.
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            f = open(index_path(path), 'rb')
+        except IOError:
+            _, e, _ = sys.exc_info()
+            raise StoreError('Could not open store %s: %s'
+                    % (path, e.strerror))
+        try:
+            self.runs, length = parse_index(f.read())
+        finally:
+            f.close()
+        self.segment = open(path, 'rb')
+
+    def run(self, number=None):
+        """Returns the StoreRun with the given number."""
+        if not self.runs:
+            raise StoreError('Store %s is empty' % self.path)
+        if number is None:
+            return self.runs[-1]
+        if number < 1 or number > len(self.runs):
+            raise StoreError('Store %s has no run %s' % (self.path, number))
+        return self.runs[number - 1]
+
+    def hosts(self, run=None):
+        """Returns the names of the hosts in a run, in order of starting."""
+        return list(self.run(run).hosts)
+
+    def size(self, host, stream=STDOUT, run=None):
+        """Returns the number of bytes saved for a host's stream."""
+        store_run = self.run(run)
+        number = self._number(store_run, host)
+        extents = store_run.extents.get((number, stream), ())
+        return sum([length for offset, length in extents])
+
+    def _number(self, store_run, host):
+        try:
+            return store_run.numbers[host]
+        except KeyError:
+            raise StoreError('No host %s in run %s' % (host,
+                store_run.number))
+
+    def read(self, host, stream=STDOUT, run=None):
+        """Yields the saved output of a host's stream as chunks of bytes."""
+        store_run = self.run(run)
+        number = self._number(store_run, host)
+        segment = self.segment
+        for offset, length in store_run.extents.get((number, stream), ()):
+            segment.seek(offset)
+            while length > 0:
+                chunk = segment.read(min(length, READ_SIZE))
+                if not chunk:
+                    raise StoreError('Store %s is truncated' % self.path)
+                length -= len(chunk)
+                yield chunk
+
+    def lines(self, host, stream=STDOUT, run=None):
+        """Yields the saved output of a host's stream line by line.
+
+        The lines keep their line endings (except possibly the last one).
+        """
+        partial = bytes()
+        for chunk in self.read(host, stream, run):
+            lines = (partial + chunk).split('\n'.encode('ascii'))
+            partial = lines.pop()
+            for line in lines:
+                yield line + '\n'.encode('ascii')
+        if partial:
+            yield partial
+
+    def grep(self, pattern, stream=STDOUT, run=None, hosts=None, flags=0):
+        """Yields (host, line) pairs for lines matching a regular expression.
+
+        The pattern may be a string, bytes, or compiled bytes pattern.  Only
+        the given hosts (all hosts if None) are searched.
+        """
+        if not hasattr(pattern, 'search'):
+            if not isinstance(pattern, bytes):
+                pattern = pattern.encode('utf-8')
+            pattern = re.compile(pattern, flags)
+        if hosts is None:
+            hosts = self.hosts(run)
+        for host in hosts:
+            for line in self.lines(host, stream, run):
+                if pattern.search(line):
+                    yield host, line
+
+    def close(self):
+        self.segment.close()
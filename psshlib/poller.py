@@ -0,0 +1,201 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""Readiness notification backends for the IOMap.
+
+Each poller keeps a persistent registration for every file descriptor, so
+the cost of a poll depends on the number of ready descriptors rather than the
+number of registered ones (except for the select fallback, which exists for
+platforms that have nothing better).  The EpollPoller and PollPoller have no
+FD_SETSIZE limit.
+"""
+
+from errno import EEXIST, EINTR, ENOENT
+import math
+import select
+import sys
+
+POLL_READ = 1
+POLL_WRITE = 2
+
+
+def _timeout_ms(timeout):
+    """Converts a timeout in seconds to the millisecond form used by poll."""
+    if timeout is None:
+        return -1
+    return int(math.ceil(max(0, timeout) * 1000))
+
+
+def _interrupted():
+    """Finds whether the exception being handled is an EINTR."""
+    _, e, _ = sys.exc_info()
+    return e.args and e.args[0] == EINTR
+
+
+class EpollPoller(object):
+    """Poller based on Linux's epoll."""
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.registered = {}
+
+    def update(self, fd, events):
+        """Sets the events of interest for fd (0 means unregister)."""
+        if self.registered.get(fd, 0) == events:
+            return
+        if not events:
+            del self.registered[fd]
+            try:
+                self.epoll.unregister(fd)
+            except (IOError, OSError, ValueError):
+                # The file descriptor may already have been closed, in which
+                # case the kernel dropped it from the epoll set.
+                pass
+            return
+
+        mask = 0
+        if events & POLL_READ:
+            mask |= select.EPOLLIN
+        if events & POLL_WRITE:
+            mask |= select.EPOLLOUT
+        if fd in self.registered:
+            try:
+                self.epoll.modify(fd, mask)
+            except (IOError, OSError):
+                _, e, _ = sys.exc_info()
+                if e.errno != ENOENT:
+                    raise
+                self.epoll.register(fd, mask)
+        else:
+            try:
+                self.epoll.register(fd, mask)
+            except (IOError, OSError):
+                _, e, _ = sys.exc_info()
+                if e.errno != EEXIST:
+                    raise
+                self.epoll.modify(fd, mask)
+        self.registered[fd] = events
+
+    def poll(self, timeout=None):
+        """Returns a list of (fd, events) pairs for the ready descriptors."""
+        if timeout is None:
+            timeout = -1
+        try:
+            ready = self.epoll.poll(timeout)
+        except (select.error, IOError, OSError):
+            if _interrupted():
+                return []
+            raise
+        error = select.EPOLLERR | select.EPOLLHUP
+        events = []
+        for fd, mask in ready:
+            if mask & error:
+                # Let the handlers discover the error with a read or write.
+                events.append((fd, self.registered.get(fd, 0)))
+                continue
+            flags = 0
+            if mask & select.EPOLLIN:
+                flags |= POLL_READ
+            if mask & select.EPOLLOUT:
+                flags |= POLL_WRITE
+            events.append((fd, flags))
+        return events
+
+    def close(self):
+        self.epoll.close()
+
+
+class PollPoller(object):
+    """Poller based on poll(2)."""
+    def __init__(self):
+        self.pollobj = select.poll()
+        self.registered = {}
+
+    def update(self, fd, events):
+        """Sets the events of interest for fd (0 means unregister)."""
+        if self.registered.get(fd, 0) == events:
+            return
+        if not events:
+            del self.registered[fd]
+            self.pollobj.unregister(fd)
+            return
+        mask = 0
+        if events & POLL_READ:
+            mask |= select.POLLIN
+        if events & POLL_WRITE:
+            mask |= select.POLLOUT
+        # Registering an fd that is already registered modifies its mask.
+        self.pollobj.register(fd, mask)
+        self.registered[fd] = events
+
+    def poll(self, timeout=None):
+        """Returns a list of (fd, events) pairs for the ready descriptors."""
+        try:
+            ready = self.pollobj.poll(_timeout_ms(timeout))
+        except (select.error, IOError, OSError):
+            if _interrupted():
+                return []
+            raise
+        error = select.POLLERR | select.POLLHUP | select.POLLNVAL
+        events = []
+        for fd, mask in ready:
+            if mask & error:
+                events.append((fd, self.registered.get(fd, 0)))
+                continue
+            flags = 0
+            if mask & select.POLLIN:
+                flags |= POLL_READ
+            if mask & select.POLLOUT:
+                flags |= POLL_WRITE
+            events.append((fd, flags))
+        return events
+
+    def close(self):
+        pass
+
+
+class SelectPoller(object):
+    """Poller based on select(2), limited to FD_SETSIZE descriptors."""
+    def __init__(self):
+        self.readset = set()
+        self.writeset = set()
+
+    def update(self, fd, events):
+        """Sets the events of interest for fd (0 means unregister)."""
+        if events & POLL_READ:
+            self.readset.add(fd)
+        else:
+            self.readset.discard(fd)
+        if events & POLL_WRITE:
+            self.writeset.add(fd)
+        else:
+            self.writeset.discard(fd)
+
+    def poll(self, timeout=None):
+        """Returns a list of (fd, events) pairs for the ready descriptors."""
+        if timeout is not None:
+            timeout = max(0, timeout)
+        try:
+            rlist, wlist, _ = select.select(list(self.readset),
+                    list(self.writeset), [], timeout)
+        except (select.error, IOError, OSError):
+            if _interrupted():
+                return []
+            raise
+        events = [(fd, POLL_READ) for fd in rlist]
+        events.extend([(fd, POLL_WRITE) for fd in wlist])
+        return events
+
+    def close(self):
+        pass
+
+
+POLLERS = {'epoll': EpollPoller, 'poll': PollPoller, 'select': SelectPoller}
+
+
+def default_poller():
+    """Creates the most scalable poller available on this platform."""
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    elif hasattr(select, 'poll'):
+        return PollPoller()
+    else:
+        return SelectPoller()
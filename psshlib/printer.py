@@ -0,0 +1,125 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""Printing of output as it arrives (pssh -P).
+
+Tasks hand complete lines to a shared Printer, which prefixes each line with
+its host and collects them in one buffer.  The Manager flushes the buffer
+once per iteration of its loop.  Standard output is switched to non-blocking
+mode only for the duration of a flush, so a slow terminal or pipe never
+stalls the event loop, and other writers to the same file description (such
+as a shell sharing the terminal) never see it in non-blocking mode.
+
+If the consumer falls behind and the buffer reaches its limit, Tasks stop
+reading from their processes until it drains, so memory stays bounded and
+the backpressure reaches the remote commands.
+"""
+
+from errno import EAGAIN, EINTR
+import fcntl
+import os
+import sys
+
+DEFAULT_LIMIT = 1 << 20
+
+
+class Printer(object):
+    """Buffers prefixed lines and writes them to a file descriptor.
+
+    Arguments:
+        fd: File descriptor to write to (normally 1).
+        iomap: IOMap used to wait for the fd to become writable.
+        limit: Number of buffered bytes at which readers should pause.
+    """
+    def __init__(self, fd, iomap, limit=DEFAULT_LIMIT):
+        self.fd = fd
+        self.iomap = iomap
+        self.limit = limit
+        self.buffer = bytearray()
+        self.waiting = []
+        self.registered = False
+
+    def write_lines(self, prefix, lines):
+        """Adds lines (which must end in newlines) with the given prefix."""
+        buffer = self.buffer
+        for line in lines:
+            buffer += prefix
+            buffer += line
+
+    def full(self):
+        """Finds whether readers should pause until the buffer drains."""
+        return len(self.buffer) >= self.limit
+
+    def wait(self, callback):
+        """Calls callback once the buffer is no longer full."""
+        self.waiting.append(callback)
+
+    def flush(self):
+        """Writes as much of the buffer as possible without blocking."""
+        if not self.buffer:
+            return
+        self._sync_stdout()
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        blocking = not flags & os.O_NONBLOCK
+        if blocking:
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        try:
+            self._write()
+        finally:
+            if blocking:
+                fcntl.fcntl(self.fd, fcntl.F_SETFL, flags)
+        if self.buffer and not self.registered:
+            # Try again as soon as the consumer catches up.
+            self.iomap.register_write(self.fd, self.handle_write)
+            self.registered = True
+        elif not self.buffer and self.registered:
+            self.iomap.unregister(self.fd)
+            self.registered = False
+        self._wake()
+
+    def handle_write(self, fd, iomap):
+        """Called when the file descriptor is ready for writing."""
+        self.flush()
+
+    def drain(self):
+        """Writes the whole buffer, blocking if necessary.
+
+        This is used before reports and at the end of the run, so that the
+        output of -P stays in order with the lines printed by Task.report.
+        """
+        if self.registered:
+            self.iomap.unregister(self.fd)
+            self.registered = False
+        if self.buffer:
+            self._sync_stdout()
+            self._write()
+        self._wake()
+
+    def _write(self):
+        """Writes from the buffer until it is empty or the fd would block."""
+        buffer = self.buffer
+        while buffer:
+            try:
+                count = os.write(self.fd, buffer)
+            except (OSError, IOError):
+                _, e, _ = sys.exc_info()
+                if e.errno == EINTR:
+                    continue
+                if e.errno == EAGAIN:
+                    return
+                raise
+            del buffer[:count]
+
+    def _wake(self):
+        """Resumes the waiting readers if the buffer has room."""
+        if self.waiting and not self.full():
+            waiting = self.waiting
+            self.waiting = []
+            for callback in waiting:
+                callback()
+
+    def _sync_stdout(self):
+        """Flushes anything printed with sys.stdout, so it stays in order."""
+        try:
+            sys.stdout.flush()
+        except (OSError, IOError):
+            pass
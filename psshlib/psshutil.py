@@ -2,11 +2,25 @@
 # Copyright (c) 2003-2008, Brent N. Chun
 
 import fcntl
+import os
 import string
 import sys
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 HOST_FORMAT = 'Host format is [user@]host[:port] [user]'
 
+HAVE_WRITEV = hasattr(os, 'writev')
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
 
 def read_hosts(pathnames, default_user=None, default_port=None):
     """
@@ -15,24 +29,33 @@ def read_hosts(pathnames, default_user=None, default_port=None):
     can be used directly for all ssh-based commands (e.g., ssh, scp, rsync -e
     ssh, etc.)
     """
-    lines = []
-    if not pathnames:
-        return lines
-    for pathname in pathnames:
-        f = open(pathname)
+    return list(iter_hosts(pathnames, default_user, default_port))
+
+
+def iter_hosts(pathnames, default_user=None, default_port=None):
+    """Like read_hosts, but returns an iterator of (host, port, user) tuples.
+
+    The files are opened immediately (so errors are reported right away) but
+    read lazily, so even a very large host list is never held in memory.
+    """
+    files = []
+    if pathnames:
+        for pathname in pathnames:
+            files.append(open(pathname))
+    return _iter_host_files(files, default_user, default_port)
+
+
+def _iter_host_files(files, default_user, default_port):
+    for f in files:
         for line in f:
-            lines.append(line.strip())
+            # Skip blank lines or lines starting with #
+            line = line.strip(string.whitespace + '#')
+            if not line:
+                continue
+            host, port, user = parse_line(line, default_user, default_port)
+            if host:
+                yield (host, port, user)
         f.close()
-    hosts = []
-    for line in lines:
-        # Skip blank lines or lines starting with #
-        line = line.strip(string.whitespace + '#')
-        if not line:
-            continue
-        host, port, user = parse_line(line, default_user, default_port)
-        if host:
-            hosts.append((host, port, user))
-    return hosts
 
 # TODO: eventually deprecate the second host field and standardize on the
 # [user@]host[:port] format.
@@ -74,3 +97,107 @@ def set_cloexec(filelike):
     not require the close_fds option.
     """
     fcntl.fcntl(filelike.fileno(), fcntl.FD_CLOEXEC, 1)
+
+
+def set_nonblocking(fd):
+    """Puts the given file descriptor in non-blocking mode."""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def raise_fd_limit(wanted):
+    """Raises the soft limit on open files toward the given number.
+
+    The soft limit is never raised above the hard limit, and it is never
+    lowered.  Returns the resulting soft limit (or None if it is unknown).
+    """
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or soft >= wanted:
+        return soft
+    if hard != resource.RLIM_INFINITY:
+        wanted = min(wanted, hard)
+    if wanted > soft:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+            soft = wanted
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+def write_chunks(fd, chunks):
+    """Writes all of the chunks to fd, using writev where available.
+
+    Returns a pair (bytes, calls): the number of bytes written and the
+    number of write calls made, including retries after partial writes.
+    """
+    total = 0
+    calls = 0
+    for i in range(0, len(chunks), IOV_MAX):
+        group = chunks[i:i + IOV_MAX]
+        if HAVE_WRITEV:
+            size = sum([len(chunk) for chunk in group])
+            written = os.writev(fd, group)
+            calls += 1
+            left = size
+            while written < left:
+                # Drop the chunks that were written and retry the rest.
+                left -= written
+                while written >= len(group[0]):
+                    written -= len(group.pop(0))
+                group[0] = group[0][written:]
+                written = os.writev(fd, group)
+                calls += 1
+        else:
+            data = bytes().join(group)
+            size = len(data)
+            written = os.write(fd, data)
+            calls += 1
+            while written < len(data):
+                data = data[written:]
+                written = os.write(fd, data)
+                calls += 1
+        total += size
+    return total, calls
+
+
+class LineSplitter(object):
+    """Splits a stream of bytes into lines.
+
+    The split method returns the complete lines (with their newlines) in a
+    chunk, and keeps any partial line until the rest of it arrives, so
+    lines that cross chunk boundaries come out whole.
+    """
+    NEWLINE = '\n'.encode('ascii')
+
+    def __init__(self):
+        # Pieces of the partial line, kept as a list so that a long line
+        # that spans many chunks isn't copied over and over.
+        self.partial = []
+
+    def split(self, data):
+        """Returns a list of the lines completed by data."""
+        end = data.rfind(self.NEWLINE) + 1
+        if not end:
+            if data:
+                self.partial.append(data)
+            return []
+        newline = self.NEWLINE
+        lines = [line + newline for line in data[:end - 1].split(newline)]
+        if self.partial:
+            self.partial.append(lines[0])
+            lines[0] = bytes().join(self.partial)
+            self.partial = []
+        if end < len(data):
+            self.partial.append(data[end:])
+        return lines
+
+    def rest(self):
+        """Returns (and forgets) the partial line, or None if there is none."""
+        if not self.partial:
+            return None
+        rest = bytes().join(self.partial)
+        self.partial = []
+        return rest
@@ -0,0 +1,199 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""Fleet-wide reducers over the output of all hosts (pssh --reduce).
+
+A reducer sees every line of standard output, from every host, as it
+arrives, and produces one result when the run is complete, so no output has
+to be buffered per host.  A reducer is any object with these methods:
+
+    add(host, line): called for each line (a string without its newline)
+    result(): returns the result as a string
+
+Reducers are chosen with a spec: one of the built-in names below, with an
+optional 1-based whitespace-separated field number (the default is 1), or
+"module:callable", where the callable (such as a class) takes no arguments
+and returns a reducer.
+
+    sum[:FIELD]     total of the numbers in the field
+    min[:FIELD]     smallest number in the field, and the host it came from
+    max[:FIELD]     largest number in the field, and the host it came from
+    count           number of lines
+    hist[:FIELD]    number of lines with each distinct value of the field
+
+A field is read as a number if it starts with one, so "85%" counts as 85.
+Lines without a number in the field are skipped.
+"""
+
+import re
+
+_NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+
+def format_number(value):
+    """Formats a float without a fractional part like an integer."""
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class FieldReducer(object):
+    """Base class for reducers over one field of each line."""
+    name = None
+
+    def __init__(self, field=1):
+        self.field = field
+        self.values = 0
+        self.skipped = 0
+
+    def get_field(self, line):
+        """Returns the field of the line, or None if it has too few."""
+        fields = line.split()
+        if len(fields) < self.field:
+            return None
+        return fields[self.field - 1]
+
+    def get_number(self, line):
+        """Returns the number in the field of the line, or None."""
+        field = self.get_field(line)
+        if field is not None:
+            match = _NUMBER.match(field)
+            if match:
+                self.values += 1
+                return float(match.group())
+        self.skipped += 1
+        return None
+
+    def summary(self):
+        return '%s values, %s lines skipped' % (self.values, self.skipped)
+
+
+class SumReducer(FieldReducer):
+    name = 'sum'
+
+    def __init__(self, field=1):
+        FieldReducer.__init__(self, field)
+        self.total = 0.0
+
+    def add(self, host, line):
+        value = self.get_number(line)
+        if value is not None:
+            self.total += value
+
+    def result(self):
+        return '%s (%s)' % (format_number(self.total), self.summary())
+
+
+class MaxReducer(FieldReducer):
+    name = 'max'
+
+    def __init__(self, field=1):
+        FieldReducer.__init__(self, field)
+        self.best = None
+        self.host = None
+
+    def better(self, value):
+        return value > self.best
+
+    def add(self, host, line):
+        value = self.get_number(line)
+        if value is not None and (self.best is None or self.better(value)):
+            self.best = value
+            self.host = host
+
+    def result(self):
+        if self.best is None:
+            return 'no values (%s)' % self.summary()
+        return '%s on %s (%s)' % (format_number(self.best), self.host,
+                self.summary())
+
+
+class MinReducer(MaxReducer):
+    name = 'min'
+
+    def better(self, value):
+        return value < self.best
+
+
+class CountReducer(object):
+    name = 'count'
+
+    def __init__(self):
+        self.count = 0
+
+    def add(self, host, line):
+        self.count += 1
+
+    def result(self):
+        return '%s lines' % self.count
+
+
+class HistReducer(FieldReducer):
+    name = 'hist'
+
+    def __init__(self, field=1):
+        FieldReducer.__init__(self, field)
+        self.counts = {}
+
+    def add(self, host, line):
+        value = self.get_field(line)
+        if value is None:
+            self.skipped += 1
+            return
+        self.values += 1
+        self.counts[value] = self.counts.get(value, 0) + 1
+
+    def result(self):
+        items = sorted(self.counts.items(), key=lambda item: (-item[1],
+            item[0]))
+        lines = ['%s distinct values (%s)' % (len(items), self.summary())]
+        for value, count in items:
+            lines.append('%8d %s' % (count, value))
+        return '\n'.join(lines)
+
+
+REDUCERS = {}
+for _reducer in (SumReducer, MaxReducer, MinReducer, CountReducer,
+        HistReducer):
+    REDUCERS[_reducer.name] = _reducer
+
+
+def parse_spec(spec):
+    """Checks a reducer spec without creating the reducer.
+
+    Returns a pair (factory, args), where factory(*args) creates the
+    reducer.  Raises ValueError if the spec is invalid.
+    """
+    name, _, arg = spec.partition(':')
+    if name in REDUCERS:
+        cls = REDUCERS[name]
+        if cls is CountReducer:
+            if arg:
+                raise ValueError('the count reducer takes no field')
+            return cls, ()
+        if not arg:
+            return cls, ()
+        try:
+            field = int(arg)
+        except ValueError:
+            field = 0
+        if field < 1:
+            raise ValueError('invalid field %r for %s' % (arg, name))
+        return cls, (field,)
+    if not arg:
+        raise ValueError('unknown reducer %r (built-in: %s; or '
+                'module:callable)' % (name, ', '.join(sorted(REDUCERS))))
+    try:
+        module = __import__(name, {}, {}, [arg])
+        factory = getattr(module, arg)
+    except (ImportError, AttributeError):
+        raise ValueError('cannot find %s' % spec)
+    return factory, ()
+
+
+def get_reducer(spec):
+    """Creates a reducer from a spec like "sum:2" or "mymodule:Reducer".
+
+    Raises ValueError if the spec is invalid.
+    """
+    factory, args = parse_spec(spec)
+    return factory(*args)
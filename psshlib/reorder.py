@@ -0,0 +1,110 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""Reordering of host reports into host-file order (pssh --ordered).
+
+Tasks finish in any order, but each is numbered in the order its host was
+read.  A report that arrives before those of all earlier hosts is held in a
+ReorderBuffer until it can be written.  Held reports are kept in memory up
+to a limit, and beyond that in a temporary file, so a slow early host does
+not make pssh hold the output of the whole fleet in memory.
+"""
+
+import os
+import tempfile
+
+DEFAULT_LIMIT = 1 << 26
+COPY_SIZE = 1 << 16
+
+
+class ReorderBuffer(object):
+    """Writes numbered reports to a stream in order.
+
+    Arguments:
+        stream: Binary stream that receives the reports.
+        limit: Bytes of held reports to keep in memory before spilling.
+    """
+    def __init__(self, stream, limit=DEFAULT_LIMIT):
+        self.stream = stream
+        self.limit = limit
+        self.next = 0
+        # Held reports by number: bytes, or (offset, length) in the spill
+        # file.
+        self.held = {}
+        self.size = 0
+        self.spillfile = None
+        self.spilled = 0
+        # Number of held reports in the spill file.
+        self.spillcount = 0
+
+    def is_next(self, number):
+        """Finds whether the report with the given number can be written now.
+
+        If so, the caller writes it to the stream and then calls written().
+        """
+        return number == self.next
+
+    def written(self):
+        """Records that the next report was written directly to the stream."""
+        self.next += 1
+        self._release()
+        self.stream.flush()
+
+    def add(self, number, data):
+        """Adds the report with the given number.
+
+        The report is written right away if every earlier report has been
+        written; otherwise it is held.
+        """
+        if number != self.next:
+            self._hold(number, data)
+            return
+        self.stream.write(data)
+        self.next += 1
+        self._release()
+        self.stream.flush()
+
+    def _hold(self, number, data):
+        if self.size + len(data) <= self.limit:
+            self.held[number] = data
+            self.size += len(data)
+            return
+        if self.spillfile is None:
+            self.spillfile = tempfile.TemporaryFile(prefix='pssh.')
+        self.spillfile.seek(0, os.SEEK_END)
+        offset = self.spillfile.tell()
+        self.spillfile.write(data)
+        self.held[number] = (offset, len(data))
+        self.spilled += len(data)
+        self.spillcount += 1
+
+    def _release(self):
+        """Writes the held reports that are next in order."""
+        while self.next in self.held:
+            self._emit(self.held.pop(self.next))
+            self.next += 1
+
+    def _emit(self, entry):
+        if not isinstance(entry, tuple):
+            self.size -= len(entry)
+            self.stream.write(entry)
+            return
+        offset, length = entry
+        self.spillfile.seek(offset)
+        while length > 0:
+            chunk = self.spillfile.read(min(length, COPY_SIZE))
+            length -= len(chunk)
+            self.stream.write(chunk)
+        self.spillcount -= 1
+        if not self.spillcount:
+            # Every spilled report has been written, so start over.
+            self.spillfile.seek(0)
+            self.spillfile.truncate()
+
+    def finish(self):
+        """Writes any held reports, skipping numbers that never arrived."""
+        for number in sorted(self.held):
+            self._emit(self.held.pop(number))
+        self.stream.flush()
+        if self.spillfile:
+            self.spillfile.close()
+            self.spillfile = None
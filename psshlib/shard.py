@@ -0,0 +1,545 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""Sharded execution over several worker processes (--workers).
+
+A single Manager runs on one core, which limits how many hosts it can
+drive at once.  With --workers=N, the ShardedManager forks N worker
+processes, each with its own event loop and its own share of the -p limit,
+and becomes their coordinator: it takes Tasks from the host stream as the
+workers have room for them, numbers them, and sends each one to a worker.
+The workers run the Tasks (writing any -o and -e files themselves) and send
+back the lines printed with -P and a message for each finished Task, so the
+coordinator prints every report, with the usual [n] counters, ordering, and
+--coalesce and --json output, as if it had run the Tasks itself.
+
+Messages in both directions are pickled tuples, each preceded by its length
+as a 4-byte integer.  Input for the commands (the same bytes for every host)
+is sent to each worker once, not with every Task.
+"""
+
+from collections import deque
+from errno import EAGAIN, EINTR, EPIPE
+import copy
+import os
+import pickle
+import signal
+import struct
+import sys
+import traceback
+
+from psshlib.buffer import OutputBuffer
+from psshlib.manager import Manager, READ_SIZE, forget_signal_handlers
+from psshlib import psshutil
+from psshlib.task import Task
+
+_HEADER = struct.Struct('!I')
+
+
+def frame(message):
+    """Returns the bytes that carry a message over a pipe."""
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(len(data)) + data
+
+
+class FrameReader(object):
+    """Collects framed messages from the chunks read from a pipe."""
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Adds data and returns a list of the messages it completed."""
+        buffer = self.buffer
+        buffer += data
+        messages = []
+        start = 0
+        while len(buffer) - start >= _HEADER.size:
+            size, = _HEADER.unpack_from(buffer, start)
+            end = start + _HEADER.size + size
+            if len(buffer) < end:
+                break
+            messages.append(pickle.loads(bytes(buffer[start +
+                _HEADER.size:end])))
+            start = end
+        del buffer[:start]
+        return messages
+
+
+def write_all(fd, data):
+    """Writes all of data to a blocking file descriptor."""
+    view = memoryview(data)
+    while view:
+        try:
+            count = os.write(fd, view)
+        except (OSError, IOError):
+            _, e, _ = sys.exc_info()
+            if e.errno == EINTR:
+                continue
+            raise
+        view = view[count:]
+
+
+class _Digest(object):
+    """Holds a digest computed in a worker, like a finished hashlib object."""
+    def __init__(self, value):
+        self.value = value
+
+    def digest(self):
+        return self.value
+
+
+class RemoteTask(object):
+    """The coordinator's stand-in for a Task that ran in a worker.
+
+    It has what Manager.finished and the Coalescer use: the host, the
+    failures, the buffered output, the digests, and report() and result().
+    """
+    def __init__(self, result, nodenum, inline, outdata, errdata,
+            digests):
+        self.host = result.host
+        self.port = result.port
+        self.nodenum = nodenum
+        self.failures = list(result.failures)
+        self.inline = inline
+        self.outfilter = result.matches is not None
+        self.outputbuffer = OutputBuffer()
+        self.errorbuffer = OutputBuffer()
+        if outdata:
+            self.outputbuffer.append(outdata)
+        if errdata:
+            self.errorbuffer.append(errdata)
+        if digests:
+            self.outhash = _Digest(digests[0])
+            self.errhash = _Digest(digests[1])
+        self._result = result
+
+    # Reports are printed exactly as for a local Task.
+    report = Task.__dict__['report']
+
+    def matches(self):
+        return self._result.matches
+
+    def result(self):
+        return self._result
+
+    def release(self):
+        if self.outputbuffer:
+            self.outputbuffer.close()
+        if self.errorbuffer:
+            self.errorbuffer.close()
+        self.outputbuffer = None
+        self.errorbuffer = None
+
+
+class PrinterProxy(object):
+    """Stands in for the Printer in a worker, sending -P lines onward.
+
+    Lines are collected until the worker's loop flushes them, like the
+    Printer's.  The writes to the coordinator block when it falls behind,
+    which holds back the worker's reads from its processes.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.buffer = bytearray()
+
+    def write_lines(self, prefix, lines):
+        buffer = self.buffer
+        for line in lines:
+            buffer += prefix
+            buffer += line
+
+    def full(self):
+        return False
+
+    def wait(self, callback):
+        callback()
+
+    def flush(self):
+        if self.buffer:
+            write_all(self.fd, frame(('lines', bytes(self.buffer))))
+            self.buffer = bytearray()
+
+    drain = flush
+
+
+class WorkerManager(Manager):
+    """Runs the Tasks that the coordinator sends to one worker process."""
+    def __init__(self, opts, taskfd, resultfd, askpass_socket):
+        Manager.__init__(self, opts)
+        self.opts = opts
+        self.taskfd = taskfd
+        self.resultfd = resultfd
+        self.askpass_socket = askpass_socket
+        self.frames = FrameReader()
+        self.eof = False
+        self.stdin = None
+        # The coordinator prints, reorders, and coalesces the reports.
+        self.quiet = True
+        self.coalescer = None
+        if self.printer:
+            self.printer = PrinterProxy(resultfd)
+        self.inline = bool(getattr(opts, 'inline', False))
+        self.coalesce = bool(getattr(opts, 'coalesce', False))
+
+    def work(self):
+        """Runs Tasks until the coordinator has no more to send."""
+        psshutil.set_nonblocking(self.taskfd)
+        self.iomap.register_read(self.taskfd, self.handle_tasks)
+        try:
+            self.start()
+            try:
+                while True:
+                    if self.running or self.pending():
+                        self.step()
+                    elif self.eof:
+                        break
+                    else:
+                        # Wait for the coordinator to send more Tasks.
+                        self.iomap.poll()
+                        self.update_tasks(self.writer)
+            except KeyboardInterrupt:
+                self.interrupted()
+        except KeyboardInterrupt:
+            pass
+        self.finish()
+
+    def handle_tasks(self, fd, iomap):
+        """Called when the coordinator has sent Tasks."""
+        try:
+            data = os.read(fd, READ_SIZE)
+        except (OSError, IOError):
+            _, e, _ = sys.exc_info()
+            if e.errno in (EINTR, EAGAIN):
+                return
+            data = None
+        if not data:
+            iomap.unregister(fd)
+            self.eof = True
+            return
+        for message in self.frames.feed(data):
+            if message[0] == 'stdin':
+                self.stdin = message[1]
+                continue
+            _, nodenum, host, port, user, cmd, has_stdin = message
+            if has_stdin:
+                stdin = self.stdin
+            else:
+                stdin = None
+            task = Task(host, port, user, cmd, self.opts, stdin)
+            task.nodenum = nodenum
+            self.add_task(task)
+
+    def finished(self, task):
+        """Sends the Result and any buffered output to the coordinator."""
+        if self.printer:
+            # The task's lines must arrive before its report.
+            self.printer.drain()
+        outdata = errdata = digests = None
+        if self.inline or self.coalesce:
+            outdata = task.outputbuffer.getvalue()
+            errdata = task.errorbuffer.getvalue()
+        if self.coalesce:
+            digests = (task.outhash.digest(), task.errhash.digest())
+        write_all(self.resultfd, frame(('done', task.nodenum, task.result(),
+            outdata, errdata, digests)))
+        task.release()
+
+
+class Worker(object):
+    """The coordinator's end of one worker process."""
+    def __init__(self, pid, taskfd, resultfd, share):
+        self.pid = pid
+        self.taskfd = taskfd
+        self.resultfd = resultfd
+        self.share = share
+        # Queued (nodenum, task, data) messages, and the number of bytes of
+        # the first one that have been written.
+        self.queue = deque()
+        self.offset = 0
+        self.frames = FrameReader()
+        # Tasks given to the worker that have not finished, by nodenum.
+        self.assigned = {}
+        # The InputStream last sent, so each worker gets it only once.
+        self.stdin = None
+        self.closing = False
+
+
+class ShardedManager(Manager):
+    """Coordinates worker processes that each run a share of the Tasks.
+
+    The Tasks are added as for a Manager.  Their processes never run in the
+    coordinator: only their host, port, user, command, and input are sent
+    to a worker.  Input must be complete bytes (or an InputStream made with
+    from_bytes), so -I is not supported, and neither are --reduce and
+    --store.  The workers use the default engine.  Raises ValueError if the
+    options ask for any of these (see check_options).
+    """
+    def __init__(self, opts):
+        check_options(opts)
+        Manager.__init__(self, opts)
+        self.opts = opts
+        self.nworkers = max(1, min(opts.workers, self.limit))
+        # The workers' ssh processes get the password from the coordinator's
+        # PasswordServer.
+        self.askpass_mode = 'program'
+        # The workers write the output files.
+        self.outdir = self.errdir = self.store = None
+        self.inline = bool(getattr(opts, 'inline', False))
+        self.workers = []
+        self.paused = False
+
+    def worker_opts(self, share):
+        """Returns the options for a worker with the given -p share."""
+        opts = copy.copy(self.opts)
+        opts.par = share
+        # The workers share the limit on open output files.
+        opts.max_open_files = max(1, self.max_open_files // self.nworkers)
+        opts.workers = None
+        opts.askpass = False
+        opts.json = None
+        opts.ordered = False
+        opts.reduce = None
+        return opts
+
+    def run(self):
+        """Runs the Tasks in the workers and reports them as they finish."""
+        try:
+            self.prepare()
+            self.start_workers()
+            try:
+                self.dispatch()
+                while self.workers:
+                    self.iomap.poll()
+                    self.dispatch()
+                    if self.printer:
+                        self.printer.flush()
+            except KeyboardInterrupt:
+                self.interrupted()
+        except KeyboardInterrupt:
+            pass
+        self.finish()
+
+    def start_workers(self):
+        """Forks the worker processes."""
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for i in range(self.nworkers):
+            share = self.limit // self.nworkers
+            if i < self.limit % self.nworkers:
+                share += 1
+            task_read, task_write = os.pipe()
+            result_read, result_write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                self._worker_main(share, task_read, result_write)
+            os.close(task_read)
+            os.close(result_write)
+            psshutil.set_nonblocking(task_write)
+            worker = Worker(pid, task_write, result_read, share)
+            self.workers.append(worker)
+            self.iomap.register_read(result_read, self.handle_results)
+
+    def _worker_main(self, share, taskfd, resultfd):
+        """Runs in the worker process, and never returns."""
+        status = 0
+        try:
+            # The coordinator relays interrupts with SIGTERM.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, _raise_interrupt)
+            # Drop what belongs to the coordinator: its signal handling, its
+            # IOMap, PasswordServer, and output files, and the other
+            # workers' pipes, which must reach EOF when the coordinator
+            # closes them, whatever this worker is doing.
+            forget_signal_handlers()
+            close_fds((taskfd, resultfd))
+            manager = WorkerManager(self.worker_opts(share), taskfd,
+                    resultfd, self.askpass_socket)
+            manager.work()
+        except:
+            _, e, _ = sys.exc_info()
+            # EPIPE means that the coordinator is gone (for example, pssh
+            # was piped into head, which exited), so there is nobody left to
+            # report to.
+            if getattr(e, 'errno', None) != EPIPE:
+                traceback.print_exc()
+            status = 1
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except (IOError, OSError):
+            pass
+        finally:
+            # Skip the coordinator's cleanup, such as its PasswordServer's.
+            os._exit(status)
+
+    def dispatch(self):
+        """Sends Tasks to the workers that have room for them."""
+        for worker in self.workers:
+            while not worker.closing and len(worker.assigned) < worker.share:
+                task = self._next_task()
+                if task is None:
+                    # No more Tasks: let every worker finish.
+                    for worker in self.workers:
+                        if not worker.closing:
+                            worker.closing = True
+                            self._send(worker)
+                    return
+                self.assign(worker, task)
+            self._send(worker)
+
+    def assign(self, worker, task):
+        """Numbers a Task and queues it for the worker."""
+        nodenum = self.taskcount
+        self.taskcount += 1
+        worker.assigned[nodenum] = task
+        stdin = task.inputstream
+        if stdin and stdin is not worker.stdin:
+            if stdin.fd is not None:
+                raise ValueError('input cannot be streamed to workers')
+            worker.stdin = stdin
+            data = bytes().join([bytes(chunk) for chunk in stdin.chunks])
+            worker.queue.append((None, None, frame(('stdin', data))))
+        message = ('task', nodenum, task.host, task.port, task.user, task.cmd,
+                bool(stdin))
+        worker.queue.append((nodenum, task, frame(message)))
+
+    def _send(self, worker):
+        """Writes queued Tasks without blocking; closes the pipe when done."""
+        queue = worker.queue
+        if queue:
+            data = bytes().join([entry[2] for entry in queue])
+            try:
+                count = os.write(worker.taskfd,
+                        memoryview(data)[worker.offset:])
+            except (OSError, IOError):
+                _, e, _ = sys.exc_info()
+                if e.errno not in (EINTR, EAGAIN):
+                    raise
+                count = 0
+            count += worker.offset
+            while queue and count >= len(queue[0][2]):
+                count -= len(queue.popleft()[2])
+            worker.offset = count
+        if queue:
+            self.iomap.register_write(worker.taskfd, self.handle_send)
+        elif worker.closing and worker.taskfd is not None:
+            self.iomap.unregister(worker.taskfd)
+            os.close(worker.taskfd)
+            worker.taskfd = None
+
+    def handle_send(self, fd, iomap):
+        """Called when a worker's task pipe is ready for writing."""
+        for worker in self.workers:
+            if worker.taskfd == fd:
+                iomap.unregister(fd)
+                self._send(worker)
+
+    def handle_results(self, fd, iomap):
+        """Called when a worker has sent output or finished Tasks."""
+        for worker in self.workers:
+            if worker.resultfd == fd:
+                break
+        try:
+            data = os.read(fd, READ_SIZE)
+        except (OSError, IOError):
+            _, e, _ = sys.exc_info()
+            if e.errno in (EINTR, EAGAIN):
+                return
+            data = None
+        if not data:
+            self.worker_exited(worker)
+            return
+        for message in worker.frames.feed(data):
+            if message[0] == 'lines':
+                self.printer.write_lines(bytes(), [message[1]])
+            else:
+                _, nodenum, result, outdata, errdata, digests = message
+                del worker.assigned[nodenum]
+                self.finished(RemoteTask(result, nodenum, self.inline,
+                    outdata, errdata, digests))
+        if self.printer and self.printer.full() and not self.paused:
+            # Stop reading from the workers until the printer catches up.
+            self.paused = True
+            for worker in self.workers:
+                iomap.unregister(worker.resultfd)
+            self.printer.wait(self.resume)
+
+    def resume(self):
+        """Called by the Printer when it has room for more output."""
+        if self.paused:
+            self.paused = False
+            for worker in self.workers:
+                self.iomap.register_read(worker.resultfd, self.handle_results)
+
+    def worker_exited(self, worker):
+        """Cleans up after a worker closes its result pipe."""
+        self.iomap.unregister(worker.resultfd)
+        os.close(worker.resultfd)
+        if worker.taskfd is not None:
+            self.iomap.unregister(worker.taskfd)
+            os.close(worker.taskfd)
+            worker.taskfd = None
+        os.waitpid(worker.pid, 0)
+        self.workers.remove(worker)
+        # Any Tasks that the worker did not report are lost.
+        for nodenum in sorted(worker.assigned):
+            task = worker.assigned[nodenum]
+            task.failures.append('Worker exited')
+            task.nodenum = nodenum
+            self.finished(task)
+        worker.assigned = {}
+
+    def interrupted(self):
+        """Stops the workers, reports what they ran, and cancels the rest."""
+        for worker in self.workers:
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except OSError:
+                pass
+            worker.closing = True
+            # Tasks that were not (completely) sent are cancelled here.
+            queue, worker.queue = worker.queue, deque()
+            for nodenum, task, _ in queue:
+                if task:
+                    del worker.assigned[nodenum]
+                    task.cancel()
+                    task.nodenum = nodenum
+                    self.finished(task)
+        self.cancel_pending()
+        # Collect the reports of the interrupted Tasks.
+        while self.workers:
+            self.iomap.poll()
+            if self.printer:
+                self.printer.flush()
+
+
+def check_options(opts):
+    """Raises ValueError if the options can't be used with --workers."""
+    for name, option in (('send_input', '-I'), ('reduce', '--reduce'),
+            ('store', '--store')):
+        if getattr(opts, name, None):
+            raise ValueError('The %s option cannot be used with --workers.'
+                    % option)
+    if getattr(opts, 'engine', None) == 'asyncio':
+        raise ValueError('The --engine=asyncio option cannot be used with '
+                '--workers.')
+
+
+def close_fds(keep):
+    """Closes every file descriptor but stdin, stdout, stderr, and keep."""
+    try:
+        maxfd = os.sysconf('SC_OPEN_MAX')
+    except (AttributeError, ValueError, OSError):
+        maxfd = -1
+    if maxfd < 0:
+        maxfd = 1024
+    low = 3
+    for fd in sorted(keep):
+        if fd >= low:
+            os.closerange(low, fd)
+            low = fd + 1
+    os.closerange(low, maxfd)
+
+
+def _raise_interrupt(number, frame):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
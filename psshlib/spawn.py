@@ -0,0 +1,127 @@
+# Copyright (c) 2009, Andrew McNabb
+
+"""Starts child processes for Tasks as cheaply as possible.
+
+Where os.posix_spawnp is available (Python 3.8+), children are created with
+posix_spawn, which the C library implements with vfork or clone, so the cost
+of starting a child does not grow with the memory size of pssh.  Children are
+started in a new session without running any Python code in the child.
+Otherwise, subprocess.Popen is used.
+
+A child may also be given a controlling terminal (the slave side of a pty),
+which is where ssh prompts for passwords.
+"""
+
+import os
+import signal
+from subprocess import Popen, PIPE
+import sys
+
+HAVE_POSIX_SPAWN = (hasattr(os, 'posix_spawnp')
+        and hasattr(os, 'POSIX_SPAWN_DUP2'))
+
+# Python ignores these signals, and ignored signals stay ignored across exec,
+# so they are reset in children (as Popen's restore_signals does).
+RESTORED_SIGNALS = tuple(getattr(signal, name)
+        for name in ('SIGPIPE', 'SIGXFZ', 'SIGXFSZ')
+        if hasattr(signal, name))
+
+
+class Process(object):
+    """A child process started with posix_spawn.
+
+    Provides the subset of the subprocess.Popen interface used by Task: the
+    pid, returncode, and stdin, stdout, and stderr attributes, and poll().
+    """
+    def __init__(self, pid, stdin, stdout, stderr):
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    def poll(self):
+        """Checks whether the process has exited and saves the return code."""
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                if os.WIFSIGNALED(status):
+                    self.returncode = -os.WTERMSIG(status)
+                else:
+                    self.returncode = os.WEXITSTATUS(status)
+        return self.returncode
+
+
+def spawn(cmd, env, tty=None):
+    """Starts cmd in a new session with pipes for its standard streams.
+
+    If tty (the path of a terminal) is given, it becomes the controlling
+    terminal of the new session; the standard streams are still pipes.
+    Returns a Process or Popen object.  Since pssh carefully calls
+    set_cloexec() on all open files, no other file descriptors need to be
+    closed in the child.
+    """
+    if HAVE_POSIX_SPAWN:
+        proc = _posix_spawn(cmd, env, tty)
+        if proc:
+            return proc
+    if tty:
+        return Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                close_fds=False, preexec_fn=_session_with_tty(tty), env=env)
+    if sys.version_info >= (3, 2):
+        return Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                close_fds=False, start_new_session=True, env=env)
+    else:
+        return Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                close_fds=False, preexec_fn=os.setsid, env=env)
+
+
+def _session_with_tty(tty):
+    """Returns a preexec_fn that starts a session controlled by tty."""
+    def preexec():
+        os.setsid()
+        # A session leader acquires the first terminal that it opens.
+        os.close(os.open(tty, os.O_RDWR))
+    return preexec
+
+
+def _posix_spawn(cmd, env, tty=None):
+    """Starts cmd with posix_spawnp, or returns None if it can't be used."""
+    # The pipes from os.pipe are close-on-exec, and the copies made by dup2
+    # are not, so the child ends up with just its three standard streams.
+    stdin_read, stdin_write = os.pipe()
+    stdout_read, stdout_write = os.pipe()
+    stderr_read, stderr_write = os.pipe()
+    fds = (stdin_read, stdin_write, stdout_read, stdout_write, stderr_read,
+            stderr_write)
+    if min(fds) <= 2:
+        # Some standard stream is closed, so a pipe could be clobbered by
+        # the dup2 calls in the child.  Let subprocess sort it out.
+        for fd in fds:
+            os.close(fd)
+        return None
+
+    file_actions = [(os.POSIX_SPAWN_DUP2, stdin_read, 0),
+            (os.POSIX_SPAWN_DUP2, stdout_write, 1),
+            (os.POSIX_SPAWN_DUP2, stderr_write, 2)]
+    if tty:
+        # The C library calls setsid before the file actions, so opening
+        # the terminal makes it the controlling terminal, which stays after
+        # the descriptor is closed.
+        spare = max(fds) + 1
+        file_actions.append((os.POSIX_SPAWN_OPEN, spare, tty, os.O_RDWR, 0))
+        file_actions.append((os.POSIX_SPAWN_CLOSE, spare))
+    try:
+        pid = os.posix_spawnp(cmd[0], cmd, env, file_actions=file_actions,
+                setsid=True, setsigdef=RESTORED_SIGNALS)
+    except:
+        os.close(stdin_write)
+        os.close(stdout_read)
+        os.close(stderr_read)
+        raise
+    finally:
+        os.close(stdin_read)
+        os.close(stdout_write)
+        os.close(stderr_write)
+    return Process(pid, os.fdopen(stdin_write, 'wb', 0),
+            os.fdopen(stdout_read, 'rb', 0), os.fdopen(stderr_read, 'rb', 0))
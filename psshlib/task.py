@@ -1,8 +1,9 @@
 # Copyright (c) 2009, Andrew McNabb
 
-from errno import EINTR
-from subprocess import Popen, PIPE
+from errno import EAGAIN, EINTR, EINVAL
+import hashlib
 import os
+import re
 import signal
 import sys
 import time
@@ -10,21 +11,184 @@ import traceback
 
 from psshlib import askpass_client
 from psshlib import color
+from psshlib.buffer import Capture, OutputBuffer
+from psshlib.instream import InputStream
+from psshlib import linefilter
+from psshlib import psshutil
+from psshlib import spawn
 
 BUFFER_SIZE = 1 << 16
 
-try:
-    bytes
-except NameError:
-    bytes = str
+# Linux's splice(2), available in Python 3.10 and later.
+HAVE_SPLICE = hasattr(os, 'splice')
+
+# The most output and error files open at once, unless --max-open-files is
+# given.
+DEFAULT_MAX_OPEN_FILES = 256
+
+# A prompt that ssh writes to its terminal to ask for a password, such as
+# "user@host's password: " or "Enter passphrase for key '...': ".
+PASSWORD_PROMPT = re.compile(br'(password|passphrase)[^\n]*:\s*$', re.I)
+# The most terminal output kept for matching a prompt.
+PROMPT_SIZE = 1024
+
+
+def splice_enabled(opts):
+    """Finds whether Tasks with these options splice output into files.
+
+    Splicing moves data from the pipes straight into the files in the
+    --outdir and --errdir without copying it into Python, so it is only used
+    when nothing else needs to see the output.  Each running task keeps its
+    own files open, so it is also only used when they fit within the
+    --max-open-files limit.
+    """
+    if not HAVE_SPLICE:
+        return False
+    if getattr(opts, 'store', None) or getattr(opts, 'compress_output', None):
+        return False
+    files = (bool(getattr(opts, 'outdir', None))
+            + bool(getattr(opts, 'errdir', None)))
+    if not files:
+        return False
+    max_open_files = (getattr(opts, 'max_open_files', None)
+            or DEFAULT_MAX_OPEN_FILES)
+    if files * opts.par > max_open_files:
+        return False
+    return not (getattr(opts, 'inline', False)
+            or getattr(opts, 'print_out', False)
+            or getattr(opts, 'coalesce', False)
+            or getattr(opts, 'reduce', None)
+            or getattr(opts, 'capture', None)
+            or linefilter.from_opts(opts))
+
+
+def splice_to_file(pipefd, filefd):
+    """Moves up to BUFFER_SIZE bytes from a pipe to a file.
+
+    Returns the number of bytes moved (0 at the end of the pipe).  Falls back
+    to read and write if the file system does not support splice.
+    """
+    try:
+        return os.splice(pipefd, filefd, BUFFER_SIZE)
+    except OSError:
+        _, e, _ = sys.exc_info()
+        if e.errno != EINVAL:
+            raise
+    buf = os.read(pipefd, BUFFER_SIZE)
+    view = memoryview(buf)
+    while view:
+        view = view[os.write(filefd, view):]
+    return len(buf)
+
+
+def open_output(filename):
+    """Creates an output file for splicing and returns its fd."""
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    flags |= getattr(os, 'O_CLOEXEC', 0)
+    return os.open(filename, flags, 438) # 0666
+
+
+def base_environ(askpass_socket=None):
+    """Creates the environment shared by every Task in a run.
+
+    Building it once lets each Task copy it and set only PSSH_NODENUM.
+    """
+    environ = dict(os.environ)
+    # Disable the GNOME pop-up password dialog and allow ssh to use
+    # askpass.py to get a provided password.  If the module file is
+    # askpass.pyc, we replace the extension.
+    environ['SSH_ASKPASS'] = askpass_client.executable_path()
+    if askpass_socket:
+        environ['PSSH_ASKPASS_SOCKET'] = askpass_socket
+    # Work around a mis-feature in ssh where it won't call SSH_ASKPASS
+    # if DISPLAY is unset.
+    if 'DISPLAY' not in environ:
+        environ['DISPLAY'] = 'pssh-gibberish'
+    return environ
+
+
+def format_status(n, host, port, failures, matches=None):
+    """Returns the status line of a report and the label for its stderr.
+
+    Both are colored if stdout supports it.  If matches is given, it is the
+    number of output lines kept by --include and --exclude.
+    """
+    error = ', '.join(failures)
+    tstamp = time.asctime().split()[3] # Current time
+    if color.has_colors(sys.stdout):
+        progress = color.c("[%s]" % color.B(n))
+        success = color.g("[%s]" % color.B("SUCCESS"))
+        failure = color.r("[%s]" % color.B("FAILURE"))
+        stderr = color.r("Stderr: ")
+        error = color.r(color.B(error))
+    else:
+        progress = "[%s]" % n
+        success = "[SUCCESS]"
+        failure = "[FAILURE]"
+        stderr = "Stderr: "
+    if port:
+        host = '%s:%s' % (host, port)
+    if matches is not None:
+        host = '%s (%s matching lines)' % (host, matches)
+    if failures:
+        status = ' '.join((progress, tstamp, failure, host, error))
+    else:
+        status = ' '.join((progress, tstamp, success, host))
+    return status, stderr
+
+
+class Result(object):
+    """A compact record of a finished Task.
+
+    The Manager keeps one of these per host instead of the Task itself, so
+    the process, buffers, and command of each Task can be freed as soon as
+    it is reported.  The outfile and errfile attributes name the files that
+    received the output (if any).  With the capture option, stdout and
+    stderr hold the start of the output (as bytes), and stdout_truncated and
+    stderr_truncated tell whether any was left out.
+    """
+    __slots__ = ('host', 'port', 'user', 'returncode', 'failures',
+            'starttime', 'endtime', 'outbytes', 'errbytes', 'outfile',
+            'errfile', 'matches', 'stdout', 'stderr', 'stdout_truncated',
+            'stderr_truncated')
+
+    def __init__(self, task):
+        self.host = task.host
+        self.port = task.port
+        self.user = task.user
+        self.returncode = task.returncode
+        self.failures = tuple(task.failures)
+        self.starttime = task.timestamp
+        self.endtime = time.time()
+        self.outbytes = task.outputbytes
+        self.errbytes = task.errorbytes
+        self.outfile = task.outpath
+        self.errfile = task.errpath
+        self.matches = task.matches()
+        if task.outcapture:
+            self.stdout = bytes(task.outcapture.data)
+            self.stdout_truncated = task.outcapture.truncated
+            self.stderr = bytes(task.errcapture.data)
+            self.stderr_truncated = task.errcapture.truncated
+        else:
+            self.stdout = self.stderr = None
+            self.stdout_truncated = self.stderr_truncated = False
+
+    def succeeded(self):
+        return not self.failures
 
 
 class Task(object):
-    """Starts a process and manages its input and output."""
+    """Starts a process and manages its input and output.
+
+    The stdin argument may be a bytes object or an InputStream shared with
+    other Tasks.
+    """
     def __init__(self, host, port, user, cmd, opts, stdin=None):
         self.host = host
         self.pretty_host = host
         self.port = port
+        self.user = user
         self.cmd = cmd
 
         if user != opts.user:
@@ -33,20 +197,42 @@ class Task(object):
             self.pretty_host = ':'.join((self.pretty_host, port))
 
         self.proc = None
+        self.pid = None
+        self.nodenum = None
+        self.returncode = None
         self.writer = None
+        self.iomap = None
         self.timestamp = None
         self.failures = []
         self.killed = False
-        self.inputbuffer = stdin
+        if stdin and not isinstance(stdin, InputStream):
+            stdin = InputStream.from_bytes(stdin)
+        self.inputstream = stdin
+        self.inputreader = None
+        self.stdin_paused = False
+        self.printer = None
+        self.reducer = None
+        self.splitter = None
+        self.printprefix = None
+        self.stdout_paused = False
         self.byteswritten = 0
-        self.outputbuffer = bytes()
-        self.errorbuffer = bytes()
+        self.outputbytes = 0
+        self.errorbytes = 0
 
         self.stdin = None
         self.stdout = None
         self.stderr = None
+        # The master and slave fds of the pty for --askpass-mode=pty.
+        self.tty = None
+        self.ttyslave = None
+        self.ttyoutput = None
+        self.password = None
         self.outfile = None
         self.errfile = None
+        self.outfd = None
+        self.errfd = None
+        self.outpath = None
+        self.errpath = None
 
         # Set options.
         self.verbose = opts.verbose
@@ -58,35 +244,66 @@ class Task(object):
             self.inline = bool(opts.inline)
         except AttributeError:
             self.inline = False
+        inline_limit = getattr(opts, 'inline_limit', None)
+        inline_spill = bool(getattr(opts, 'inline_spill', False))
+        self.outputbuffer = OutputBuffer(inline_limit, inline_spill)
+        self.errorbuffer = OutputBuffer(inline_limit, inline_spill)
+        # With coalesce, the output is buffered and hashed for a Coalescer.
+        self.coalesce = bool(getattr(opts, 'coalesce', False))
+        self.buffered = self.inline or self.coalesce
+        if self.coalesce:
+            self.outhash = hashlib.sha256()
+            self.errhash = hashlib.sha256()
+        else:
+            self.outhash = self.errhash = None
+        # With --include or --exclude, each stream is filtered line by line.
+        lines = linefilter.from_opts(opts)
+        if lines:
+            self.outfilter = linefilter.StreamFilter(lines)
+            self.errfilter = linefilter.StreamFilter(lines)
+        else:
+            self.outfilter = self.errfilter = None
+        # With capture (--json-output), the Result holds the start of each
+        # stream.
+        capture = getattr(opts, 'capture', None)
+        if capture:
+            self.outcapture = Capture(capture)
+            self.errcapture = Capture(capture)
+        else:
+            self.outcapture = self.errcapture = None
+        self.splice = splice_enabled(opts)
 
-    def start(self, nodenum, iomap, writer, askpass_socket=None):
-        """Starts the process and registers files with the IOMap."""
-        self.writer = writer
-
-        if writer:
-            self.outfile, self.errfile = writer.open_files(self.pretty_host)
+    def start(self, nodenum, iomap, writer, askpass_socket=None,
+            environ=None, printer=None, reducer=None, password=None):
+        """Starts the process and registers files with the IOMap.
 
-        # Set up the environment.
-        environ = dict(os.environ)
-        environ['PSSH_NODENUM'] = str(nodenum)
-        # Disable the GNOME pop-up password dialog and allow ssh to use
-        # askpass.py to get a provided password.  If the module file is
-        # askpass.pyc, we replace the extension.
-        environ['SSH_ASKPASS'] = askpass_client.executable_path()
-        if askpass_socket:
-            environ['PSSH_ASKPASS_SOCKET'] = askpass_socket
-        # Work around a mis-feature in ssh where it won't call SSH_ASKPASS
-        # if DISPLAY is unset.
-        if 'DISPLAY' not in environ:
-            environ['DISPLAY'] = 'pssh-gibberish'
-
-        # Create the subprocess.  Since we carefully call set_cloexec() on
-        # all open files, we specify close_fds=False.
-        self.proc = Popen(self.cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
-                close_fds=False, preexec_fn=os.setsid, env=environ)
+        The environ argument, if given, should come from base_environ().  The
+        printer (a psshlib.printer.Printer) is required for print_out.  If a
+        reducer (see psshlib.reduce) is given, it gets every line of stdout.
+        If a password (bytes) is given, the process gets a pty as its
+        controlling terminal, and the password is typed at each password
+        prompt that appears there.
+        """
+        environ = self.setup(nodenum, iomap, writer, askpass_socket, environ,
+                printer, reducer)
+        tty = None
+        if password is not None:
+            self.tty, self.ttyslave = os.openpty()
+            tty = os.ttyname(self.ttyslave)
+            self.ttyoutput = bytes()
+            self.password = password
+        try:
+            self.proc = spawn.spawn(self.cmd, environ, tty)
+        except:
+            self.close_tty(None)
+            raise
+        self.pid = self.proc.pid
         self.timestamp = time.time()
-        if self.inputbuffer:
+        if self.inputstream:
+            self.inputreader = self.inputstream.reader(iomap)
             self.stdin = self.proc.stdin
+            # A slow host must not block the writes to everyone else.
+            psshutil.set_nonblocking(self.stdin.fileno())
             iomap.register_write(self.stdin.fileno(), self.handle_stdin)
         else:
             self.proc.stdin.close()
@@ -94,6 +311,51 @@ class Task(object):
         iomap.register_read(self.stdout.fileno(), self.handle_stdout)
         self.stderr = self.proc.stderr
         iomap.register_read(self.stderr.fileno(), self.handle_stderr)
+        if self.tty is not None:
+            # The slave stays open here until the process exits, so that
+            # the master does not hang up while ssh has the terminal closed.
+            iomap.register_read(self.tty, self.handle_tty)
+
+    def setup(self, nodenum, iomap, writer, askpass_socket=None,
+            environ=None, printer=None, reducer=None):
+        """Prepares the output files and returns the process's environment.
+
+        This is the part of start() that does not depend on how the process
+        is run, so other engines (such as psshlib.aio) can share it.
+        """
+        self.nodenum = nodenum
+        self.writer = writer
+        self.iomap = iomap
+        if self.print_out:
+            self.printer = printer
+            self.printprefix = ('%s: ' % self.host).encode('utf-8')
+        self.reducer = reducer
+        if self.printer or self.reducer:
+            self.splitter = psshutil.LineSplitter()
+
+        if writer and self.splice:
+            # Output goes straight from the pipes to files of our own.
+            self.outpath, self.errpath = writer.filenames(self.pretty_host)
+            try:
+                if self.outpath:
+                    self.outfd = open_output(self.outpath)
+                if self.errpath:
+                    self.errfd = open_output(self.errpath)
+            except OSError:
+                # The output is discarded and the host reported as failed.
+                _, e, _ = sys.exc_info()
+                self.log_exception(e)
+        elif writer:
+            self.outfile, self.errfile = writer.open_files(self.pretty_host)
+            if not writer.store:
+                self.outpath, self.errpath = self.outfile, self.errfile
+
+        # Set up the environment.
+        if environ is None:
+            environ = base_environ(askpass_socket)
+        environ = dict(environ)
+        environ['PSSH_NODENUM'] = str(nodenum)
+        return environ
 
     def _kill(self):
         """Signals the process to terminate."""
@@ -118,68 +380,109 @@ class Task(object):
             self.failures.append('Interrupted')
 
     def cancel(self):
-        """Stops a task that has not started."""
-        self.failures.append('Cancelled')
+        """Stops the task, killing its process if it has started."""
+        if not self.killed:
+            self._kill()
+            self.failures.append('Cancelled')
 
     def elapsed(self):
         """Finds the time in seconds since the process was started."""
         return time.time() - self.timestamp
 
+    def exited(self, status):
+        """Saves the return code given the exit status from waitpid."""
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        # The process has been reaped, so keep subprocess from waiting on it.
+        self.proc.returncode = returncode
+        self.returned(returncode)
+
+    def returned(self, returncode):
+        """Saves the return code (negative for a signal) and any failure."""
+        self.returncode = returncode
+        if self.stdin_paused:
+            # Nobody is left to read the rest of the input.
+            self.close_stdin(self.iomap)
+        self.close_tty(self.iomap)
+        if self.returncode < 0:
+            message = 'Killed by signal %s' % (-self.returncode)
+            self.failures.append(message)
+        elif self.returncode > 0:
+            message = 'Exited with error code %s' % self.returncode
+            self.failures.append(message)
+
     def running(self):
-        """Finds if the process has terminated and saves the return code."""
+        """Finds if the process has not exited or its pipes are still open.
+
+        The return code must be supplied by exited() once the process has
+        been reaped.
+        """
         if self.stdin or self.stdout or self.stderr:
             return True
         if self.proc:
-            self.returncode = self.proc.poll()
             if self.returncode is None:
-                if self.killed:
-                    return False
-                else:
-                    return True
-            else:
-                if self.returncode < 0:
-                    message = 'Killed by signal %s' % (-self.returncode)
-                    self.failures.append(message)
-                elif self.returncode > 0:
-                    message = 'Exited with error code %s' % self.returncode
-                    self.failures.append(message)
-                self.proc = None
-                return False
+                return True
+            self.proc = None
+        return False
 
     def handle_stdin(self, fd, iomap):
         """Called when the process's standard input is ready for writing."""
         try:
-            start = self.byteswritten
-            if start < len(self.inputbuffer):
-                chunk = self.inputbuffer[start:start+BUFFER_SIZE]
-                self.byteswritten = start + os.write(fd, chunk)
-            else:
+            chunk = self.inputreader.peek()
+            if chunk is not None:
+                count = os.write(fd, chunk)
+                self.inputreader.advance(count)
+                self.byteswritten += count
+            elif self.inputreader.at_eof():
                 self.close_stdin(iomap)
+            else:
+                # Stop polling the pipe until more input has been read.
+                iomap.unregister(fd)
+                self.stdin_paused = True
+                self.inputreader.wait(self.resume_stdin)
         except (OSError, IOError):
             _, e, _ = sys.exc_info()
-            if e.errno != EINTR:
+            if e.errno not in (EINTR, EAGAIN):
                 self.close_stdin(iomap)
                 self.log_exception(e)
 
+    def resume_stdin(self):
+        """Called by the InputReader when more input is available."""
+        if self.stdin_paused and self.stdin:
+            self.stdin_paused = False
+            self.iomap.register_write(self.stdin.fileno(), self.handle_stdin)
+
     def close_stdin(self, iomap):
         if self.stdin:
             iomap.unregister(self.stdin.fileno())
             self.stdin.close()
             self.stdin = None
+            self.stdin_paused = False
+        if self.inputreader:
+            self.inputreader.close()
+            self.inputreader = None
+
+    def seal_input(self):
+        """Tells the input stream that no more Tasks will start reading it."""
+        if self.inputstream:
+            self.inputstream.seal()
 
     def handle_stdout(self, fd, iomap):
         """Called when the process's standard output is ready for reading."""
+        if self.outfd is not None:
+            self.splice_stream(fd, iomap, self.outfd)
+            return
         try:
             buf = os.read(fd, BUFFER_SIZE)
             if buf:
-                if self.inline:
-                    self.outputbuffer += buf
-                if self.outfile:
-                    self.writer.write(self.outfile, buf)
-                if self.print_out:
-                    sys.stdout.write('%s: %s' % (self.host, buf))
-                    if buf[-1] != '\n':
-                        sys.stdout.write('\n')
+                self.receive_stdout(buf)
+                if self.printer and self.printer.full():
+                    # Stop reading until the printer catches up.
+                    iomap.unregister(fd)
+                    self.stdout_paused = True
+                    self.printer.wait(self.resume_stdout)
             else:
                 self.close_stdout(iomap)
         except (OSError, IOError):
@@ -188,24 +491,80 @@ class Task(object):
                 self.close_stdout(iomap)
                 self.log_exception(e)
 
+    def receive_stdout(self, buf):
+        """Handles a chunk read from the process's standard output."""
+        self.outputbytes += len(buf)
+        if self.outfilter:
+            buf = self.outfilter.feed(buf)
+        if buf:
+            self.process_stdout(buf)
+
+    def process_stdout(self, buf):
+        """Buffers, writes, or prints a chunk of (filtered) stdout."""
+        if self.buffered:
+            self.outputbuffer.append(buf)
+        if self.outhash:
+            self.outhash.update(buf)
+        if self.outcapture:
+            self.outcapture.add(buf)
+        if self.outfile:
+            self.writer.write(self.outfile, buf)
+        if self.splitter:
+            lines = self.splitter.split(buf)
+            if lines:
+                self.handle_lines(lines)
+
+    def handle_lines(self, lines):
+        """Passes complete lines of stdout to the printer and reducer."""
+        if self.printer:
+            self.printer.write_lines(self.printprefix, lines)
+        if self.reducer:
+            try:
+                for line in lines:
+                    self.reducer.add(self.host,
+                            line[:-1].decode('utf-8', 'replace'))
+            except Exception:
+                # Keep going, but report the failure with this host.
+                _, e, _ = sys.exc_info()
+                self.log_exception(e)
+                self.reducer = None
+
+    def resume_stdout(self):
+        """Called by the Printer when it has room for more output."""
+        if self.stdout_paused and self.stdout:
+            self.stdout_paused = False
+            self.iomap.register_read(self.stdout.fileno(), self.handle_stdout)
+
     def close_stdout(self, iomap):
         if self.stdout:
             iomap.unregister(self.stdout.fileno())
             self.stdout.close()
             self.stdout = None
+            self.stdout_paused = False
+        if self.outfilter:
+            rest = self.outfilter.finish()
+            if rest:
+                self.process_stdout(rest)
+        if self.splitter:
+            rest = self.splitter.rest()
+            if rest:
+                self.handle_lines([rest + '\n'.encode('ascii')])
         if self.outfile:
             self.writer.close(self.outfile)
             self.outfile = None
+        if self.outfd is not None:
+            os.close(self.outfd)
+            self.outfd = None
 
     def handle_stderr(self, fd, iomap):
         """Called when the process's standard error is ready for reading."""
+        if self.errfd is not None:
+            self.splice_stream(fd, iomap, self.errfd)
+            return
         try:
             buf = os.read(fd, BUFFER_SIZE)
             if buf:
-                if self.inline:
-                    self.errorbuffer += buf
-                if self.errfile:
-                    self.writer.write(self.errfile, buf)
+                self.receive_stderr(buf)
             else:
                 self.close_stderr(iomap)
         except (OSError, IOError):
@@ -214,14 +573,126 @@ class Task(object):
                 self.close_stderr(iomap)
                 self.log_exception(e)
 
+    def receive_stderr(self, buf):
+        """Handles a chunk read from the process's standard error."""
+        self.errorbytes += len(buf)
+        if self.errfilter:
+            buf = self.errfilter.feed(buf)
+        if buf:
+            self.process_stderr(buf)
+
+    def process_stderr(self, buf):
+        """Buffers or writes a chunk of (filtered) stderr."""
+        if self.buffered:
+            self.errorbuffer.append(buf)
+        if self.errhash:
+            self.errhash.update(buf)
+        if self.errcapture:
+            self.errcapture.add(buf)
+        if self.errfile:
+            self.writer.write(self.errfile, buf)
+
     def close_stderr(self, iomap):
         if self.stderr:
             iomap.unregister(self.stderr.fileno())
             self.stderr.close()
             self.stderr = None
+        if self.errfilter:
+            rest = self.errfilter.finish()
+            if rest:
+                self.process_stderr(rest)
         if self.errfile:
             self.writer.close(self.errfile)
             self.errfile = None
+        if self.errfd is not None:
+            os.close(self.errfd)
+            self.errfd = None
+
+    def splice_stream(self, fd, iomap, filefd):
+        """Moves data from the stdout or stderr pipe into its output file."""
+        if filefd == self.outfd:
+            close = self.close_stdout
+        else:
+            close = self.close_stderr
+        try:
+            count = splice_to_file(fd, filefd)
+        except (OSError, IOError):
+            _, e, _ = sys.exc_info()
+            if e.errno not in (EINTR, EAGAIN):
+                close(iomap)
+                self.log_exception(e)
+            return
+        if not count:
+            close(iomap)
+        elif filefd == self.outfd:
+            self.outputbytes += count
+        else:
+            self.errorbytes += count
+
+    def handle_tty(self, fd, iomap):
+        """Called when the process writes to its terminal.
+
+        Types the password whenever the output ends with a password prompt.
+        """
+        try:
+            buf = os.read(fd, BUFFER_SIZE)
+        except (OSError, IOError):
+            _, e, _ = sys.exc_info()
+            if e.errno != EINTR:
+                self.close_tty(iomap)
+            return
+        if not buf:
+            self.close_tty(iomap)
+            return
+        self.ttyoutput = (self.ttyoutput + buf)[-PROMPT_SIZE:]
+        if PASSWORD_PROMPT.search(self.ttyoutput):
+            self.ttyoutput = bytes()
+            try:
+                os.write(fd, self.password + '\n'.encode('ascii'))
+            except (OSError, IOError):
+                _, e, _ = sys.exc_info()
+                self.close_tty(iomap)
+                self.log_exception(e)
+
+    def close_tty(self, iomap):
+        if self.tty is not None:
+            if iomap:
+                iomap.unregister(self.tty)
+            os.close(self.tty)
+            os.close(self.ttyslave)
+            self.tty = self.ttyslave = None
+        self.ttyoutput = None
+        self.password = None
+
+    def matches(self):
+        """Returns the number of lines kept by --include/--exclude, or None."""
+        if not self.outfilter:
+            return None
+        return self.outfilter.matches + self.errfilter.matches
+
+    def result(self):
+        """Returns a compact Result record for the finished task."""
+        return Result(self)
+
+    def release(self):
+        """Frees the process, buffers, and command after the report."""
+        self.close_tty(self.iomap)
+        self.proc = None
+        self.cmd = None
+        self.writer = None
+        self.iomap = None
+        self.inputstream = None
+        self.printer = None
+        self.reducer = None
+        self.splitter = None
+        self.outcapture = None
+        self.errcapture = None
+        if self.outputbuffer:
+            self.outputbuffer.close()
+        if self.errorbuffer:
+            self.errorbuffer.close()
+        self.outputbuffer = None
+        self.errorbuffer = None
 
     def log_exception(self, e):
         """Saves a record of the most recent exception for error reporting."""
@@ -233,44 +704,27 @@ class Task(object):
             exc = str(e)
         self.failures.append(exc)
 
-    def report(self, n):
-        """Pretty prints a status report after the Task completes."""
-        error = ', '.join(self.failures)
-        tstamp = time.asctime().split()[3] # Current time
-        if color.has_colors(sys.stdout):
-            progress = color.c("[%s]" % color.B(n))
-            success = color.g("[%s]" % color.B("SUCCESS"))
-            failure = color.r("[%s]" % color.B("FAILURE"))
-            stderr = color.r("Stderr: ")
-            error = color.r(color.B(error))
-        else:
-            progress = "[%s]" % n
-            success = "[SUCCESS]"
-            failure = "[FAILURE]"
-            stderr = "Stderr: "
-        if self.port:
-            host = '%s:%s' % (self.host, self.port)
-        else:
-            host = self.host
-        if self.failures:
-            print(' '.join((progress, tstamp, failure, host, error)))
-        else:
-            print(' '.join((progress, tstamp, success, host)))
-        # NOTE: The extra flushes are to ensure that the data is output in
-        # the correct order with the C implementation of io.
-        if self.outputbuffer:
-            sys.stdout.flush()
-            try:
-                sys.stdout.buffer.write(self.outputbuffer)
-                sys.stdout.flush()
-            except AttributeError:
-                sys.stdout.write(self.outputbuffer)
-        if self.errorbuffer:
-            sys.stdout.write(stderr)
+    def report(self, n, out=None):
+        """Pretty prints a status report after the Task completes.
+
+        The report goes to the given binary stream, or to stdout by default.
+        """
+        matches = None
+        if self.outfilter:
+            matches = self.matches()
+        status, stderr = format_status(n, self.host, self.port, self.failures,
+                matches)
+        if out is None:
             # Flush the TextIOWrapper before writing to the binary buffer.
             sys.stdout.flush()
             try:
-                sys.stdout.buffer.write(self.errorbuffer)
+                out = sys.stdout.buffer
             except AttributeError:
-                sys.stdout.write(self.errorbuffer)
-
+                out = sys.stdout
+        out.write((status + '\n').encode('utf-8'))
+        if self.inline and self.outputbuffer:
+            self.outputbuffer.write_to(out)
+        if self.inline and self.errorbuffer:
+            out.write(stderr.encode('utf-8'))
+            self.errorbuffer.write_to(out)
+        out.flush()
@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Local benchmarks for psshlib.
+
+These run against local commands rather than remote hosts, so they need no
+TEST_HOSTS setup.  Run "bench.py --help" for the list of benchmarks.
+"""
+
+import optparse
+import os
+import resource
+import shutil
+from subprocess import Popen, PIPE
+import sys
+import tempfile
+import threading
+import time
+import warnings
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.insert(0, "%s" % basedir)
+
+from psshlib.aio import AsyncManager
+from psshlib import askpass_client
+from psshlib import askpass_server
+from psshlib.manager import Manager, Writer
+from psshlib.task import Task
+from psshlib import spawn
+from psshlib import task as taskmod
+from psshlib import compress
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class Options(object):
+    """Stand-in for the optparse values used by Manager and Task."""
+    def __init__(self, **kwargs):
+        self.par = 32
+        self.timeout = 60
+        self.askpass = False
+        self.outdir = None
+        self.errdir = None
+        self.verbose = False
+        self.inline = False
+        self.print_out = False
+        self.user = None
+        self.__dict__.update(kwargs)
+
+
+def quiet_report(n):
+    pass
+
+
+def run_commands(cmd, count, opts, manager_class=Manager):
+    """Runs cmd count times and returns the elapsed wall time."""
+    manager = manager_class(opts)
+    for i in range(count):
+        task = Task('host%s' % i, None, None, cmd, opts)
+        task.report = quiet_report
+        manager.add_task(task)
+    start = time.time()
+    manager.run()
+    return time.time() - start
+
+
+def bench_makespan(options):
+    """Makespan of many short commands (default: 5000 runs of true)."""
+    count = options.count or 5000
+    opts = Options(par=options.par, timeout=options.timeout)
+    elapsed = run_commands(['true'], count, opts)
+    print('makespan: %s commands, -p %s, -t %s: %.2f s (%.0f commands/s)'
+            % (count, options.par, options.timeout, elapsed,
+                count / elapsed))
+
+
+def cpu_seconds():
+    """Returns the user and system CPU time used by this process."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def bench_engine(options):
+    """The poll Manager vs. the asyncio AsyncManager.
+
+    Each simulated host prints a line, at 100, 1000, and 5000 hosts (or
+    just the given count).
+    """
+    if options.count:
+        counts = [options.count]
+    else:
+        counts = [100, 1000, 5000]
+    cmd = ['echo', 'simulated host output']
+    opts = Options(par=options.par, timeout=options.timeout)
+    print('engine: echo per host, -p %s, -t %s' % (options.par,
+        options.timeout))
+    print('%8s %8s %10s %10s %12s' % ('engine', 'hosts', 'wall (s)',
+        'CPU (s)', 'hosts/s'))
+    for count in counts:
+        for name, manager_class in (('poll', Manager),
+                ('asyncio', AsyncManager)):
+            cpu = cpu_seconds()
+            elapsed = run_commands(cmd, count, opts, manager_class)
+            cpu = cpu_seconds() - cpu
+            print('%8s %8d %10.2f %10.2f %12.0f' % (name, count, elapsed,
+                cpu, count / elapsed))
+
+
+# Stands in for ssh asking for a password: on its terminal if it has one (as
+# with --askpass-mode=pty), or else through SSH_ASKPASS.
+PROMPT_SCRIPT = '''
+if ( : </dev/tty ) 2>/dev/null; then
+    printf "%s's password: " "$0" >/dev/tty
+    read -r pw </dev/tty
+else
+    pw=$("$SSH_ASKPASS" "$0's password: ")
+fi
+[ "$pw" = bench ] && echo "$0 connected"
+'''
+
+
+def children_cpu_seconds():
+    """Returns the user and system CPU time used by reaped children."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def bench_askpass(options):
+    """Connection ramp-up without -A and with each -A mode.
+
+    Each simulated host asks for a password (like PROMPT_SCRIPT's ssh) and
+    exits once it has one.  The default is 1000 hosts.
+    """
+    count = options.count or 1000
+    askpass_server.prompt_password = lambda: 'bench'
+    askpass_client._executable_path = os.path.join(basedir, 'bin',
+            'pssh-askpass')
+    cases = (('no -A', ['sh', '-c', 'echo "$0" connected'], None),
+            ('-A program', ['sh', '-c', PROMPT_SCRIPT], 'program'),
+            ('-A pty', ['sh', '-c', PROMPT_SCRIPT], 'pty'))
+    print('askpass: %s hosts, -p %s, -t %s' % (count, options.par,
+        options.timeout))
+    print('%12s %10s %12s %10s %10s' % ('mode', 'wall (s)', 'child CPU (s)',
+        'hosts/s', 'failures'))
+    for name, cmd, mode in cases:
+        opts = Options(par=options.par, timeout=options.timeout,
+                askpass=bool(mode), askpass_mode=mode)
+        manager = Manager(opts)
+        for i in range(count):
+            task = Task('host%s' % i, None, None, cmd + ['host%s' % i], opts)
+            task.report = quiet_report
+            manager.add_task(task)
+        cpu = children_cpu_seconds()
+        start = time.time()
+        manager.run()
+        elapsed = time.time() - start
+        cpu = children_cpu_seconds() - cpu
+        failures = len([r for r in manager.done if r.failures])
+        print('%12s %10.2f %12.2f %10.0f %10d' % (name, elapsed, cpu,
+            count / elapsed, failures))
+
+
+def rss_bytes():
+    """Returns the current resident set size of this process."""
+    f = open('/proc/self/statm')
+    pages = int(f.read().split()[1])
+    f.close()
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def bench_memory(options):
+    """RSS while many hosts finish, each with 4 KiB of -i output.
+
+    The default is 50000 hosts.
+    """
+    count = options.count or 50000
+    opts = Options(par=options.par, timeout=options.timeout, inline=True)
+    cmd = ['head', '-c', '4096', '/dev/zero']
+    manager = Manager(opts)
+
+    def tasks():
+        for i in range(count):
+            task = Task('host%s' % i, None, None, cmd, opts)
+            task.report = quiet_report
+            yield task
+    manager.add_tasks(tasks())
+
+    step = max(1, count // 10)
+    samples = []
+    original_finished = manager.finished
+    def finished(task):
+        original_finished(task)
+        if len(manager.done) % step == 0:
+            samples.append((len(manager.done), rss_bytes()))
+    manager.finished = finished
+
+    start_rss = rss_bytes()
+    manager.run()
+    print('memory: %s hosts, -p %s' % (count, options.par))
+    print('%10s %12s %14s' % ('finished', 'RSS (KiB)', 'growth (KiB)'))
+    for finished_count, rss in samples:
+        print('%10d %12d %14d' % (finished_count, rss // 1024,
+            (rss - start_rss) // 1024))
+
+
+def popen_setsid(cmd, env):
+    """The process creation used by Task.start before spawn.py existed."""
+    return Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=False,
+            preexec_fn=os.setsid, env=dict(env))
+
+
+def spawn_rate(start, count):
+    """Starts count copies of true in batches and returns spawns/second."""
+    cmd = ['true']
+    env = dict(os.environ)
+    batch = 100
+    elapsed = 0
+    for i in range(0, count, batch):
+        procs = []
+        begin = time.time()
+        for j in range(min(batch, count - i)):
+            procs.append(start(cmd, env))
+        elapsed += time.time() - begin
+        for proc in procs:
+            for f in (proc.stdin, proc.stdout, proc.stderr):
+                f.close()
+            os.waitpid(proc.pid, 0)
+            proc.returncode = 0
+    return count / elapsed
+
+
+def bench_spawn(options):
+    """Process creation rate of Popen+setsid vs. spawn.spawn()."""
+    count = options.count or 2000
+    # Make the parent large, like a busy control node, since fork costs grow
+    # with the size of the parent.
+    ballast = bytearray(options.ballast << 20)
+    print('spawn: %s runs of true, %s MiB ballast, posix_spawn %s'
+            % (count, options.ballast,
+                spawn.HAVE_POSIX_SPAWN and 'available' or 'unavailable'))
+    print('  Popen with preexec_fn=os.setsid: %8.0f spawns/s'
+            % spawn_rate(popen_setsid, count))
+    print('  spawn.spawn:                     %8.0f spawns/s'
+            % spawn_rate(spawn.spawn, count))
+    del ballast
+
+
+class LegacyWriter(threading.Thread):
+    """The single-threaded Writer used before batching, for comparison."""
+    OPEN = object()
+    EOF = object()
+    ABORT = object()
+
+    def __init__(self, outdir, errdir):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue.Queue()
+        self.outdir = outdir
+        self.errdir = errdir
+        self.files = {}
+
+    def run(self):
+        while True:
+            filename, data = self.queue.get()
+            if filename == self.ABORT:
+                return
+            if data == self.OPEN:
+                # Python 3 warns that buffering=1 means nothing here.
+                warnings.simplefilter('ignore', RuntimeWarning)
+                self.files[filename] = open(filename, 'wb', buffering=1)
+            else:
+                dest = self.files[filename]
+                if data == self.EOF:
+                    dest.close()
+                else:
+                    dest.write(data)
+
+    def open_file(self, host):
+        filename = os.path.join(self.outdir, host)
+        self.queue.put((filename, self.OPEN))
+        return filename
+
+    def write(self, filename, data):
+        self.queue.put((filename, data))
+
+    def close(self, filename):
+        self.queue.put((filename, self.EOF))
+
+    def signal_quit(self):
+        self.queue.put((self.ABORT, None))
+
+
+def writer_throughput(writer, open_file, hosts, chunks, chunk):
+    """Streams chunks to one file per host, interleaved like live output.
+
+    The open_file function takes a host name and returns a filename.  All
+    requests are queued before the writer starts, so that the time measured
+    is the time the writer needs to drain a backlog.
+    """
+    filenames = [open_file('host%s' % i) for i in range(hosts)]
+    for j in range(chunks):
+        for filename in filenames:
+            writer.write(filename, chunk)
+    for filename in filenames:
+        writer.close(filename)
+    writer.signal_quit()
+    start = time.time()
+    writer.start()
+    writer.join()
+    return time.time() - start
+
+
+def bench_writer(options):
+    """Throughput of the legacy Writer vs. the batched Writer.
+
+    Each of N hosts (default 1000) writes 64 chunks to its own file in an
+    --outdir, using the chunk size of a task's pipe reads.
+    """
+    hosts = options.count or 1000
+    chunks = 64
+    chunk = bytes(bytearray(options.chunk_size))
+    total = hosts * chunks * len(chunk)
+    print('writer: %s hosts, %s chunks of %s bytes each (%.0f MiB)'
+            % (hosts, chunks, len(chunk), total / 1048576.0))
+
+    def run(name, make_writer, open_file):
+        outdir = tempfile.mkdtemp(prefix='pssh-bench.')
+        try:
+            writer = make_writer(outdir)
+            elapsed = writer_throughput(writer, open_file(writer), hosts,
+                    chunks, chunk)
+        finally:
+            shutil.rmtree(outdir)
+        print('  %-26s %6.2f s %8.1f MiB/s' % (name, elapsed,
+            total / elapsed / 1048576.0))
+        return writer
+
+    run('legacy writer:', lambda outdir: LegacyWriter(outdir, None),
+            lambda writer: writer.open_file)
+    for threads in (1, 2, 4):
+        writer = run('batched writer, %s thread%s:'
+                % (threads, threads > 1 and 's' or ''),
+                lambda outdir: Writer(outdir, None, threads),
+                lambda writer: (lambda host: writer.open_files(host)[0]))
+        stats = writer.stats()
+        print('    %(writes)s writes in %(batches)s batches, '
+                'max queue depth %(max_queue_depth)s' % stats)
+
+def bench_splice(options):
+    """Collecting output into an --outdir with and without splice.
+
+    Each of N hosts (default 8) cats a 256 MiB file.
+    """
+    count = options.count or 8
+    size = 256 << 20
+    source = tempfile.NamedTemporaryFile(prefix='pssh-bench.')
+    block = bytes(bytearray(range(256))) * 4096
+    for i in range(size // len(block)):
+        source.write(block)
+    source.flush()
+    cmd = ['cat', source.name]
+    print('splice: %s hosts, %s MiB each, splice %s' % (count, size >> 20,
+        taskmod.HAVE_SPLICE and 'available' or 'unavailable'))
+
+    have_splice = taskmod.HAVE_SPLICE
+    for name, splice in (('read and Writer:', False), ('splice:', True)):
+        if splice and not have_splice:
+            continue
+        taskmod.HAVE_SPLICE = splice
+        outdir = tempfile.mkdtemp(prefix='pssh-bench.')
+        try:
+            opts = Options(par=options.par, timeout=options.timeout,
+                    outdir=outdir)
+            before = os.times()
+            elapsed = run_commands(cmd, count, opts)
+            after = os.times()
+        finally:
+            shutil.rmtree(outdir)
+        cpu = (after[0] - before[0]) + (after[1] - before[1])
+        print('  %-18s %6.2f s %8.1f MiB/s, pssh CPU %.2f s' % (name,
+            elapsed, count * size / elapsed / 1048576.0, cpu))
+    taskmod.HAVE_SPLICE = have_splice
+    source.close()
+
+def directory_size(path):
+    """Returns the total size of the files in a directory."""
+    return sum([os.path.getsize(os.path.join(path, name))
+        for name in os.listdir(path)])
+
+
+def bench_compress(options):
+    """Wall time and bytes written for raw and compressed --outdir files.
+
+    Each of N hosts (default 16) prints 1,000,000 log-like lines (about
+    49 MiB).
+    """
+    count = options.count or 16
+    cmd = ['awk', 'BEGIN { for (i = 0; i < 1000000; i++) '
+            'printf "%d INFO worker %d: request %d done in %d ms\\n", '
+            'i, i % 16, i, i % 97 }']
+    print('compress: %s hosts, -p %s' % (count, options.par))
+    codecs = [None] + [spec for spec in ('gzip:1', 'gzip', 'bzip2', 'xz')
+            if spec.split(':')[0] in compress.CODECS]
+    raw = None
+    for spec in codecs:
+        outdir = tempfile.mkdtemp(prefix='pssh-bench.')
+        try:
+            opts = Options(par=options.par, timeout=options.timeout,
+                    outdir=outdir, compress_output=spec)
+            elapsed = run_commands(cmd, count, opts)
+            size = directory_size(outdir)
+        finally:
+            shutil.rmtree(outdir)
+        if raw is None:
+            raw = size
+        print('  %-8s %7.2f s %10.1f MiB written (%5.1f%%)' % (spec or 'raw',
+            elapsed, size / 1048576.0, 100.0 * size / raw))
+
+
+BENCHMARKS = {
+    'askpass': bench_askpass,
+    'compress': bench_compress,
+    'engine': bench_engine,
+    'makespan': bench_makespan,
+    'memory': bench_memory,
+    'splice': bench_splice,
+    'spawn': bench_spawn,
+    'writer': bench_writer,
+    }
+
+
+def main():
+    names = sorted(BENCHMARKS)
+    parser = optparse.OptionParser(usage='%prog [OPTIONS] BENCHMARK...',
+            epilog='Benchmarks: %s' % ', '.join(names))
+    parser.add_option('-n', '--count', dest='count', type='int',
+            help='number of commands or hosts (default depends on the '
+            'benchmark)')
+    parser.add_option('-p', '--par', dest='par', type='int', default=32,
+            help='max number of parallel commands (default 32)')
+    parser.add_option('-t', '--timeout', dest='timeout', type='int',
+            default=60, help='per-command timeout (default 60)')
+    parser.add_option('--ballast', dest='ballast', type='int', default=0,
+            metavar='MIB', help='extra memory to allocate before spawning '
+            '(spawn benchmark only, default 0)')
+    parser.add_option('--chunk-size', dest='chunk_size', type='int',
+            default=1 << 16, metavar='BYTES', help='size of each write '
+            '(writer benchmark only, default 65536)')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('No benchmark specified.')
+    for name in args:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark: %s' % name)
+    for name in args:
+        BENCHMARKS[name](options)
+
+
+if __name__ == '__main__':
+    main()
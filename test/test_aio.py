@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of the asyncio engine (--engine=asyncio) with a local fake ssh.
+
+Like test_controlpool.py, these need no remote hosts: test/fakessh stands in
+for ssh and runs every command locally.
+"""
+
+import asyncio
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib import aio
+from psshlib import askpass_client
+
+g_hosts = ['h1', 'h2', 'h3']
+
+class AsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # Put the fake ssh first in the PATH.
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bindir)
+        os.symlink(os.path.join(basedir, 'test', 'fakessh'),
+                os.path.join(bindir, 'ssh'))
+        self.oldpath = os.environ['PATH']
+        os.environ['PATH'] = '%s:%s' % (bindir, self.oldpath)
+        # Since this script isn't in bin, point at bin's pssh-askpass.
+        askpass_client._executable_path = os.path.join(basedir, 'bin',
+                'pssh-askpass')
+
+    def tearDown(self):
+        os.environ['PATH'] = self.oldpath
+        shutil.rmtree(self.tmpdir)
+
+    def pssh(self, *args):
+        """Runs pssh with the asyncio engine and returns its stdout."""
+        cmd = [sys.executable, '%s/bin/pssh' % basedir, '--engine=asyncio']
+        for host in g_hosts:
+            cmd += ['-H', host]
+        cmd.extend(args)
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(stderr, ''.encode())
+        return stdout.decode()
+
+    def statuses(self, stdout):
+        """Returns a dict mapping each host to the rest of its status line."""
+        statuses = {}
+        for line in stdout.splitlines():
+            match = re.match(r'\[\d+\] [\d:]+ (\[\w+\]) (\S+)(.*)', line)
+            if match:
+                status, host, error = match.groups()
+                statuses[host] = status + error
+        return statuses
+
+    def collect(self, hosts, cmdline, **kwargs):
+        async def main():
+            return [result async for result in
+                    aio.run_hosts(hosts, cmdline, **kwargs)]
+        return asyncio.run(main())
+
+    def testStatus(self):
+        stdout = self.pssh('exit $PSSH_NODENUM')
+        self.assertEqual(self.statuses(stdout), {
+            'h1': '[SUCCESS]',
+            'h2': '[FAILURE] Exited with error code 1',
+            'h3': '[FAILURE] Exited with error code 2'})
+
+    def testInline(self):
+        stdout = self.pssh('-i', 'echo out; echo err >&2')
+        self.assertEqual(stdout.count('[SUCCESS]'), len(g_hosts))
+        self.assertEqual(stdout.count('\nout\nStderr: err\n'), len(g_hosts))
+
+    def testTimeout(self):
+        stdout = self.pssh('-t', '1', 'sleep 5')
+        self.assertEqual(stdout.count('[FAILURE]'), len(g_hosts))
+        self.assertEqual(stdout.count('Timed out'), len(g_hosts))
+
+    def testResults(self):
+        results = self.collect(g_hosts, 'echo $PSSH_NODENUM; exit 3',
+                capture=100)
+        self.assertEqual(sorted(r.stdout for r in results),
+                ['0\n'.encode(), '1\n'.encode(), '2\n'.encode()])
+        for result in results:
+            self.assertEqual(result.returncode, 3)
+            self.assertEqual(result.failures, ('Exited with error code 3',))
+
+    def testTaskRaises(self):
+        # A bad option makes each task raise; its host must still finish,
+        # as a failure.
+        results = self.collect(g_hosts, 'true', timeout='x')
+        self.assertEqual(sorted(r.host for r in results), g_hosts)
+        for result in results:
+            self.assertFalse(result.succeeded())
+
+
+if __name__ == '__main__':
+    unittest.main()
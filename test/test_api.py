@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of the library interface (psshlib.api) with a local fake ssh.
+
+These need no remote hosts: test/fakessh stands in for ssh and runs every
+command locally.
+"""
+
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib import api
+from psshlib import askpass_client
+
+g_hosts = ['h%s' % i for i in range(6)]
+
+class Failure(Exception):
+    pass
+
+class ApiTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # Put the fake ssh first in the PATH.
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bindir)
+        os.symlink(os.path.join(basedir, 'test', 'fakessh'),
+                os.path.join(bindir, 'ssh'))
+        self.oldpath = os.environ['PATH']
+        os.environ['PATH'] = '%s:%s' % (bindir, self.oldpath)
+        # Since this script isn't in bin, point at bin's pssh-askpass.
+        askpass_client._executable_path = os.path.join(basedir, 'bin',
+                'pssh-askpass')
+
+    def tearDown(self):
+        os.environ['PATH'] = self.oldpath
+        shutil.rmtree(self.tmpdir)
+
+    def openFds(self):
+        return set(os.listdir('/proc/self/fd'))
+
+    def assertReleased(self, fds):
+        """Checks that a finished Run left no handlers or descriptors."""
+        self.assertEqual(signal.getsignal(signal.SIGCHLD), signal.SIG_DFL)
+        wakeup = signal.set_wakeup_fd(-1)
+        self.assertEqual(wakeup, -1)
+        self.assertEqual(self.openFds(), fds)
+
+    def testRun(self):
+        fds = self.openFds()
+        results = api.run(g_hosts, 'echo out; echo err >&2; '
+                'exit $PSSH_NODENUM', capture=100)
+        self.assertEqual(sorted(r.host for r in results), g_hosts)
+        for result in results:
+            n = result.returncode
+            self.assertEqual(result.stdout, 'out\n'.encode())
+            self.assertEqual(result.stderr, 'err\n'.encode())
+            self.assertEqual(result.succeeded(), n == 0)
+            if n:
+                self.assertEqual(result.failures,
+                        ('Exited with error code %s' % n,))
+        self.assertEqual(sorted(r.returncode for r in results),
+                list(range(len(g_hosts))))
+        self.assertReleased(fds)
+
+    def testStdin(self):
+        results = api.run(g_hosts[:2], 'cat', stdin='input\n'.encode(),
+                capture=100)
+        self.assertEqual([r.stdout for r in results], ['input\n'.encode()] * 2)
+
+    def testBreak(self):
+        fds = self.openFds()
+        run = api.Run(g_hosts, 'sleep $PSSH_NODENUM', par=2)
+        for result in run:
+            self.assertEqual(result.host, 'h0')
+            break
+        self.assertTrue(run.done)
+        self.assertReleased(fds)
+
+    def testCancel(self):
+        finished = []
+        def callback(result):
+            finished.append(result)
+            run.cancel()
+        run = api.Run(g_hosts, 'sleep $PSSH_NODENUM', par=2,
+                callback=callback)
+        results = run.wait()
+        self.assertEqual(len(results), len(finished))
+        self.assertTrue(finished[0].succeeded())
+        self.assertEqual(finished[0].host, 'h0')
+        for result in finished[1:]:
+            self.assertTrue('Cancelled' in result.failures)
+
+    def testCallbackRaises(self):
+        fds = self.openFds()
+        calls = []
+        def callback(result):
+            calls.append(result)
+            raise Failure()
+        run = api.Run(g_hosts, 'sleep $PSSH_NODENUM', par=2,
+                callback=callback)
+        self.assertRaises(Failure, run.wait)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(run.done)
+        self.assertReleased(fds)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of password prompts (-A) with a local fake ssh that asks for one.
+
+pssh runs in a pty, as if a user typed the password at its prompt.  The
+fake ssh asks for the password on its terminal if it has one (as with
+--askpass-mode=pty) and otherwise through SSH_ASKPASS (pssh-askpass).
+"""
+
+import os
+import pty
+import shutil
+import sys
+import tempfile
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib.task import PASSWORD_PROMPT
+
+g_hosts = ['h1', 'h2', 'h3']
+g_password = 'sekrit'
+
+FAKESSH = """#!/bin/sh
+host=$1
+if ( : </dev/tty ) 2>/dev/null; then
+    stty -echo </dev/tty
+    printf "%%s's password: " "$host" >/dev/tty
+    read -r password </dev/tty
+    stty echo </dev/tty
+    printf '\\n' >/dev/tty
+else
+    password=$("$SSH_ASKPASS" "$host's password: ")
+fi
+[ "$password" = "%s" ] || { echo "Permission denied" >&2; exit 255; }
+echo "ok $host"
+""" % g_password
+
+class AskpassTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # Put the fake ssh first in the PATH.
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bindir)
+        path = os.path.join(bindir, 'ssh')
+        f = open(path, 'w')
+        f.write(FAKESSH)
+        f.close()
+        os.chmod(path, 493) # 0755
+        self.oldpath = os.environ['PATH']
+        os.environ['PATH'] = '%s:%s' % (bindir, self.oldpath)
+
+    def tearDown(self):
+        os.environ['PATH'] = self.oldpath
+        shutil.rmtree(self.tmpdir)
+
+    def pssh(self, password, *args):
+        """Runs pssh in a pty, typing the password at its prompt.
+
+        Returns the exit status and the output.
+        """
+        cmd = [sys.executable, '%s/bin/pssh' % basedir, '-A', '-i']
+        for host in g_hosts:
+            cmd += ['-H', host]
+        cmd.extend(args)
+        pid, fd = pty.fork()
+        if pid == 0:
+            try:
+                # No colors in the status lines.
+                os.environ['TERM'] = 'dumb'
+                os.execv(cmd[0], cmd)
+            finally:
+                os._exit(127)
+        output = ''.encode()
+        typed = False
+        while True:
+            try:
+                data = os.read(fd, 4096)
+            except OSError:
+                # The pty is gone (EIO) once pssh exits.
+                break
+            if not data:
+                break
+            output += data
+            if not typed and 'Password: '.encode() in output:
+                os.write(fd, (password + '\n').encode())
+                typed = True
+        os.close(fd)
+        _, status = os.waitpid(pid, 0)
+        self.assertTrue(typed)
+        return os.WEXITSTATUS(status), output.decode().replace('\r\n', '\n')
+
+    def assertHosts(self, output, status):
+        for host in g_hosts:
+            self.assertTrue('[%s] %s' % (status, host) in output)
+            if status == 'SUCCESS':
+                self.assertTrue('\nok %s\n' % host in output)
+
+    def testPty(self):
+        status, output = self.pssh(g_password, '--askpass-mode=pty', 'true')
+        self.assertEqual(status, 0)
+        self.assertHosts(output, 'SUCCESS')
+        # The fake ssh's prompts are answered, not shown.
+        self.assertFalse("'s password:" in output)
+
+    def testProgram(self):
+        status, output = self.pssh(g_password, '--askpass-mode=program',
+                'true')
+        self.assertEqual(status, 0)
+        self.assertHosts(output, 'SUCCESS')
+
+    def testWrongPassword(self):
+        status, output = self.pssh('wrong', '--askpass-mode=pty', 'true')
+        self.assertHosts(output, 'FAILURE')
+        self.assertTrue('Permission denied' in output)
+
+    def testPrompt(self):
+        for prompt in ("h1's password: ", 'Password:',
+                "Enter passphrase for key '/root/.ssh/id_rsa': ",
+                'user@h1\'s password:'):
+            self.assertTrue(PASSWORD_PROMPT.search(prompt.encode()))
+        for text in ('password: ok\nmore output', 'Last login: today',
+                'no prompt here'):
+            self.assertFalse(PASSWORD_PROMPT.search(text.encode()))
+
+
+if __name__ == '__main__':
+    unittest.main()
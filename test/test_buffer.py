@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of the output buffers for -i (psshlib.buffer)."""
+
+import os
+import sys
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib.buffer import Capture, OutputBuffer
+
+def omitted(count):
+    return ('\n[... %s bytes omitted ...]\n' % count).encode('ascii')
+
+class OutputBufferTest(unittest.TestCase):
+    def testUnlimited(self):
+        buf = OutputBuffer()
+        for i in range(1000):
+            buf.append(('%s\n' % i).encode())
+        expected = ''.join(['%s\n' % i for i in range(1000)]).encode()
+        self.assertEqual(buf.getvalue(), expected)
+        self.assertEqual(len(buf), len(expected))
+        self.assertEqual(buf.omitted, 0)
+
+    def testExactlyAtCap(self):
+        buf = OutputBuffer(10)
+        buf.append('abcd'.encode())
+        buf.append('efghij'.encode())
+        self.assertEqual(buf.getvalue(), 'abcdefghij'.encode())
+        self.assertEqual(buf.omitted, 0)
+
+    def testOneOverCap(self):
+        buf = OutputBuffer(10)
+        buf.append('abcdefghijk'.encode())
+        self.assertEqual(buf.omitted, 1)
+        self.assertEqual(len(buf), 11)
+        self.assertEqual(buf.getvalue(),
+                'abcde'.encode() + omitted(1) + 'ghijk'.encode())
+
+    def testTailRetention(self):
+        buf = OutputBuffer(8)
+        data = ''.join([chr(ord('a') + i % 26) for i in range(100)]).encode()
+        # Chunks of varying sizes, including ones larger than the tail.
+        pos = 0
+        for size in (1, 2, 3, 30, 1, 1, 5, 57):
+            buf.append(data[pos:pos + size])
+            pos += size
+        self.assertEqual(pos, len(data))
+        self.assertEqual(buf.getvalue(),
+                data[:4] + omitted(len(data) - 8) + data[-4:])
+        self.assertEqual(buf.headsize, 4)
+        self.assertEqual(buf.tailsize, 4)
+        self.assertEqual(len(buf), len(data))
+
+    def testNoSpillWithinLimit(self):
+        buf = OutputBuffer(10, spill=True)
+        buf.append('0123456789'.encode())
+        self.assertTrue(buf.spillfile is None)
+        self.assertEqual(buf.getvalue(), '0123456789'.encode())
+
+    def testSpillReadback(self):
+        buf = OutputBuffer(10, spill=True)
+        chunks = [('chunk %s\n' % i).encode() for i in range(10000)]
+        for chunk in chunks:
+            buf.append(chunk)
+        self.assertTrue(buf.spillfile is not None)
+        self.assertEqual(buf.head, [])
+        self.assertEqual(buf.omitted, 0)
+        expected = bytes().join(chunks)
+        self.assertEqual(len(buf), len(expected))
+        # The output can be written more than once.
+        self.assertEqual(buf.getvalue(), expected)
+        self.assertEqual(buf.getvalue(), expected)
+        buf.close()
+        self.assertTrue(buf.spillfile is None)
+
+class CaptureTest(unittest.TestCase):
+    def testCapture(self):
+        capture = Capture(5)
+        capture.add('abc'.encode())
+        self.assertFalse(capture.truncated)
+        capture.add('de'.encode())
+        self.assertFalse(capture.truncated)
+        capture.add('f'.encode())
+        self.assertTrue(capture.truncated)
+        self.assertEqual(bytes(capture.data), 'abcde'.encode())
+
+if __name__ == '__main__':
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite([
+        loader.loadTestsFromTestCase(OutputBufferTest),
+        loader.loadTestsFromTestCase(CaptureTest)])
+    unittest.TextTestRunner().run(suite)
@@ -0,0 +1,50 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of host-range compression for coalesced output (psshlib.coalesce)."""
+
+import os
+import sys
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib.coalesce import compress_hosts
+
+class CompressHostsTest(unittest.TestCase):
+    def testNumericRuns(self):
+        hosts = ['web1', 'web2', 'web3', 'web5', 'db']
+        self.assertEqual(compress_hosts(hosts), 'db,web[1-3,5]')
+
+    def testOrderAndDuplicates(self):
+        hosts = ['web3', 'web1', 'web2', 'web2']
+        self.assertEqual(compress_hosts(hosts), 'web[1-3]')
+
+    def testZeroPadding(self):
+        hosts = ['n008', 'n009', 'n010', 'n011']
+        self.assertEqual(compress_hosts(hosts), 'n[008-011]')
+
+    def testMixedWidths(self):
+        # Padded and unpadded numbers are never folded into one range.
+        hosts = ['n01', 'n02', 'n03', 'n10', 'n9']
+        self.assertEqual(compress_hosts(hosts), 'n[01-03,10],n9')
+
+    def testMixedPrefixes(self):
+        hosts = ['a1', 'b2', 'a2', 'b3', 'c']
+        self.assertEqual(compress_hosts(hosts), 'a[1-2],b[2-3],c')
+
+    def testSuffixes(self):
+        self.assertEqual(compress_hosts(['node1a', 'node2a']), 'node[1-2]a')
+        hosts = ['h1:22', 'h2:22', 'h3:2222']
+        self.assertEqual(compress_hosts(hosts), 'h[1-2]:22,h3:2222')
+
+    def testSingleHost(self):
+        self.assertEqual(compress_hosts(['web7']), 'web7')
+        self.assertEqual(compress_hosts(['n007']), 'n007')
+        self.assertEqual(compress_hosts(['db']), 'db')
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(CompressHostsTest)
+    unittest.TextTestRunner().run(suite)
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of the ssh master pool (--control-dir) with a local fake ssh.
+
+Unlike test.py, these need no remote hosts: test/fakessh stands in for ssh
+and runs every command locally.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib import controlpool
+
+g_hosts = ['h1', 'h2', 'h3']
+
+class ControlPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.controldir = os.path.join(self.tmpdir, 'control')
+        self.log = os.path.join(self.tmpdir, 'log')
+        # Put the fake ssh first in the PATH.
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bindir)
+        os.symlink(os.path.join(basedir, 'test', 'fakessh'),
+                os.path.join(bindir, 'ssh'))
+        self.oldpath = os.environ['PATH']
+        os.environ['PATH'] = '%s:%s' % (bindir, self.oldpath)
+        os.environ['FAKESSH_LOG'] = self.log
+
+    def tearDown(self):
+        pool = controlpool.ControlPool(self.controldir)
+        controlpool.close_masters([path for _, path in pool.sockets()])
+        os.environ['PATH'] = self.oldpath
+        del os.environ['FAKESSH_LOG']
+        shutil.rmtree(self.tmpdir)
+
+    def pssh(self, *args):
+        """Runs pssh on the hosts and returns its stderr."""
+        cmd = [sys.executable, '%s/bin/pssh' % basedir,
+                '--control-dir', self.controldir, '-v']
+        for host in g_hosts:
+            cmd += ['-H', host]
+        cmd.extend(args)
+        proc = subprocess.Popen(cmd, stdin=open(os.devnull),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(stdout.count('[SUCCESS]'.encode()), len(g_hosts))
+        return stderr.decode()
+
+    def readLog(self):
+        lines = open(self.log).read().splitlines()
+        os.unlink(self.log)
+        return sorted(lines)
+
+    def testReuse(self):
+        stderr = self.pssh('true')
+        self.assertTrue('0 hits, 3 misses' in stderr)
+        self.assertEqual(self.readLog(),
+                ['connect %s' % host for host in g_hosts])
+        stderr = self.pssh('true')
+        self.assertTrue('3 hits, 0 misses (100% hit rate)' in stderr)
+        self.assertEqual(self.readLog(), ['mux %s' % host for host in g_hosts])
+
+    def testLeastRecentlyUsed(self):
+        self.pssh('true')
+        pool = controlpool.ControlPool(self.controldir, max_sockets=2)
+        oldest = pool.path('h2')
+        os.utime(oldest, (time.time() - 10, time.time() - 10))
+        self.assertEqual(pool.expire(), 1)
+        self.assertEqual(len(pool.sockets()), 2)
+        self.assertTrue(not os.path.exists(oldest))
+
+    def testMaxOption(self):
+        self.pssh('true')
+        stderr = self.pssh('--control-max', '1', 'true')
+        self.assertTrue('3 hits, 0 misses' in stderr)
+        self.assertTrue('2 masters closed' in stderr)
+        pool = controlpool.ControlPool(self.controldir)
+        self.assertEqual(len(pool.sockets()), 1)
+
+    def testExpire(self):
+        self.pssh('true')
+        pool = controlpool.ControlPool(self.controldir, persist=60)
+        now = time.time()
+        self.assertEqual(pool.expire(now), 0)
+        self.assertEqual(pool.expire(now + 120), len(g_hosts))
+        self.assertEqual(pool.sockets(), [])
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(ControlPoolTest)
+    unittest.TextTestRunner().run(suite)
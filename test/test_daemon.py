@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of pssh-daemon and pssh-client with a local fake ssh.
+
+Like test_controlpool.py, these need no remote hosts: test/fakessh stands in
+for ssh and runs every command locally.
+"""
+
+import base64
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # Put the fake ssh first in the PATH.
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bindir)
+        os.symlink(os.path.join(basedir, 'test', 'fakessh'),
+                os.path.join(bindir, 'ssh'))
+        self.oldpath = os.environ['PATH']
+        os.environ['PATH'] = '%s:%s' % (bindir, self.oldpath)
+        self.socket = os.path.join(self.tmpdir, 'daemon.sock')
+        self.daemon = subprocess.Popen([sys.executable,
+            '%s/bin/pssh-daemon' % basedir, '-s', self.socket,
+            '--no-control'], stdin=subprocess.DEVNULL)
+        for i in range(100):
+            if os.path.exists(self.socket):
+                break
+            time.sleep(0.05)
+        else:
+            self.fail('The daemon did not start.')
+
+    def tearDown(self):
+        if self.daemon.poll() is None:
+            self.daemon.kill()
+            self.daemon.wait()
+        os.environ['PATH'] = self.oldpath
+        shutil.rmtree(self.tmpdir)
+
+    def request(self, line):
+        """Sends a request and returns the records of the answer."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket)
+        sock.sendall(line.encode() + '\n'.encode())
+        f = sock.makefile('rb')
+        records = [json.loads(record.decode()) for record in f]
+        f.close()
+        sock.close()
+        return records
+
+    def assertError(self, request, message):
+        self.assertEqual(self.request(json.dumps(request)),
+                [{'error': message}])
+
+    def client(self, *args, **kwargs):
+        """Runs pssh-client and returns its exit status, stdout, and stderr.
+
+        The keyword arguments are the input and any environment variables.
+        """
+        data = kwargs.pop('input', None)
+        environ = dict(os.environ)
+        environ.update(kwargs)
+        proc = subprocess.Popen([sys.executable,
+            '%s/bin/pssh-client' % basedir, '-s', self.socket] + list(args),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, env=environ)
+        stdout, stderr = proc.communicate(data)
+        return proc.returncode, stdout.decode(), stderr.decode()
+
+    def testErrors(self):
+        records = self.request('{')
+        self.assertEqual(len(records), 1)
+        self.assertTrue('error' in records[0])
+        self.assertError([], 'The request must be a JSON object.')
+        self.assertError({'hosts': ['h1']}, 'Command not specified.')
+        self.assertError({'command': 'true'}, 'Hosts not specified.')
+        self.assertError({'command': 1, 'hosts': ['h1']},
+                'The command option must be a string.')
+        self.assertError({'command': 'true', 'hosts': 'h1'},
+                'The hosts option must be a list of strings.')
+        self.assertError({'command': 'true', 'hosts': ['h1'],
+            'timeout': 'x'}, 'The timeout option must be an integer.')
+        self.assertError({'command': 'true', 'hosts': ['h1'],
+            'verbose': 1}, 'The verbose option must be true or false.')
+        self.assertError({'command': 'true', 'hosts': ['h1'],
+            'extra': ['-v', 2]}, 'The extra option must be a list of '
+            'strings.')
+        self.assertError({'command': 'true', 'hosts': ['h1'], 'par': 0},
+                'The parallelism must be a positive number.')
+        self.assertError({'command': 'true', 'hosts': ['h1'],
+            'include': ['(']}, 'Invalid regular expression: missing ), '
+            'unterminated subpattern at position 0')
+        # The daemon is still serving.
+        self.assertEqual(self.request(json.dumps({'command': 'true',
+            'hosts': ['h1']}))[-1], {'done': True, 'hosts': 1,
+                'failures': 0})
+
+    def testJob(self):
+        records = self.request(json.dumps({'command':
+            'echo $PSSH_NODENUM; exit $PSSH_NODENUM',
+            'hosts': ['h1', 'h2', 'h3'], 'capture': 100}))
+        self.assertEqual(records[-1], {'done': True, 'hosts': 3,
+            'failures': 2})
+        records = sorted(records[:-1], key=lambda record: record['exit'])
+        self.assertEqual([record['host'] for record in records],
+                ['h1', 'h2', 'h3'])
+        for i, record in enumerate(records):
+            self.assertEqual(record['exit'], i)
+            self.assertEqual(base64.b64decode(record['stdout']),
+                    ('%s\n' % i).encode())
+
+    def testClient(self):
+        # The input is larger than a frame.
+        data = ''.join('line %s\n' % i for i in range(20000)).encode()
+        status, stdout, _ = self.client('-H', 'h1', '-H', 'h2', '-I', '-i',
+                'wc -l', input=data)
+        self.assertEqual(status, 0)
+        lines = [line.strip() for line in stdout.splitlines()]
+        self.assertEqual(lines.count('20000'), 2)
+        self.assertEqual(len([line for line in lines
+            if '[SUCCESS]' in line]), 2)
+
+    def testClientError(self):
+        missing = os.path.join(self.tmpdir, 'missing')
+        status, _, stderr = self.client('-h', missing, 'true')
+        self.assertEqual(status, 1)
+        self.assertEqual(stderr, 'pssh-client: Could not read host file '
+                '%s: No such file or directory\n' % missing)
+
+    def testEnvironment(self):
+        # The daemon takes numbers and booleans, not the strings of PSSH_*.
+        status, stdout, stderr = self.client('-H', 'h1', 'true',
+                PSSH_PAR='2', PSSH_TIMEOUT='30', PSSH_VERBOSE='1')
+        self.assertEqual(status, 0)
+        self.assertEqual(stderr, '')
+        self.assertTrue('[SUCCESS] h1' in stdout)
+
+    def testTerminate(self):
+        self.daemon.terminate()
+        self.assertEqual(self.daemon.wait(), 0)
+        self.assertFalse(os.path.exists(self.socket))
+
+
+if __name__ == '__main__':
+    unittest.main()
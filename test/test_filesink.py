@@ -0,0 +1,62 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of output files kept within --max-open-files (manager.FileSink)."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib.manager import FileSink
+
+class FileSinkTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='pssh-test.')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def write(self, sink, name, data):
+        sink.write(self.path(name), [data.encode()])
+
+    def testLeastRecentlyUsedEvicted(self):
+        sink = FileSink(max_open=2)
+        for name in ('a', 'b'):
+            sink.open(self.path(name))
+        self.write(sink, 'a', 'a1')
+        self.write(sink, 'b', 'b1')
+        # Using a again makes b the least recently used.
+        self.write(sink, 'a', 'a2')
+        sink.open(self.path('c'))
+        self.assertEqual(list(sink.files), [self.path('a'), self.path('c')])
+        self.assertEqual(sink.closed, set([self.path('b')]))
+        self.write(sink, 'b', 'b2')
+        self.assertEqual(sink.reopens, 1)
+        self.assertEqual(list(sink.files), [self.path('c'), self.path('b')])
+        sink.finish()
+        for name, data in (('a', 'a1a2'), ('b', 'b1b2'), ('c', '')):
+            f = open(self.path(name), 'rb')
+            self.assertEqual(f.read(), data.encode())
+            f.close()
+
+    def testCounters(self):
+        sink = FileSink(max_open=1)
+        sink.open(self.path('a'))
+        sink.write(self.path('a'), ['x'.encode(), 'yz'.encode()])
+        sink.finish()
+        self.assertEqual(sink.bytes, 3)
+        self.assertEqual(sink.written, 3)
+        self.assertEqual(sink.writes, 1)
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(FileSinkTest)
+    unittest.TextTestRunner().run(suite)
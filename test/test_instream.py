@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of the shared input stream for pssh -I (psshlib.instream)."""
+
+import os
+import sys
+import tempfile
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib.instream import InputStream, CHUNK_SIZE
+
+class InputStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(10 * CHUNK_SIZE + 123)
+        self.file = tempfile.TemporaryFile()
+        self.file.write(self.data)
+        self.file.seek(0)
+        # A regular file is read on demand, so no IOMap is needed.
+        self.stream = InputStream(self.file.fileno(), capacity=CHUNK_SIZE)
+
+    def tearDown(self):
+        self.file.close()
+
+    def readAll(self, reader, step=None):
+        """Reads to the end, returning the data and the most chunks held."""
+        parts = []
+        most = 0
+        while not reader.at_eof():
+            view = reader.peek()
+            if view is None:
+                # The end of the input was found.
+                self.assertTrue(reader.at_eof())
+                break
+            if step:
+                view = view[:step]
+            parts.append(bytes(view))
+            reader.advance(len(view))
+            most = max(most, len(self.stream.chunks))
+        return bytes().join(parts), most
+
+    def testLateReader(self):
+        first = self.stream.reader(None)
+        data, most = self.readAll(first)
+        self.assertEqual(data, self.data)
+        # Memory stays bounded although more readers may still come.
+        self.assertTrue(most <= 2)
+        self.assertTrue(self.stream.spill is not None)
+        late = self.stream.reader(None)
+        self.stream.seal()
+        data, most = self.readAll(late, 1000)
+        self.assertEqual(data, self.data)
+        self.assertTrue(self.stream.spill is None)
+
+    def testSealedWithoutLateReaders(self):
+        reader = self.stream.reader(None)
+        self.stream.seal()
+        self.assertTrue(self.stream.spill is None)
+        data, most = self.readAll(reader)
+        self.assertEqual(data, self.data)
+        self.assertTrue(self.stream.spill is None)
+        self.assertRaises(ValueError, self.stream.reader, None)
+
+    def testClosedLateReader(self):
+        self.readAll(self.stream.reader(None))
+        late = self.stream.reader(None)
+        self.stream.seal()
+        late.close()
+        self.assertEqual(self.stream.lagging, 0)
+        self.assertTrue(self.stream.spill is None)
+
+    def testFromBytes(self):
+        stream = InputStream.from_bytes(self.data)
+        self.stream = stream
+        first = stream.reader(None)
+        self.assertEqual(self.readAll(first)[0], self.data)
+        # Nothing is spilled, so all of the data is kept until sealing.
+        late = stream.reader(None)
+        stream.seal()
+        self.assertEqual(self.readAll(late)[0], self.data)
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(InputStreamTest)
+    unittest.TextTestRunner().run(suite)
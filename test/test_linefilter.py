@@ -0,0 +1,61 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of --include/--exclude line filtering (psshlib.linefilter)."""
+
+import os
+import sys
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib.linefilter import LineFilter, StreamFilter
+
+class LineFilterTest(unittest.TestCase):
+    def testInclude(self):
+        linefilter = LineFilter(include=['err', 'warn'])
+        self.assertTrue(linefilter.keep('an error\n'.encode()))
+        self.assertTrue(linefilter.keep('warning\n'.encode()))
+        self.assertFalse(linefilter.keep('fine\n'.encode()))
+
+    def testExclude(self):
+        linefilter = LineFilter(include=['err'], exclude=['^debug'])
+        self.assertTrue(linefilter.keep('error\n'.encode()))
+        self.assertFalse(linefilter.keep('debug: error\n'.encode()))
+        self.assertFalse(linefilter.keep('fine\n'.encode()))
+
+class StreamFilterTest(unittest.TestCase):
+    def testPartialLineCarried(self):
+        stream = StreamFilter(LineFilter(include=['error']))
+        self.assertEqual(stream.feed('ok\nan er'.encode()), bytes())
+        self.assertEqual(stream.feed('ror\nok\n'.encode()),
+                'an error\n'.encode())
+        self.assertEqual(stream.finish(), bytes())
+        self.assertEqual(stream.matches, 1)
+
+    def testMatchCount(self):
+        data = 'x1\ny\nx2\nx3 debug\nz\nx4'.encode()
+        for size in range(1, len(data) + 1):
+            stream = StreamFilter(LineFilter(include=['x'],
+                exclude=['debug']))
+            output = []
+            for i in range(0, len(data), size):
+                output.append(stream.feed(data[i:i + size]))
+            output.append(stream.finish())
+            self.assertEqual(bytes().join(output), 'x1\nx2\nx4'.encode())
+            self.assertEqual(stream.matches, 3)
+
+    def testFinalPartialLineRejected(self):
+        stream = StreamFilter(LineFilter(exclude=['tail']))
+        self.assertEqual(stream.feed('head\ntail'.encode()),
+                'head\n'.encode())
+        self.assertEqual(stream.finish(), bytes())
+        self.assertEqual(stream.matches, 1)
+
+if __name__ == '__main__':
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(LineFilterTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(StreamFilterTest))
+    unittest.TextTestRunner().run(suite)
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of line assembly across chunk boundaries (psshutil.LineSplitter)."""
+
+import os
+import sys
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib.psshutil import LineSplitter
+
+class LineSplitterTest(unittest.TestCase):
+    def testWholeLines(self):
+        splitter = LineSplitter()
+        lines = splitter.split('one\ntwo\n'.encode())
+        self.assertEqual(lines, ['one\n'.encode(), 'two\n'.encode()])
+        self.assertEqual(splitter.rest(), None)
+
+    def testPartialLineCarried(self):
+        splitter = LineSplitter()
+        self.assertEqual(splitter.split('one\ntw'.encode()),
+                ['one\n'.encode()])
+        self.assertEqual(splitter.split('o\nthr'.encode()),
+                ['two\n'.encode()])
+        self.assertEqual(splitter.rest(), 'thr'.encode())
+        self.assertEqual(splitter.rest(), None)
+
+    def testLineAcrossManyChunks(self):
+        splitter = LineSplitter()
+        for piece in ('a', 'b', '', 'c'):
+            self.assertEqual(splitter.split(piece.encode()), [])
+        self.assertEqual(splitter.split('d\ne\n'.encode()),
+                ['abcd\n'.encode(), 'e\n'.encode()])
+        self.assertEqual(splitter.rest(), None)
+
+    def testNewlineAtChunkStart(self):
+        splitter = LineSplitter()
+        self.assertEqual(splitter.split('one'.encode()), [])
+        self.assertEqual(splitter.split('\n\n'.encode()),
+                ['one\n'.encode(), '\n'.encode()])
+
+    def testEveryBoundary(self):
+        data = 'alpha\n\nbeta gamma\ndelta\nrest'.encode()
+        expected = data.splitlines(True)
+        for i in range(len(data) + 1):
+            for j in range(i, len(data) + 1):
+                splitter = LineSplitter()
+                lines = []
+                for chunk in (data[:i], data[i:j], data[j:]):
+                    lines.extend(splitter.split(chunk))
+                lines.append(splitter.rest())
+                self.assertEqual(lines, expected)
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(LineSplitterTest)
+    unittest.TextTestRunner().run(suite)
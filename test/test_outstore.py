@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of the indexed output store (psshlib.outstore)."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib import outstore
+from psshlib.outstore import OutputStore, StoreWriter, STDOUT, STDERR
+
+class OutputStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'store')
+        # The (host, stream, data) of each extent, in the order written.
+        self.extents = [('web1', STDOUT, 'up 1 day\n'.encode()),
+                ('web2', STDOUT, 'up 2 days\n'.encode()),
+                ('web1', STDERR, 'warning\n'.encode()),
+                ('web1', STDOUT, 'load 0.1\n'.encode())]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writeRun(self, extents):
+        writer = StoreWriter(self.path)
+        for host, stream, data in extents:
+            writer.open((host, stream))
+            writer.write((host, stream), [data])
+        writer.finish()
+
+    def readIndex(self):
+        f = open(outstore.index_path(self.path), 'rb')
+        data = f.read()
+        f.close()
+        return data
+
+    def truncateIndex(self, length):
+        f = open(outstore.index_path(self.path), 'r+b')
+        f.truncate(length)
+        f.close()
+
+    def expected(self, extents):
+        """Returns the output of each (host, stream) in the extents."""
+        output = {}
+        for host, stream, data in extents:
+            key = (host, stream)
+            output[key] = output.get(key, bytes()) + data
+        return output
+
+    def check(self, store, extents, run=None):
+        for (host, stream), data in self.expected(extents).items():
+            self.assertEqual(bytes().join(store.read(host, stream, run)),
+                    data)
+            self.assertEqual(store.size(host, stream, run), len(data))
+
+    def extentEnds(self, index):
+        """Returns the offsets in the index where extent records end."""
+        ends = []
+        pos = len(outstore.MAGIC)
+        while pos < len(index):
+            kind = index[pos:pos + 1]
+            if kind == outstore.RUN_TYPE:
+                pos += outstore.RUN.size
+            elif kind == outstore.HOST_TYPE:
+                _, _, size = outstore.HOST.unpack_from(index, pos)
+                pos += outstore.HOST.size + size
+            else:
+                pos += outstore.EXTENT.size
+                ends.append(pos)
+        return ends
+
+    def testReadBack(self):
+        self.writeRun(self.extents)
+        store = OutputStore(self.path)
+        self.assertEqual(store.hosts(), ['web1', 'web2'])
+        self.check(store, self.extents)
+        self.assertEqual(list(store.lines('web1')),
+                ['up 1 day\n'.encode(), 'load 0.1\n'.encode()])
+        self.assertEqual(list(store.grep('days')),
+                [('web2', 'up 2 days\n'.encode())])
+        store.close()
+
+    def testTruncatedIndex(self):
+        self.writeRun(self.extents)
+        index = self.readIndex()
+        ends = self.extentEnds(index)
+        self.assertEqual(len(ends), len(self.extents))
+        for length in range(len(outstore.MAGIC), len(index) + 1):
+            self.truncateIndex(length)
+            store = OutputStore(self.path)
+            complete = len([end for end in ends if end <= length])
+            if complete:
+                self.check(store, self.extents[:complete])
+            for run in store.runs:
+                # Only complete records are parsed.
+                count = sum([len(extents)
+                    for extents in run.extents.values()])
+                self.assertEqual(count, complete)
+            store.close()
+            f = open(outstore.index_path(self.path), 'wb')
+            f.write(index)
+            f.close()
+
+    def testRecovery(self):
+        self.writeRun(self.extents)
+        index = self.readIndex()
+        second = [('db1', STDOUT, 'ok\n'.encode())]
+        # Cut the index in the middle of the last extent record, as a crash
+        # might, and then append another run.
+        for cut in (1, outstore.EXTENT.size // 2, outstore.EXTENT.size - 1):
+            f = open(outstore.index_path(self.path), 'wb')
+            f.write(index[:len(index) - cut])
+            f.close()
+            self.writeRun(second)
+            store = OutputStore(self.path)
+            self.assertEqual(len(store.runs), 2)
+            self.check(store, self.extents[:-1], 1)
+            self.check(store, second, 2)
+            self.assertEqual(store.hosts(2), ['db1'])
+            store.close()
+
+    def testTruncatedSegment(self):
+        self.writeRun(self.extents)
+        f = open(self.path, 'r+b')
+        f.truncate(3)
+        f.close()
+        store = OutputStore(self.path)
+        self.assertRaises(outstore.StoreError, list, store.read('web2'))
+        store.close()
+
+    def testNotAStore(self):
+        f = open(outstore.index_path(self.path), 'wb')
+        f.write('something else\n'.encode())
+        f.close()
+        open(self.path, 'wb').close()
+        self.assertRaises(outstore.StoreError, OutputStore, self.path)
+
+    def testRecordBeforeRun(self):
+        records = (outstore.EXTENT.pack(outstore.EXTENT_TYPE, 0, 1, 0, 3),
+                outstore.HOST.pack(outstore.HOST_TYPE, 0, 0))
+        for record in records:
+            self.assertRaises(outstore.StoreError, outstore.parse_index,
+                    outstore.MAGIC + record)
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(OutputStoreTest)
+    unittest.TextTestRunner().run(suite)
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of the readiness notification backends (psshlib.poller)."""
+
+import os
+import select
+import sys
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib.poller import EpollPoller, PollPoller, SelectPoller
+from psshlib.poller import POLL_READ, POLL_WRITE
+
+class PollerTests(object):
+    """Tests shared by every poller; subclasses set poller_class."""
+    def setUp(self):
+        self.poller = self.poller_class()
+        self.rfd, self.wfd = os.pipe()
+
+    def tearDown(self):
+        self.poller.close()
+        for fd in (self.rfd, self.wfd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def ready(self):
+        return dict(self.poller.poll(0))
+
+    def testRegister(self):
+        self.poller.update(self.rfd, POLL_READ)
+        self.poller.update(self.wfd, POLL_WRITE)
+        self.assertEqual(self.ready(), {self.wfd: POLL_WRITE})
+        os.write(self.wfd, 'x'.encode())
+        self.assertEqual(self.ready(),
+                {self.rfd: POLL_READ, self.wfd: POLL_WRITE})
+
+    def testModify(self):
+        self.poller.update(self.wfd, POLL_READ)
+        self.assertEqual(self.ready(), {})
+        self.poller.update(self.wfd, POLL_READ | POLL_WRITE)
+        self.assertEqual(self.ready(), {self.wfd: POLL_WRITE})
+        # Setting the same events again is harmless.
+        self.poller.update(self.wfd, POLL_READ | POLL_WRITE)
+        self.assertEqual(self.ready(), {self.wfd: POLL_WRITE})
+
+    def testUnregister(self):
+        self.poller.update(self.wfd, POLL_WRITE)
+        self.poller.update(self.wfd, 0)
+        self.assertEqual(self.ready(), {})
+        # The fd can be registered again afterwards.
+        self.poller.update(self.wfd, POLL_WRITE)
+        self.assertEqual(self.ready(), {self.wfd: POLL_WRITE})
+
+    def testUnregisterUnknown(self):
+        self.poller.update(self.rfd, 0)
+        self.poller.update(self.wfd, POLL_WRITE)
+        self.poller.update(self.wfd, 0)
+        self.poller.update(self.wfd, 0)
+        self.assertEqual(self.ready(), {})
+
+    def testTimeout(self):
+        self.poller.update(self.rfd, POLL_READ)
+        self.assertEqual(self.poller.poll(0.01), [])
+
+class EpollPollerTest(PollerTests, unittest.TestCase):
+    poller_class = EpollPoller
+
+    def testUnregisterClosed(self):
+        # Closing an fd drops it from the epoll set behind our back.
+        self.poller.update(self.wfd, POLL_WRITE)
+        os.close(self.wfd)
+        self.poller.update(self.wfd, 0)
+        self.assertEqual(self.ready(), {})
+
+    def testReusedNumber(self):
+        # A closed fd's number may come back before it is unregistered.
+        os.write(self.wfd, 'x'.encode())
+        self.poller.update(self.wfd, POLL_WRITE)
+        os.close(self.wfd)
+        fd = os.dup(self.rfd)
+        self.assertEqual(fd, self.wfd)
+        self.poller.update(fd, POLL_READ)
+        self.assertEqual(self.ready(), {fd: POLL_READ})
+
+class PollPollerTest(PollerTests, unittest.TestCase):
+    poller_class = PollPoller
+
+class SelectPollerTest(PollerTests, unittest.TestCase):
+    poller_class = SelectPoller
+
+if __name__ == '__main__':
+    suite = unittest.TestSuite()
+    tests = []
+    if hasattr(select, 'epoll'):
+        tests.append(EpollPollerTest)
+    if hasattr(select, 'poll'):
+        tests.append(PollPollerTest)
+    tests.append(SelectPollerTest)
+    for test in tests:
+        suite.addTest(unittest.TestLoader().loadTestsFromTestCase(test))
+    unittest.TextTestRunner().run(suite)
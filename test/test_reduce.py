@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of the fleet-wide reducers for --reduce (psshlib.reduce)."""
+
+import os
+import sys
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib.reduce import get_reducer, parse_spec
+
+g_lines = [('web1', 'load 0.50 12%'),
+        ('web2', 'load 2.25 85%'),
+        ('web3', 'load 1 7%'),
+        ('web3', 'no numbers here'),
+        ('db1', '')]
+
+g_created = []
+
+class CountingReducer(object):
+    """A custom reducer that records how many times it is created."""
+    def __init__(self):
+        g_created.append(self)
+        self.hosts = set()
+
+    def add(self, host, line):
+        self.hosts.add(host)
+
+    def result(self):
+        return ' '.join(sorted(self.hosts))
+
+def reduce_lines(spec, lines=g_lines):
+    reducer = get_reducer(spec)
+    for host, line in lines:
+        reducer.add(host, line)
+    return reducer.result()
+
+class ReducerTest(unittest.TestCase):
+    def testSum(self):
+        self.assertEqual(reduce_lines('sum:2'),
+                '3.75 (3 values, 2 lines skipped)')
+        self.assertEqual(reduce_lines('sum:3'),
+                '104 (3 values, 2 lines skipped)')
+        self.assertEqual(reduce_lines('sum'),
+                '0 (0 values, 5 lines skipped)')
+
+    def testMax(self):
+        self.assertEqual(reduce_lines('max:2'),
+                '2.25 on web2 (3 values, 2 lines skipped)')
+        self.assertEqual(reduce_lines('max'),
+                'no values (0 values, 5 lines skipped)')
+
+    def testMin(self):
+        self.assertEqual(reduce_lines('min:3'),
+                '7 on web3 (3 values, 2 lines skipped)')
+
+    def testCount(self):
+        self.assertEqual(reduce_lines('count'), '5 lines')
+
+    def testHist(self):
+        self.assertEqual(reduce_lines('hist:1').split('\n'),
+                ['2 distinct values (4 values, 1 lines skipped)',
+                '       3 load',
+                '       1 no'])
+
+    def testCustom(self):
+        del g_created[:]
+        spec = '%s:CountingReducer' % __name__
+        self.assertEqual(reduce_lines(spec), 'db1 web1 web2 web3')
+        self.assertEqual(len(g_created), 1)
+
+    def testParseSpecCreatesNothing(self):
+        del g_created[:]
+        factory, args = parse_spec('%s:CountingReducer' % __name__)
+        self.assertEqual(g_created, [])
+        self.assertTrue(factory is CountingReducer)
+        self.assertEqual(parse_spec('sum:3')[1], (3,))
+
+    def testInvalidSpecs(self):
+        for spec in ('nosuch', 'count:2', 'sum:0', 'sum:x',
+                'nosuchmodule:Reducer', '%s:Nothing' % __name__):
+            self.assertRaises(ValueError, parse_spec, spec)
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(ReducerTest)
+    unittest.TextTestRunner().run(suite)
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of the report reordering buffer for --ordered (psshlib.reorder)."""
+
+import io
+import os
+import sys
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib.reorder import ReorderBuffer
+
+def report(number, size=4):
+    return ('%d' % number).encode() * size
+
+class ReorderBufferTest(unittest.TestCase):
+    def testInOrder(self):
+        stream = io.BytesIO()
+        reorder = ReorderBuffer(stream)
+        for number in range(3):
+            self.assertTrue(reorder.is_next(number))
+            reorder.add(number, report(number))
+        self.assertEqual(stream.getvalue(), '000011112222'.encode())
+        self.assertEqual(reorder.held, {})
+
+    def testOutOfOrderRelease(self):
+        stream = io.BytesIO()
+        reorder = ReorderBuffer(stream)
+        reorder.add(2, report(2))
+        reorder.add(1, report(1))
+        self.assertEqual(stream.getvalue(), bytes())
+        self.assertEqual(reorder.size, 8)
+        reorder.add(0, report(0))
+        self.assertEqual(stream.getvalue(), '000011112222'.encode())
+        self.assertEqual(reorder.size, 0)
+        reorder.add(4, report(4))
+        self.assertEqual(stream.getvalue(), '000011112222'.encode())
+        reorder.finish()
+        self.assertEqual(stream.getvalue(), '0000111122224444'.encode())
+
+    def testWrittenDirectly(self):
+        stream = io.BytesIO()
+        reorder = ReorderBuffer(stream)
+        reorder.add(1, report(1))
+        self.assertFalse(reorder.is_next(1))
+        self.assertTrue(reorder.is_next(0))
+        stream.write(report(0))
+        reorder.written()
+        self.assertEqual(stream.getvalue(), '00001111'.encode())
+
+    def testSpill(self):
+        stream = io.BytesIO()
+        reorder = ReorderBuffer(stream, limit=10)
+        for number in (5, 4, 3, 2, 1):
+            reorder.add(number, report(number))
+        # Two reports fit in memory and the rest are in the spill file.
+        self.assertEqual(reorder.size, 8)
+        self.assertEqual(reorder.spillcount, 3)
+        self.assertEqual(reorder.spilled, 12)
+        reorder.add(0, report(0))
+        self.assertEqual(stream.getvalue(),
+                ''.join(['%d' % n * 4 for n in range(6)]).encode())
+        self.assertEqual(reorder.spillcount, 0)
+        # The spill file is emptied and reused once it has been drained.
+        self.assertEqual(os.fstat(reorder.spillfile.fileno()).st_size, 0)
+        reorder.add(8, report(8, 20))
+        reorder.add(7, report(7))
+        reorder.finish()
+        self.assertEqual(stream.getvalue()[24:],
+                report(7) + report(8, 20))
+        self.assertEqual(reorder.spillfile, None)
+
+    def testSpillLargeReport(self):
+        # Reports longer than one copy are read back in pieces.
+        stream = io.BytesIO()
+        reorder = ReorderBuffer(stream, limit=0)
+        big = os.urandom(200000)
+        reorder.add(1, big)
+        reorder.add(0, report(0))
+        self.assertEqual(stream.getvalue(), report(0) + big)
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(ReorderBufferTest)
+    unittest.TextTestRunner().run(suite)
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of worker processes (--workers) with a local fake ssh.
+
+Like test_controlpool.py, these need no remote hosts: test/fakessh stands in
+for ssh and runs every command locally.
+"""
+
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib import api
+from psshlib import shard
+
+g_hosts = ['h%s' % i for i in range(1, 13)]
+
+class ShardTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # Put the fake ssh first in the PATH.
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bindir)
+        os.symlink(os.path.join(basedir, 'test', 'fakessh'),
+                os.path.join(bindir, 'ssh'))
+        self.oldpath = os.environ['PATH']
+        os.environ['PATH'] = '%s:%s' % (bindir, self.oldpath)
+        self.hostfile = os.path.join(self.tmpdir, 'hosts')
+        f = open(self.hostfile, 'w')
+        f.write(''.join('%s\n' % host for host in g_hosts))
+        f.close()
+
+    def tearDown(self):
+        os.environ['PATH'] = self.oldpath
+        shutil.rmtree(self.tmpdir)
+
+    def pssh(self, *args, **kwargs):
+        """Runs pssh with two workers and returns its stdout and stderr."""
+        status = kwargs.get('status', 0)
+        cmd = [sys.executable, '%s/bin/pssh' % basedir, '--workers', '2',
+                '-h', self.hostfile]
+        cmd.extend(args)
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        self.assertEqual(proc.returncode, status)
+        return stdout.decode(), stderr.decode()
+
+    def statuses(self, stdout):
+        """Returns (counter, status, host) for each status line."""
+        return re.findall(r'^\[(\d+)\] [\d:]+ \[(\w+)\] (\S+)', stdout,
+                re.MULTILINE)
+
+    def testFailures(self):
+        stdout, stderr = self.pssh('-p', '4', 'exit $((PSSH_NODENUM % 3))')
+        self.assertEqual(stderr, '')
+        statuses = self.statuses(stdout)
+        self.assertEqual(sorted(host for _, _, host in statuses),
+                sorted(g_hosts))
+        self.assertEqual([int(n) for n, _, _ in statuses],
+                list(range(1, len(g_hosts) + 1)))
+        failures = [line for line in stdout.splitlines()
+                if '[FAILURE]' in line]
+        self.assertEqual(len(failures), 8)
+        self.assertEqual(len([line for line in failures
+            if line.endswith('Exited with error code 1')]), 4)
+        self.assertEqual(len([line for line in failures
+            if line.endswith('Exited with error code 2')]), 4)
+
+    def testOrdered(self):
+        stdout, _ = self.pssh('--ordered', '-i',
+                'sleep 0.$((12 - PSSH_NODENUM)); echo $PSSH_NODENUM')
+        statuses = self.statuses(stdout)
+        self.assertEqual(statuses, [(str(i + 1), 'SUCCESS', host)
+            for i, host in enumerate(g_hosts)])
+        outputs = [line for line in stdout.splitlines()
+                if not line.startswith('[')]
+        self.assertEqual(outputs, [str(i) for i in range(len(g_hosts))])
+
+    def testOutdir(self):
+        outdir = os.path.join(self.tmpdir, 'out')
+        self.pssh('-o', outdir, '--max-open-files', '3', 'echo $PSSH_NODENUM')
+        for i, host in enumerate(g_hosts):
+            f = open(os.path.join(outdir, host))
+            self.assertEqual(f.read(), '%s\n' % i)
+            f.close()
+
+    def testIncompatible(self):
+        _, stderr = self.pssh('-I', 'true', status=2)
+        self.assertTrue('The -I option cannot be used with --workers.'
+                in stderr)
+        for kwargs in ({'send_input': True}, {'reduce': 'sum'},
+                {'store': 'dir'}, {'engine': 'asyncio'}):
+            opts = api.Options(workers=2, **kwargs)
+            self.assertRaises(ValueError, shard.check_options, opts)
+            self.assertRaises(ValueError, shard.ShardedManager, opts)
+        shard.check_options(api.Options(workers=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
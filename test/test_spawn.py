@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of process creation for Tasks (psshlib.spawn)."""
+
+import os
+import signal
+import sys
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib import spawn
+
+class SpawnTest(unittest.TestCase):
+    def spawnStatus(self):
+        """Returns the fields of /proc/PID/status of a spawned shell."""
+        proc = spawn.spawn(['sh', '-c', 'cat /proc/$$/status'],
+                dict(os.environ))
+        proc.stdin.close()
+        output = proc.stdout.read().decode()
+        proc.stdout.close()
+        proc.stderr.close()
+        os.waitpid(proc.pid, 0)
+        proc.returncode = 0
+        fields = {}
+        for line in output.splitlines():
+            name, _, value = line.partition(':')
+            fields[name] = value.strip()
+        return fields
+
+    def testSignalsRestored(self):
+        if not os.path.exists('/proc/self/status'):
+            return
+        # Python itself ignores SIGPIPE and SIGXFSZ.
+        self.assertEqual(signal.getsignal(signal.SIGPIPE), signal.SIG_IGN)
+        ignored = int(self.spawnStatus()['SigIgn'], 16)
+        for number in (signal.SIGPIPE, signal.SIGXFSZ):
+            self.assertFalse(ignored & (1 << (number - 1)),
+                    'signal %s is ignored' % number)
+
+    def testSignalsRestoredWithoutPosixSpawn(self):
+        have_posix_spawn = spawn.HAVE_POSIX_SPAWN
+        spawn.HAVE_POSIX_SPAWN = False
+        try:
+            self.testSignalsRestored()
+        finally:
+            spawn.HAVE_POSIX_SPAWN = have_posix_spawn
+
+    def testBrokenPipe(self):
+        # With SIGPIPE ignored, yes would report "Broken pipe" on stderr.
+        proc = spawn.spawn(['sh', '-c', 'yes | head -1'], dict(os.environ))
+        proc.stdin.close()
+        self.assertEqual(proc.stdout.read(), 'y\n'.encode())
+        self.assertEqual(proc.stderr.read(), bytes())
+        proc.stdout.close()
+        proc.stderr.close()
+        os.waitpid(proc.pid, 0)
+        proc.returncode = 0
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(SpawnTest)
+    unittest.TextTestRunner().run(suite)
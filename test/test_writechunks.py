@@ -0,0 +1,160 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Andrew McNabb
+
+"""Tests of batched output writing (psshutil.write_chunks, WriterThread)."""
+
+import fcntl
+import os
+import signal
+import sys
+import threading
+import time
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.append("%s" % basedir)
+
+from psshlib import psshutil
+from psshlib.manager import WriterThread
+
+PIPE_SIZE = 4096
+
+def make_chunks(count, size):
+    return [('%x' % (i % 16)).encode() * size for i in range(count)]
+
+class Drain(threading.Thread):
+    """Reads a pipe slowly, so that writes to it block and are interrupted."""
+    def __init__(self, fd):
+        threading.Thread.__init__(self)
+        self.fd = fd
+        self.data = []
+
+    def run(self):
+        while True:
+            data = os.read(self.fd, 1024)
+            if not data:
+                break
+            self.data.append(data)
+            time.sleep(0.001)
+
+class WriteChunksTest(unittest.TestCase):
+    def setUp(self):
+        self.rfd, self.wfd = os.pipe()
+        if hasattr(fcntl, 'F_SETPIPE_SZ'):
+            fcntl.fcntl(self.wfd, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+        self.results = []
+        self.writev = getattr(os, 'writev', None)
+        self.write = os.write
+        # A signal interrupts a blocked pipe write after part of the data
+        # has gone through, and the write returns the partial count.
+        self.handler = signal.signal(signal.SIGALRM, lambda *args: None)
+        signal.setitimer(signal.ITIMER_REAL, 0.002, 0.002)
+
+    def tearDown(self):
+        signal.setitimer(signal.ITIMER_REAL, 0, 0)
+        signal.signal(signal.SIGALRM, self.handler)
+        if self.writev:
+            os.writev = self.writev
+        os.write = self.write
+        psshutil.HAVE_WRITEV = bool(self.writev)
+        for fd in (self.rfd, self.wfd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def record(self, function):
+        def wrapper(fd, data):
+            written = function(fd, data)
+            self.results.append(written)
+            return written
+        return wrapper
+
+    def roundTrip(self, chunks):
+        drain = Drain(self.rfd)
+        drain.start()
+        total, calls = psshutil.write_chunks(self.wfd, list(chunks))
+        os.close(self.wfd)
+        drain.join()
+        self.assertEqual(bytes().join(drain.data), bytes().join(chunks))
+        self.assertEqual(total, sum([len(chunk) for chunk in chunks]))
+        return calls
+
+    def testPartialWritev(self):
+        if not self.writev:
+            return
+        os.writev = self.record(self.writev)
+        calls = self.roundTrip(make_chunks(64, 1000))
+        # Each call after the first resumed after a partial write.
+        self.assertTrue(len(self.results) > 1)
+        self.assertEqual(calls, len(self.results))
+
+    def testPartialWrite(self):
+        psshutil.HAVE_WRITEV = False
+        os.write = self.record(self.write)
+        calls = self.roundTrip(make_chunks(64, 1000))
+        self.assertTrue(len(self.results) > 1)
+        self.assertEqual(calls, len(self.results))
+
+    def testIovMax(self):
+        # Without interruptions, each group of IOV_MAX chunks takes one call.
+        signal.setitimer(signal.ITIMER_REAL, 0, 0)
+        chunks = make_chunks(psshutil.IOV_MAX * 2 + 1, 3)
+        self.assertEqual(self.roundTrip(chunks), 3)
+
+class RecordingSink(object):
+    def __init__(self):
+        self.calls = []
+
+    def open(self, handle):
+        self.calls.append(('open', handle))
+
+    def write(self, handle, chunks):
+        self.calls.append(('write', handle, bytes().join(chunks)))
+
+    def close(self, handle):
+        self.calls.append(('close', handle))
+
+    def finish(self):
+        self.calls.append(('finish',))
+
+class WriterThreadTest(unittest.TestCase):
+    def testBatching(self):
+        sink = RecordingSink()
+        writer = WriterThread(sink)
+        # Queue everything before starting so it is taken in one batch.
+        writer.queue.put(('a', WriterThread.OPEN))
+        writer.queue.put(('b', WriterThread.OPEN))
+        for i in range(10):
+            writer.queue.put(('a', ('a%d' % i).encode()))
+            writer.queue.put(('b', ('b%d' % i).encode()))
+        writer.queue.put(('a', WriterThread.EOF))
+        writer.queue.put((WriterThread.ABORT, None))
+        writer.start()
+        writer.join()
+        a = ''.join(['a%d' % i for i in range(10)]).encode()
+        b = ''.join(['b%d' % i for i in range(10)]).encode()
+        self.assertEqual(writer.batches, 1)
+        self.assertEqual(sink.calls[:4], [('open', 'a'), ('open', 'b'),
+            ('write', 'a', a), ('close', 'a')])
+        self.assertEqual(sink.calls[4:], [('write', 'b', b), ('finish',)])
+
+    def testFlushSize(self):
+        sink = RecordingSink()
+        writer = WriterThread(sink)
+        chunk = 'x'.encode() * (WriterThread.FLUSH_SIZE // 2)
+        writer.queue.put(('a', WriterThread.OPEN))
+        for i in range(5):
+            writer.queue.put(('a', chunk))
+        writer.queue.put((WriterThread.ABORT, None))
+        writer.start()
+        writer.join()
+        sizes = [len(call[2]) for call in sink.calls if call[0] == 'write']
+        self.assertEqual(sizes, [len(chunk) * 2, len(chunk) * 2, len(chunk)])
+
+if __name__ == '__main__':
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(WriteChunksTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(WriterThreadTest))
+    unittest.TextTestRunner().run(suite)